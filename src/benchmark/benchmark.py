@@ -0,0 +1,243 @@
+'''
+Scaling benchmark of the pipeline stages on synthetic hotspots (synthetic.py), fully offline.
+
+For every size in `sizes` the hotspots are generated once and go through the same functions
+as the pipeline scripts:
+  merge   gen_graph.py: nodes from the rows and merge_close_nodes (merge_distance)
+  edges   gen_graph.py: add_edges_by_distance, once per radius in `radii`
+  expand  increase_radius.py: components of the graph coarsened and linked at add_edges_distance2
+  metrics degree_analysis.py: graph_metrics (degree, clustering, distances, betweenness)
+  sir     the animation and propagation scripts: batch_sir from `sir_seeds` random nodes
+Every stage is measured by instrument.py (wall and CPU time, peak memory) and its records are
+written to data/benchmark_report.jsonl. A stage that takes more than `max_seconds` is not run
+on the larger sizes (nor are the stages that need its output), so the sizes can go up to
+millions of points without the largest ones running for hours.
+
+The report gives the throughput (input points per second) and the memory of every stage
+(peak resident memory above the memory at its start) against the size, compared with the
+baseline saved by `--save-baseline` in data/benchmark_baseline.json. Stages more than
+instrument.REGRESSION_RATIO times slower than the baseline are listed and make the script
+exit with an error.
+'''
+import argparse
+import configparser
+import gc
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+from synthetic import synthetic_hotspots, options_from_config
+
+from gen_graph import add_edges_by_distance, graph_from_dataframe, merge_close_nodes
+from graph_io import CSRGraph
+from increase_radius import component_labels, create_subgraph_from_edges
+from spatial import neighbor_pairs
+
+import sir
+from graph_metrics import graph_metrics
+
+import instrument
+
+config_file = os.environ['CONFIG']
+config = configparser.ConfigParser()
+config.read(config_file)
+logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+log = logging.getLogger(os.path.basename(__file__))
+
+REPORT_FILE = "../../data/benchmark_report.jsonl"
+BASELINE_FILE = "../../data/benchmark_baseline.json"
+PLOT_FILE = "../../data/benchmark_scaling.png"
+STAGES = ("merge", "edges", "expand", "metrics", "sir")
+# stages that need the output of another stage
+NEEDS = {"edges": "merge", "expand": "edges", "metrics": "edges", "sir": "edges"}
+
+
+def _key(stage, points, radius):
+    return f"{stage}|{points}|{radius}"
+
+
+class Budget:
+    """Stages (per radius) that went over `max_seconds`, and are not run on larger inputs."""
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+        self.over = set()
+
+    def allows(self, stage, radius=None):
+        while stage:
+            if (stage, radius) in self.over or (stage, None) in self.over:
+                return False
+            stage = NEEDS.get(stage)
+        return True
+
+    def check(self, stage, radius, seconds):
+        if seconds is not None and seconds > self.max_seconds:
+            log.info(f"{stage} took {seconds:.0f} s > {self.max_seconds:g} s: not run on larger inputs")
+            self.over.add((stage, radius))
+
+
+def run_size(points, radii, budget, options):
+    """Runs every stage allowed by the budget on `points` synthetic hotspots."""
+    df = synthetic_hotspots(points, **options['synthetic'])
+    with instrument.stage("merge", points=points) as record:
+        G = merge_close_nodes(graph_from_dataframe(df), options['merge_distance'])
+        record.record(nodes=G.number_of_nodes())
+    budget.check("merge", None, record.seconds)
+    merged = CSRGraph.from_networkx(G)
+    del df, G
+
+    for radius in radii:
+        if not budget.allows("edges", radius):
+            continue
+        with instrument.stage("edges", points=points, radius=radius) as record:
+            G = merged.to_networkx()
+            add_edges_by_distance(G, radius)
+            graph = CSRGraph.from_networkx(G)
+            record.record(nodes=graph.n, edges=graph.m)
+        del G
+        budget.check("edges", radius, record.seconds)
+
+        if budget.allows("expand", radius):
+            with instrument.stage("expand", points=points, radius=radius) as record:
+                coarse = create_subgraph_from_edges(graph)
+                i, j, distances = neighbor_pairs(coarse.nodes['Latitude'], coarse.nodes['Longitude'],
+                                                 options['expand_distance'])
+                expanded = CSRGraph.from_edges(coarse.ids, coarse.nodes, i, j, distances)
+                component_labels(expanded)
+                record.record(nodes=expanded.n, edges=expanded.m)
+            budget.check("expand", radius, record.seconds)
+
+        if budget.allows("metrics", radius):
+            with instrument.stage("metrics", points=points, radius=radius, nodes=graph.n, edges=graph.m) as record:
+                samples = options['metric_samples'] or None
+                graph_metrics(graph, samples=samples if samples and samples < graph.n else None)
+            budget.check("metrics", radius, record.seconds)
+
+        if budget.allows("sir", radius):
+            rng = np.random.default_rng(options['synthetic']['seed'])
+            seeds = rng.choice(graph.n, size=min(options['sir_seeds'], graph.n), replace=False)
+            with instrument.stage("sir", points=points, radius=radius, nodes=graph.n, edges=graph.m) as record:
+                sir.batch_sir(graph, 1.0, 1.0, seeds, rng=rng)
+            budget.check("sir", radius, record.seconds)
+        del graph
+        gc.collect()
+
+
+def results(records, run):
+    """Top-level stage records of `run`, keyed by stage, points and radius."""
+    found = {}
+    for record in records:
+        if record['run'] == run and record['stage'] in STAGES:
+            sizes = record['sizes']
+            found[_key(record['stage'], sizes['points'], sizes.get('radius'))] = {
+                'stage': record['stage'], 'points': sizes['points'], 'radius': sizes.get('radius'),
+                'nodes': sizes.get('nodes'), 'edges': sizes.get('edges'), 'wall_s': record['wall_s'],
+                'cpu_s': record['cpu_s'], 'memory_mb': round(record['peak_rss_mb'] - record['rss_start_mb'], 1),
+                'points_per_s': round(sizes['points'] / max(record['wall_s'], 1e-9), 1)}
+    return found
+
+
+def compare(current, baseline, ratio=instrument.REGRESSION_RATIO):
+    """:return: list of (key, baseline wall time, wall time) of the stages slower than `ratio` times the baseline"""
+    slower = []
+    for key, result in current.items():
+        before = baseline.get(key)
+        if before and result['wall_s'] > ratio * before['wall_s'] and result['wall_s'] - before['wall_s'] > 0.1:
+            slower.append((key, before['wall_s'], result['wall_s']))
+    return slower
+
+
+def plot_scaling(current, baseline, path=PLOT_FILE):
+    """Throughput and memory of every stage and radius against the number of points."""
+    fig, (ax_speed, ax_memory) = plt.subplots(1, 2, figsize=(14, 6))
+    curves = sorted({(r['stage'], r['radius']) for r in current.values()}, key=lambda c: (STAGES.index(c[0]), c[1] or 0))
+    for stage, radius in curves:
+        label = stage if radius is None else f"{stage} ({radius:g} km)"
+        rows = sorted((r for r in current.values() if (r['stage'], r['radius']) == (stage, radius)),
+                      key=lambda r: r['points'])
+        line, = ax_speed.plot([r['points'] for r in rows], [r['points_per_s'] for r in rows], marker='o', label=label)
+        ax_memory.plot([r['points'] for r in rows], [max(r['memory_mb'], 0.1) for r in rows], marker='o',
+                       color=line.get_color(), label=label)
+        before = sorted((r for r in baseline.values() if (r['stage'], r['radius']) == (stage, radius)),
+                        key=lambda r: r['points'])
+        if before:
+            ax_speed.plot([r['points'] for r in before], [r['points_per_s'] for r in before], linestyle='--',
+                          color=line.get_color(), alpha=0.5)
+            ax_memory.plot([r['points'] for r in before], [max(r['memory_mb'], 0.1) for r in before],
+                           linestyle='--', color=line.get_color(), alpha=0.5)
+    for ax, ylabel in ((ax_speed, "input points per second"), (ax_memory, "peak memory above start (MiB)")):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel("synthetic hotspots")
+        ax.set_ylabel(ylabel)
+        ax.grid(True, which='both', alpha=0.3)
+    ax_speed.set_title("Throughput (dashed: baseline)")
+    ax_memory.set_title("Memory (dashed: baseline)")
+    ax_memory.legend(fontsize=8)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+
+def _cell(value):
+    return "-" if value is None else value
+
+
+def _values(text, type_=int):
+    return [type_(value) for value in text.split(",") if value.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="times the pipeline stages on synthetic hotspots of several sizes")
+    parser.add_argument("--sizes", help="comma separated numbers of points (default: [benchmark] sizes)")
+    parser.add_argument("--radii", help="comma separated edge distances in km (default: [benchmark] radii)")
+    parser.add_argument("--save-baseline", action="store_true", help=f"saves this run as the baseline {BASELINE_FILE}")
+    args = parser.parse_args()
+
+    sizes = _values(args.sizes or config.get("benchmark", "sizes", fallback="1000,10000,100000"))
+    radii = _values(args.radii or config.get("benchmark", "radii", fallback="5,10"), float)
+    options = {'synthetic': options_from_config(config),
+               'merge_distance': config.getint("generate", "merge_distance", fallback=1),
+               'expand_distance': config.getint("generate", "add_edges_distance2", fallback=50),
+               'metric_samples': config.getint("benchmark", "metric_samples", fallback=500),
+               'sir_seeds': config.getint("benchmark", "sir_seeds", fallback=20)}
+    budget = Budget(config.getfloat("benchmark", "max_seconds", fallback=120))
+
+    bench = instrument.Instrument(report_file=REPORT_FILE, profile=config.get("instrument", "profile", fallback="").strip() or None)
+    instrument.set_default(bench)
+    for points in sizes:
+        if not budget.allows("merge"):
+            break
+        log.info(f"--- {points} synthetic hotspots ---")
+        run_size(points, radii, budget, options)
+
+    current = results(instrument.read_report(REPORT_FILE), bench.run_id)
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)['results']
+
+    print(f"{'stage':<8} {'radius':>6} {'points':>9} {'nodes':>9} {'edges':>10} {'wall s':>8} {'points/s':>10} "
+          f"{'MiB':>7} {'baseline':>9}")
+    for key, r in sorted(current.items(), key=lambda item: (STAGES.index(item[1]['stage']), item[1]['radius'] or 0,
+                                                            item[1]['points'])):
+        before = baseline.get(key)
+        versus = f"{r['wall_s'] / before['wall_s']:.2f}x" if before and before['wall_s'] else "-"
+        radius = f"{r['radius']:g}" if r['radius'] is not None else "-"
+        print(f"{r['stage']:<8} {radius:>6} {r['points']:>9} {_cell(r['nodes']):>9} {_cell(r['edges']):>10} "
+              f"{r['wall_s']:>8.2f} {r['points_per_s']:>10.0f} {r['memory_mb']:>7.0f} {versus:>9}")
+    plot_scaling(current, baseline)
+    log.info(f"scaling curves saved to {PLOT_FILE}")
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({'run': bench.run_id, 'results': current}, f, indent=2)
+        log.info(f"baseline saved to {BASELINE_FILE}")
+    slower = compare(current, baseline)
+    for key, before, after in slower:
+        print(f"REGRESSION {key.replace('|', ' ')}: {before:.2f} s -> {after:.2f} s ({after / before:.1f}x)")
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,148 @@
+'''
+Synthetic fire detections inside the bounding box of São Paulo, to run and benchmark the
+pipeline without BigQuery or the Google Drive CSV.
+
+Reasoning: real hotspots are clustered (a fire front is detected many times within a few km,
+and fire seasons concentrate in some regions), so uniform points would give far fewer edges
+and far larger components than real data at the same size. Detections come from a Thomas
+cluster process: cluster centres are uniform in the box, each one gets a lognormal share of
+the points (a few big fires and many small ones), and its detections are spread around the
+centre with a Gaussian of `cluster_km`; a `background` fraction is uniform in the box.
+Detections of a cluster happen within a few days of its start. FRP is lognormal with a heavy
+tail (median around 20 MW, a few detections of thousands of MW), as in MODIS detections.
+
+The columns are those of the BigQuery table, so the DataFrame can be written to a hotspot
+store (hotspot_store.write_store) and read by gen_graph.py unchanged. The detections go to
+their own store, data/synthetic_hotspots, never to the downloaded one: gen_graph.py reads them
+when `store = synthetic_hotspots` is set in the [data] section of config.ini. Partitions that
+already exist are only replaced with --force.
+'''
+import argparse
+import configparser
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from hotspot_store import partition_path, write_store
+
+log = logging.getLogger(os.path.basename(__file__))
+
+# min_longitude, min_latitude, max_longitude, max_latitude of the state of São Paulo
+SP_BBOX = (-53.11, -25.31, -44.16, -19.78)
+KM_PER_DEGREE = 111.195
+SYNTHETIC_STORE_DIR = '../../data/synthetic_hotspots'
+
+
+def _cluster_points(rng, centres, counts, cluster_km, bbox):
+    """Gaussian offsets of `counts[c]` points around every centre, redrawn until inside `bbox`."""
+    owner = np.repeat(np.arange(len(centres)), counts)
+    lon, lat = np.empty(len(owner)), np.empty(len(owner))
+    pending = np.arange(len(owner))
+    while len(pending):
+        centre = centres[owner[pending]]
+        offset = rng.normal(scale=cluster_km / KM_PER_DEGREE, size=(len(pending), 2))
+        lat[pending] = centre[:, 1] + offset[:, 1]
+        lon[pending] = centre[:, 0] + offset[:, 0] / np.cos(np.radians(centre[:, 1]))
+        pending = pending[(lon[pending] < bbox[0]) | (lat[pending] < bbox[1]) |
+                          (lon[pending] > bbox[2]) | (lat[pending] > bbox[3])]
+    return owner, lon, lat
+
+
+def synthetic_hotspots(points, bbox=SP_BBOX, cluster_size=50, cluster_km=3.0, background=0.1, frp_median=20.0,
+                       frp_sigma=1.3, year=2024, months=(8, 9, 10), state='SP',
+                       satellites=('TERRA_M-M', 'TERRA_M-T'), seed=42):
+    """
+    Clustered fire detections.
+
+    :param points: number of detections
+    :param bbox: (min_longitude, min_latitude, max_longitude, max_latitude)
+    :param cluster_size: mean detections per cluster
+    :param cluster_km: standard deviation in km of the detections around their cluster centre
+    :param background: fraction of the detections uniform in the box
+    :param frp_median: median FRP in MW
+    :param frp_sigma: standard deviation of log(FRP)
+    :param year: year of the detections (ano)
+    :param months: months the detections are spread over (mes)
+    :param state: sigla_uf
+    :param satellites: satellite names, one drawn per detection
+    :param seed: seed of the generator
+    :return: DataFrame with one row per detection and the columns of the BigQuery table
+    """
+    rng = np.random.default_rng(seed)
+    n_background = int(round(points * background))
+    n_clusters = max(1, (points - n_background) // cluster_size)
+    centres = np.column_stack((rng.uniform(bbox[0], bbox[2], n_clusters), rng.uniform(bbox[1], bbox[3], n_clusters)))
+    share = rng.lognormal(sigma=1.0, size=n_clusters)
+    counts = rng.multinomial(points - n_background, share / share.sum())
+    owner, lon, lat = _cluster_points(rng, centres, counts, cluster_km, bbox)
+    lon = np.concatenate((lon, rng.uniform(bbox[0], bbox[2], n_background)))
+    lat = np.concatenate((lat, rng.uniform(bbox[1], bbox[3], n_background)))
+
+    # a cluster burns for a few days from its start; background detections are spread over the months
+    first_day = pd.Timestamp(year=year, month=min(months), day=1)
+    days = (pd.Timestamp(year=year, month=max(months), day=1) + pd.offsets.MonthEnd(1) - first_day).days + 1
+    start = rng.uniform(0, days, n_clusters)
+    day = np.concatenate((start[owner] + rng.exponential(1.5, len(owner)), rng.uniform(0, days, n_background)))
+    data_hora = pd.DatetimeIndex(first_day + pd.to_timedelta(np.minimum(day, days - 1e-6), unit='D').floor('min'))
+
+    dias_sem_chuva = rng.poisson(rng.gamma(2.0, 6.0, points))
+    rain = rng.random(points) < 0.1
+    order = rng.permutation(points)
+    df = pd.DataFrame({
+        'dias_sem_chuva': dias_sem_chuva,
+        'Latitude': lat,
+        'Longitude': lon,
+        'FRP': np.round(frp_median * rng.lognormal(sigma=frp_sigma, size=points), 1),
+        'precipitacao': np.where(rain, np.round(rng.exponential(5.0, points), 1), 0.0),
+        'risco_fogo': np.where(rain, 0.0, np.round(1 - np.exp(-dias_sem_chuva / 10), 2)),
+        'satelite': rng.choice(list(satellites), points),
+        'data_hora': data_hora,
+        'sigla_uf': state,
+        'ano': year,
+        'mes': data_hora.month,
+    }).iloc[order].reset_index(drop=True)
+    return df
+
+
+def existing_partitions(df, store_dir):
+    """(ano, mes, sigla_uf) partitions of `df` already present in the store."""
+    partitions = df[['ano', 'mes', 'sigla_uf']].drop_duplicates().itertuples(index=False)
+    return [p for p in partitions if os.path.exists(os.path.dirname(partition_path(store_dir, *p)))]
+
+
+def options_from_config(config, section="benchmark"):
+    data = config["data"] if config.has_section("data") else {}
+    return {'year': int(data.get("year", "2024").split(",")[0]),
+            'months': tuple(int(m) for m in data.get("month", "8,9,10").split(",")),
+            'state': data.get("state", "SP").split(",")[0].strip(),
+            'satellites': tuple(s.strip() for s in data.get("satellites", "TERRA_M-M,TERRA_M-T").split(",")),
+            'seed': config.getint(section, "seed", fallback=42)}
+
+
+if __name__ == "__main__":
+    config = configparser.ConfigParser()
+    config.read(os.environ['CONFIG'])
+    logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+
+    parser = argparse.ArgumentParser(description="writes synthetic hotspots to their own store or to a CSV")
+    parser.add_argument("points", type=int, nargs="?", default=config.getint("benchmark", "points", fallback=20000))
+    parser.add_argument("--store", default=SYNTHETIC_STORE_DIR, help=f"store to write (default: {SYNTHETIC_STORE_DIR})")
+    parser.add_argument("--csv", help="CSV file to write instead of the store")
+    parser.add_argument("--force", action="store_true", help="replaces existing partitions or an existing CSV")
+    args = parser.parse_args()
+
+    df = synthetic_hotspots(args.points, **options_from_config(config))
+    if args.csv:
+        if os.path.exists(args.csv) and not args.force:
+            sys.exit(f"{args.csv} exists; use --force to replace it")
+        df.to_csv(args.csv, index=False)
+    else:
+        existing = existing_partitions(df, args.store)
+        if existing and not args.force:
+            sys.exit(f"partitions {', '.join(f'ano={a}/mes={m}/sigla_uf={s}' for a, m, s in existing)} already exist "
+                     f"in {args.store}; use --force to replace them")
+        write_store(df, args.store)
+    log.info(f"{len(df)} synthetic hotspots written to {args.csv or args.store}")
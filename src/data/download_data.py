@@ -1,56 +1,70 @@
 import configparser
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import pandas as pd
 import requests
 from requests import HTTPError
 import basedosdados as bd
 
+from hotspot_store import STORE_DIR, csv_to_store, partition_path, read_store, store_files, write_partition
+
+import instrument
+from stage_cache import StageCache
+
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
+CSV_FILE = '../../data/queimadas.csv'
 
 
-def download_csv(url, output_path):
+def download_csv(url, output_path, chunk_size=2**20, retries=5, session=None):
     """
-    Download CSV from a URL and save it directly to a file.
+    Download CSV from a URL, streaming it to a file in chunks.
+
+    The data is written to `output_path`.part and renamed when complete. If the download stops,
+    the next attempt asks only for the missing bytes with a Range request and appends them; servers
+    that ignore Range requests send the whole file again, which then replaces the partial one.
 
     Args:
         url: URL to download CSV from
         output_path: Path where to save the CSV file
+        chunk_size: Bytes read from the response at a time
+        retries: Attempts before giving up on connection errors
+        session: requests.Session (or compatible object) used for the requests
     """
-
-    # Download and save the file
-    response = requests.get(url)
-    response.raise_for_status()  # Raise error if download failed
-
-    # Save to file
-    with open(output_path, 'wb') as f:
-        f.write(response.content)
-
+    session = session or requests.Session()
+    part_path = output_path + '.part'
+    for attempt in range(1, retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if offset and response.status_code == 416:
+                    # nothing left to send: the partial file is already complete
+                    break
+                response.raise_for_status()  # Raise error if download failed
+                resumed = offset and response.status_code == 206
+                if offset:
+                    log.info(f"Resuming download at byte {offset}" if resumed else "Server ignored the Range request, restarting download")
+                with open(part_path, 'ab' if resumed else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            log.warning(f"Download interrupted ({e}), retrying ({attempt}/{retries})")
+
+    os.replace(part_path, output_path)
     log.info(f"CSV downloaded and saved to {output_path}")
 
 
-def download_big_query(output_path):
-    """
-    Lib documentation https://basedosdados.org/docs/api_reference_python
-    billing_id Project that will be billed. Find your Project ID here https://console.cloud.google.com/projectselector2/home/dashboard.
-    :param output_path:
-    """
-    # REPLACE WITH YOUR PROJECT ID
-    log.info("Enter your Project ID from google cloud console,\n"
-          "for reference check  https://basedosdados.org/docs/api_reference_python .\n"
-          "eg. mo412-queimadas-em-sp")
-    billing_id = input()
-
-    years = config.get("data", "year", fallback='2024').split(",")
-    months = config.get("data", "month", fallback='9').split(",")
-    states = config.get("data", "state", fallback='SP').split(",")
-    satellites = config.get("data", "satellites").split(",")
-    query = f"""
+def partition_query(year, month, state, satellites):
+    """BigQuery SQL selecting the detections of one year/month/state partition."""
+    return f"""
         SELECT
           `dias_sem_chuva`,
           `latitude`,
@@ -61,43 +75,94 @@ def download_big_query(output_path):
           `sigla_uf`,
           `ano`,
           `mes`,
+          `satelite`,
+          `data_hora`,
         FROM
           `basedosdados.br_inpe_queimadas.microdados`
         WHERE
-          (`ano` IN ({",".join(years)}))
-          AND (`mes` IN ({",".join(months)}))
-          AND (`sigla_uf` IN ('{"','".join(states)}'))
+          (`ano` = {year})
+          AND (`mes` = {month})
+          AND (`sigla_uf` = '{state}')
           AND (`satelite` IN ('{"','".join(satellites)}'));
             """
 
-    log.info(query)
-    df = bd.read_sql(query=query, billing_project_id=billing_id)
-    log.info(df.describe())
+
+def download_partition(read_sql, billing_id, satellites, store_dir, year, month, state):
+    """Downloads one partition and writes it to the store; returns its number of rows."""
+    query = partition_query(year, month, state, satellites)
+    log.debug(query)
+    df = read_sql(query=query, billing_project_id=billing_id)
     df.rename(columns={'longitude': 'Longitude', 'latitude': 'Latitude', 'potencia_radiativa_fogo': 'FRP'}, inplace=True)
-    df.to_csv(output_path, index=False, header=True)
-    return df
+    write_partition(df, year, month, state, store_dir)
+    return len(df)
+
+
+def download_big_query(read_sql=None, billing_id=None, workers=4, store_dir=STORE_DIR):
+    """
+    Lib documentation https://basedosdados.org/docs/api_reference_python
+    billing_id Project that will be billed. Find your Project ID here https://console.cloud.google.com/projectselector2/home/dashboard.
+
+    The query is split in one partition per year, month and state. Partitions are downloaded
+    concurrently, each one written to the Parquet store (hotspot_store.py) as soon as it arrives;
+    partitions already in the store are skipped, so an interrupted download resumes.
+    :param read_sql: function with the signature of basedosdados.read_sql
+    :param billing_id: Google Cloud project id (asked on the terminal if not given)
+    :param workers: partitions downloaded at the same time
+    :param store_dir: root directory of the store
+    """
+    read_sql = read_sql or bd.read_sql
+    years = config.get("data", "year", fallback='2024').split(",")
+    months = config.get("data", "month", fallback='9').split(",")
+    states = config.get("data", "state", fallback='SP').split(",")
+    satellites = config.get("data", "satellites").split(",")
+    partitions = [(year.strip(), month.strip(), state.strip()) for year in years for month in months for state in states]
+    pending = [p for p in partitions if not os.path.exists(partition_path(store_dir, *p))]
+    log.info(f"{len(partitions) - len(pending)}/{len(partitions)} partitions already downloaded")
+
+    if pending and billing_id is None:
+        # REPLACE WITH YOUR PROJECT ID
+        log.info("Enter your Project ID from google cloud console,\n"
+              "for reference check  https://basedosdados.org/docs/api_reference_python .\n"
+              "eg. mo412-queimadas-em-sp")
+        billing_id = config.get("data", "billing_id", fallback=None) or input()
+
+    rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_partition, read_sql, billing_id, satellites, store_dir, *p): p
+                   for p in pending}
+        for future in as_completed(futures):
+            year, month, state = futures[future]
+            rows += future.result()
+            log.info(f"partition ano={year} mes={month} sigla_uf={state}: {future.result()} rows")
+    instrument.record(partitions=len(pending), rows=rows)
+    log.info(f"{len(partitions)} partitions saved to {store_dir}")
+
+
+def download_stage():
+    url='https://drive.google.com/file/d/1l7W0B2MlYWQFH981haUA9h_6w8Q4sfpS/view?usp=sharing'
+    url='https://drive.google.com/uc?id=' + url.split('/')[-2]
+    download_csv(url, output_path=CSV_FILE)
 
 
 if __name__ == "__main__":
     success = False
-    csv_file='../../data/queimadas.csv'
-    df = None
     if not config.getboolean("data", "query", fallback=False):
-        url='https://drive.google.com/file/d/1l7W0B2MlYWQFH981haUA9h_6w8Q4sfpS/view?usp=sharing'
-        url='https://drive.google.com/uc?id=' + url.split('/')[-2]
         try:
-            download_csv(url, output_path=csv_file)
-            df = pd.read_csv(csv_file)
+            # the download is skipped when the CSV is cached
+            StageCache.from_config(config).run("download", [CSV_FILE], download_stage,
+                                               inputs=StageCache.sources(__file__))
             if config.has_option("data", "month"):
-                log.warning(f"Ignoring parameters at {config_file}")
+                log.info(f"The whole CSV is stored; the [data] selection at {config_file} is applied when reading it")
+            with instrument.stage("ingest", csv_mb=round(os.path.getsize(CSV_FILE) / 2**20, 1)):
+                csv_to_store(CSV_FILE)
             success = True
         except HTTPError as e:
             log.info(f"Error downloading CSV: {e}")
 
     if not success:
-        df = download_big_query(output_path=csv_file)
-
-    if df is not None:
-        log.info(df.describe())
-
+        # partitions already in the store are not downloaded again
+        with instrument.stage("download_big_query"):
+            download_big_query()
 
+    log.info(f"{len(store_files())} files in the store")
+    log.info(read_store(columns=['Latitude', 'Longitude', 'FRP']).describe())
@@ -0,0 +1,176 @@
+'''
+Partitioned Parquet store of the fire detections.
+
+Detections are kept under data/hotspots/ano=<year>/mes=<month>/sigla_uf=<state>/ as Parquet
+files with typed columns (float32 coordinates and FRP, dictionary-encoded satellite names), so
+readers neither parse text nor convert types. A selection of years, months, states, satellites
+and a bounding box is pushed down to the dataset scan: partitions outside the selection are
+never opened, row groups are skipped using their column statistics, and only the requested
+columns are read.
+'''
+import glob
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+log = logging.getLogger(os.path.basename(__file__))
+
+STORE_DIR = '../../data/hotspots'
+
+PARTITIONING = pa.schema([('ano', pa.int16()), ('mes', pa.int8()), ('sigla_uf', pa.string())])
+COLUMN_TYPES = {
+    'Latitude': pa.float32(),
+    'Longitude': pa.float32(),
+    'FRP': pa.float32(),
+    'dias_sem_chuva': pa.float32(),
+    'precipitacao': pa.float32(),
+    'risco_fogo': pa.float32(),
+    'satelite': pa.dictionary(pa.int32(), pa.string()),
+    'data_hora': pa.timestamp('us'),
+}
+
+
+def _cast(table):
+    """Casts the known columns of a table to the store types."""
+    for name, type_ in {**COLUMN_TYPES, **dict(zip(PARTITIONING.names, PARTITIONING.types))}.items():
+        index = table.schema.get_field_index(name)
+        if index >= 0 and table.schema.field(index).type != type_:
+            table = table.set_column(index, name, table.column(name).cast(type_))
+    return table
+
+
+def _check_partition_columns(names):
+    missing = [name for name in PARTITIONING.names if name not in names]
+    if missing:
+        raise ValueError(f"columns {missing} are needed to partition the store")
+
+
+def write_store(df, store_dir=STORE_DIR):
+    """
+    Writes the detections of a DataFrame to the store.
+
+    Partitions present in `df` replace the ones on disk; other partitions are kept.
+
+    :param df: DataFrame with ano, mes and sigla_uf columns
+    :param store_dir: root directory of the store
+    """
+    _check_partition_columns(df.columns)
+    table = _cast(pa.Table.from_pandas(df, preserve_index=False))
+    ds.write_dataset(table, store_dir, format='parquet', partitioning=ds.partitioning(PARTITIONING, flavor='hive'),
+                     existing_data_behavior='delete_matching')
+
+
+def write_partition(df, year, month, state, store_dir=STORE_DIR):
+    """
+    Writes the detections of one partition, replacing it atomically.
+
+    :param df: DataFrame of the detections of the partition (partition columns are dropped)
+    """
+    path = partition_path(store_dir, year, month, state)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = _cast(pa.Table.from_pandas(df.drop(columns=PARTITIONING.names, errors='ignore'), preserve_index=False))
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def partition_path(store_dir, year, month, state):
+    return os.path.join(store_dir, f"ano={int(year)}", f"mes={int(month)}", f"sigla_uf={state}", "part-0.parquet")
+
+
+def csv_to_store(csv_file, store_dir=STORE_DIR, block_size=2**24):
+    """
+    Converts a CSV of detections to the store, streaming it in blocks of `block_size` bytes.
+
+    :param csv_file: CSV with ano, mes and sigla_uf columns
+    :param store_dir: root directory of the store
+    """
+    header = pv.open_csv(csv_file, read_options=pv.ReadOptions(block_size=2**16)).schema.names
+    _check_partition_columns(header)
+    types = {name: type_ for name, type_ in {**COLUMN_TYPES, **dict(zip(PARTITIONING.names, PARTITIONING.types))}.items()
+             if name in header}
+    # dictionary columns are read as strings and encoded per batch
+    read_types = {name: pa.string() if pa.types.is_dictionary(type_) else type_ for name, type_ in types.items()}
+    reader = pv.open_csv(csv_file, read_options=pv.ReadOptions(block_size=block_size),
+                         convert_options=pv.ConvertOptions(column_types=read_types))
+    schema = _cast(reader.schema.empty_table()).schema
+    batches = (batch for block in reader for batch in _cast(pa.Table.from_batches([block])).to_batches())
+    ds.write_dataset(pa.RecordBatchReader.from_batches(schema, batches), store_dir, format='parquet',
+                     partitioning=ds.partitioning(PARTITIONING, flavor='hive'),
+                     existing_data_behavior='delete_matching')
+    log.info(f"{csv_file} converted to the store at {store_dir}")
+
+
+def store_files(store_dir=STORE_DIR):
+    """Sorted Parquet files of the store (empty if there is no store)."""
+    return sorted(glob.glob(os.path.join(store_dir, "**", "*.parquet"), recursive=True))
+
+
+def _partition_key(path):
+    values = dict(part.split("=", 1) for part in os.path.dirname(path).split(os.sep) if "=" in part)
+    return int(values.get('ano', 0)), int(values.get('mes', 0)), values.get('sigla_uf', ''), path
+
+
+def dataset(store_dir=STORE_DIR):
+    """The store as a pyarrow dataset, with its files in chronological order."""
+    files = sorted(store_files(store_dir), key=_partition_key)
+    return ds.dataset(files, format='parquet', partitioning=ds.partitioning(PARTITIONING, flavor='hive'),
+                      partition_base_dir=store_dir)
+
+
+def selection_filter(schema, years=None, months=None, states=None, satellites=None, bbox=None):
+    """
+    Dataset filter expression of a selection; None or empty selects everything.
+
+    :param schema: schema of the dataset (filters on columns it does not have are skipped)
+    :param bbox: (min longitude, min latitude, max longitude, max latitude)
+    """
+    conditions = []
+    for column, values, type_ in [('ano', years, pa.int16()), ('mes', months, pa.int8()),
+                                  ('sigla_uf', states, pa.string()), ('satelite', satellites, pa.string())]:
+        if not values:
+            continue
+        if column not in schema.names:
+            log.warning(f"the store has no column {column}: ignoring its selection")
+            continue
+        conditions.append(ds.field(column).isin(pa.array(list(values)).cast(type_)))
+    if bbox:
+        min_long, min_lat, max_long, max_lat = bbox
+        conditions += [ds.field('Longitude') >= min_long, ds.field('Longitude') <= max_long,
+                       ds.field('Latitude') >= min_lat, ds.field('Latitude') <= max_lat]
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_store(store_dir=STORE_DIR, columns=None, **selection):
+    """
+    Reads a selection of the store as a DataFrame.
+
+    :param store_dir: root directory of the store
+    :param columns: columns to read (None reads all); missing columns are skipped
+    :param selection: years, months, states, satellites and bbox, as in selection_filter
+    :return: DataFrame with the store types (satellite as category)
+    """
+    data = dataset(store_dir)
+    if columns is not None:
+        columns = [column for column in columns if column in data.schema.names]
+    table = data.to_table(columns=columns, filter=selection_filter(data.schema, **selection))
+    return table.to_pandas()
+
+
+def selection_from_config(config, section="data"):
+    """Selection of the store given by the year, month, state, satellites and bbox options of a config."""
+    def values(option, type_=str):
+        raw = config.get(section, option, fallback='').strip()
+        return [type_(value.strip()) for value in raw.split(",") if value.strip()] if raw else None
+
+    bbox = values("bbox", float)
+    if bbox is not None and len(bbox) != 4:
+        raise ValueError("bbox must be min_longitude,min_latitude,max_longitude,max_latitude")
+    return {'years': values("year", int), 'months': values("month", int), 'states': values("state"),
+            'satellites': values("satellites"), 'bbox': bbox}
@@ -5,140 +5,181 @@ import os
 import networkx as nx
 import numpy as np
 import pandas as pd
-from haversine import haversine, Unit, haversine_vector
-from statistics import mean
-import pickle
 
 from tqdm import tqdm
 
+from graph_io import load_graph, save_graph
+from spatial import neighbor_pairs
+from union_find import connected_labels
+
+import instrument
+from stage_cache import StageCache
+from hotspot_store import read_store, selection_from_config, store_files
+
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
+CSV_FILE = "../../data/queimadas.csv"
+# store of the downloaded detections, or another one under data/ (e.g. synthetic_hotspots)
+STORE_DIR = os.path.join("../../data", config.get("data", "store", fallback="hotspots"))
+MERGED_GRAPH_FILE = "../../data/graph_merged.npz"
+GRAPH_FILE = "../../data/graph_1_10.npz"
 
 '''
 Subtask:
 Define a method to add edges between nodes based on a distance metric or other criteria.
 
-Reasoning: Define a function to calculate geographical distance between two nodes and then iterate through all node pairs to add edges based on a distance threshold. I will use the haversine library for distance calculation.
+Reasoning: Define a function to calculate geographical distance between two nodes and then add edges based on a distance threshold. Candidate pairs come from a spatial index (see spatial.py) instead of checking every node pair; distances still use the haversine formula.
 '''
 def add_edges_by_distance(graph, distance_threshold=10): # Distance in kilometers
     """Adds edges to a graph based on geographical distance between nodes."""
     nodes = list(graph.nodes(data=True))
-    for i in tqdm(range(len(nodes)), desc="Add edges", total=len(nodes), unit="nodes"):
-        for j in range(i + 1, len(nodes)):
-            node1_index, node1_data = nodes[i]
-            node2_index, node2_data = nodes[j]
-
-            lat1 = node1_data['Latitude']
-            lon1 = node1_data['Longitude']
-            lat2 = node2_data['Latitude']
-            lon2 = node2_data['Longitude']
-
-            distance = haversine((lat1, lon1), (lat2, lon2), unit=Unit.KILOMETERS)
-
-            if distance < distance_threshold:
-                graph.add_edge(node1_index, node2_index, weight=distance)
+    lats = np.fromiter((data['Latitude'] for _, data in nodes), dtype=np.float64, count=len(nodes))
+    longs = np.fromiter((data['Longitude'] for _, data in nodes), dtype=np.float64, count=len(nodes))
+    i, j, distances = neighbor_pairs(lats, longs, distance_threshold)
+    keys = [node_index for node_index, _ in nodes]
+    graph.add_edges_from(
+        (keys[u], keys[v], {'weight': d})
+        for u, v, d in tqdm(zip(i.tolist(), j.tolist(), distances.tolist()), desc="Add edges", total=len(i), unit="edges"))
 
 def merge_close_nodes(graph, distance_threshold=1):
-    """Merges close nodes in a graph based on geographical distance."""
-    nodes_to_merge = set()
-    merged_nodes = {}
-
+    """
+    Merges close nodes in a graph based on geographical distance.
+
+    Nodes closer than `distance_threshold` km are joined transitively (single linkage) with a
+    union-find over the spatial neighbour pairs. Each cluster keeps the key of its first node
+    and gets the mean Latitude/Longitude and the summed FRP of its members; its other attributes
+    (ano, mes, satelite, data_hora) are those of its earliest detection by data_hora, or of its
+    first node without dates. Single nodes keep their attributes. Edges are carried over between
+    clusters.
+    """
     nodes = list(graph.nodes(data=True))
-    for i in range(len(nodes)):
-        for j in range(i + 1, len(nodes)):
-            node1_index, node1_data = nodes[i]
-            node2_index, node2_data = nodes[j]
-
-            lat1 = node1_data['Latitude']
-            lon1 = node1_data['Longitude']
-            lat2 = node2_data['Latitude']
-            lon2 = node2_data['Longitude']
-
-            distance = haversine((lat1, lon1), (lat2, lon2), unit=Unit.KILOMETERS)
-
-            if distance < distance_threshold:
-                # find if indexes are already in some list
-                for key, values in merged_nodes.items():
-                    if node1_index in values and node2_index not in values:
-                        merged_nodes[key].append(node2_index)
-                        nodes_to_merge.add(node2_index)
-                        break;
-                    if node1_index not in values and node2_index in values:
-                        merged_nodes[key].append(node1_index)
-                        nodes_to_merge.add(node1_index)
-                        break;
-                else:
-                # Merge node2 into node1
-                    merged_nodes[node1_index] = [node1_index]
-                    merged_nodes[node1_index].append(node2_index)
-                    nodes_to_merge.add(node2_index)
+    keys = [node_index for node_index, _ in nodes]
+    lats = np.fromiter((data['Latitude'] for _, data in nodes), dtype=np.float64, count=len(nodes))
+    longs = np.fromiter((data['Longitude'] for _, data in nodes), dtype=np.float64, count=len(nodes))
+    frp = np.fromiter((data['FRP'] for _, data in nodes), dtype=np.float64, count=len(nodes))
+
+    i, j, _ = neighbor_pairs(lats, longs, distance_threshold)
+    labels = connected_labels(len(nodes), i, j)
+
+    # grouped reductions per cluster; clusters are numbered by their first node
+    counts = np.bincount(labels)
+    cluster_lats = np.bincount(labels, weights=lats) / counts
+    cluster_longs = np.bincount(labels, weights=longs) / counts
+    cluster_frp = np.bincount(labels, weights=frp)
+    first = np.unique(labels, return_index=True)[1]
+    # member whose other attributes the cluster keeps: the earliest one, NaT last
+    times = pd.to_datetime([data.get('data_hora') for _, data in nodes]).to_numpy()
+    order = np.lexsort((times, np.isnat(times), labels))
+    earliest = order[np.unique(labels[order], return_index=True)[1]]
+    log.info(f"merged {len(nodes)} nodes into {len(counts)} ({np.count_nonzero(counts > 1)} clusters with more than one node)")
 
     # Create a new graph with merged nodes
     H = nx.Graph()
-    for node_index, node_data in tqdm(graph.nodes(data=True), desc="Merge step 2", total=len(graph.nodes), unit="nodes"):
-        if node_index not in nodes_to_merge:
-          if node_index in merged_nodes:
-            lats = []
-            longs = []
-            frp = []
-            for original_node in merged_nodes[node_index]:
-                lats.append(graph.nodes[original_node]['Latitude'])
-                longs.append(graph.nodes[original_node]['Longitude'])
-                frp.append(graph.nodes[original_node]['FRP'])
-            #log.info(f"merged {len(frp)} into one node; lats = {lats} mean={mean(lats)}")
-            H.add_node(node_index, Latitude=mean(lats), Longitude=mean(longs), FRP=sum(frp))
-          else:
-            H.add_node(node_index, **node_data)
+    H.add_nodes_from(
+        (keys[index], nodes[index][1]) if count == 1 else
+        (keys[index], {**nodes[member][1], 'Latitude': lat, 'Longitude': long, 'FRP': f})
+        for index, member, count, lat, long, f in zip(first.tolist(), earliest.tolist(), counts.tolist(),
+                                                       cluster_lats.tolist(), cluster_longs.tolist(),
+                                                       cluster_frp.tolist()))
 
     # Add edges to the new graph
-    for edge in tqdm(graph.edges(data=True), desc="Merge step 3", total=len(graph.edges), unit="edges"):
-        u, v, data = edge
-        if u not in nodes_to_merge and v not in nodes_to_merge:
-            H.add_edge(u, v, **data)
-        elif u in merged_nodes and v not in nodes_to_merge:
-            for original_node in merged_nodes[u]:
-                if graph.has_edge(original_node, v):
-                     H.add_edge(u, v, **graph.get_edge_data(original_node, v))
-        elif v in merged_nodes and u not in nodes_to_merge:
-             for original_node in merged_nodes[v]:
-                if graph.has_edge(u, original_node):
-                     H.add_edge(u, v, **graph.get_edge_data(u, original_node))
-        elif u in merged_nodes and v in merged_nodes and u != v:
-             for original_node_u in merged_nodes[u]:
-                 for original_node_v in merged_nodes[v]:
-                     if graph.has_edge(original_node_u, original_node_v):
-                         H.add_edge(u, v, **graph.get_edge_data(original_node_u, original_node_v))
+    position = {key: index for index, key in enumerate(keys)}
+    H.add_edges_from(
+        (keys[first[labels[position[u]]]], keys[first[labels[position[v]]]], data)
+        for u, v, data in graph.edges(data=True)
+        if labels[position[u]] != labels[position[v]])
 
     return H
 
 
-if __name__ == "__main__":
-    csv_file = '../../data/queimadas.csv'
+NODE_COLUMNS = {'Latitude': 'float32', 'Longitude': 'float32', 'FRP': 'float32'}
+OPTIONAL_COLUMNS = {'ano': 'int16', 'mes': 'int8', 'satelite': 'category', 'data_hora': 'datetime64[ns]'}
+
+
+def read_hotspots(csv_file):
+    """
+    Reads only the columns needed to build the graph, with compact dtypes.
+
+    Latitude, Longitude and FRP are required; date and satellite columns are read when present.
+    """
+    header = pd.read_csv(csv_file, nrows=0).columns
+    optional = [column for column in OPTIONAL_COLUMNS if column in header]
+    dtypes = {**NODE_COLUMNS, **{column: OPTIONAL_COLUMNS[column] for column in optional if column != 'data_hora'}}
+    return pd.read_csv(csv_file, usecols=[*NODE_COLUMNS, *optional], dtype=dtypes,
+                       parse_dates=['data_hora'] if 'data_hora' in optional else False)
+
+
+def load_hotspots():
+    """
+    Reads the hotspots selected in config.ini from the Parquet store, or from CSV_FILE if there is no store.
 
-    df = pd.read_csv(csv_file)
+    Only the graph columns of the selected partitions, satellites and bounding box are read.
+    """
+    if not store_files(STORE_DIR):
+        log.info(f"no hotspot store at {STORE_DIR}, reading {CSV_FILE}")
+        return read_hotspots(CSV_FILE)
+    return read_store(STORE_DIR, columns=[*NODE_COLUMNS, *OPTIONAL_COLUMNS], **selection_from_config(config))
+
+
+def graph_from_dataframe(df):
+    """Creates a graph with one node per row, keyed by the row index, using the columns as node attributes."""
     G = nx.Graph()
+    columns = {column: df[column].tolist() for column in df.columns}
+    G.add_nodes_from(zip(df.index.tolist(), (dict(zip(columns, values)) for values in zip(*columns.values()))))
+    return G
+
+
+def merge_stage():
+    with instrument.stage("read_hotspots"):
+        df = load_hotspots()
+    instrument.record(rows=len(df))
+    log.info(f"read {len(df)} hotspots ({df.memory_usage(deep=True).sum() / 2**20:.1f} MiB)")
 
     '''
     Subtask:
     Add nodes to the graph using the 'Latitude' and 'Longitude' columns from the df DataFrame.
     
-    Reasoning: Iterate through the dataframe and add nodes with latitude and longitude attributes to the graph.
+    Reasoning: Build the nodes in bulk from the column arrays, with latitude, longitude and FRP attributes.
     '''
-    for index, row in df.iterrows():
-        G.add_node(index, Latitude=row['Latitude'], Longitude=row['Longitude'], FRP=row["FRP"])
+    G = graph_from_dataframe(df)
+    del df
 
     merge_distance = config.getint("generate", "merge_distance", fallback=1)
-    G = merge_close_nodes(G, merge_distance)  # 1km default
+    with instrument.stage("merge_close_nodes", nodes=G.number_of_nodes()):
+        G = merge_close_nodes(G, merge_distance)  # 1km default
     log.info(f"merge distance = {merge_distance}")
+    save_graph(G, MERGED_GRAPH_FILE)
+
+
+def edges_stage():
+    merged = load_graph(MERGED_GRAPH_FILE)
+    instrument.record(nodes=merged.n, edges=merged.m)
+    G = merged.to_networkx()
     add_edges_distance = config.getint("generate", "add_edges_distance", fallback=10)
     log.info(f"add edges distance = {add_edges_distance}")
-    add_edges_by_distance(G, add_edges_distance)  # 10 km default
+    with instrument.stage("add_edges_by_distance", nodes=G.number_of_nodes()):
+        add_edges_by_distance(G, add_edges_distance)  # 10 km default
 
     log.info(f"edges = {G.number_of_edges()}")
     log.info(f"nodes = {G.number_of_nodes()}")
     log.info(f"components = {nx.number_connected_components(G)}")
-    with open("../../data/graph_1_10.gpickle", 'wb') as f:
-        pickle.dump(G, f, pickle.HIGHEST_PROTOCOL)
\ No newline at end of file
+    save_graph(G, GRAPH_FILE)
+
+
+def main():
+    # each stage is skipped when its inputs and options match a cached result
+    cache = StageCache.from_config(config)
+    hotspot_files = store_files(STORE_DIR) or [CSV_FILE]
+    sources = StageCache.sources(__file__, "graph_io.py", "spatial.py", "union_find.py", "../data/hotspot_store.py")
+    cache.run("merge", [MERGED_GRAPH_FILE], merge_stage, inputs=[*sources, *hotspot_files],
+              options={"merge_distance": config.get("generate", "merge_distance", fallback="1"),
+                       "selection": selection_from_config(config) if hotspot_files != [CSV_FILE] else None})
+    cache.run("graph_1_10", [GRAPH_FILE], edges_stage, inputs=[*sources, MERGED_GRAPH_FILE],
+              options={"add_edges_distance": config.get("generate", "add_edges_distance", fallback="10")})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+'''
+Compact on-disk graph format.
+
+A graph is stored as an uncompressed .npz archive with one array per column:
+  node_id           integer key of every node, in node order
+  node_<attribute>  one array per node attribute (Latitude, Longitude, FRP, ...)
+  indptr, indices   symmetric CSR adjacency over node positions (both directions of every edge)
+  weight            edge weight aligned with `indices`
+  extra_<name>      optional arrays saved alongside the graph (e.g. index mappings)
+
+Because the archive is not compressed, every array can be memory mapped straight from the
+file. networkx graphs are only built on demand with CSRGraph.to_networkx().
+'''
+import logging
+import os
+import zipfile
+
+import networkx as nx
+import numpy as np
+
+log = logging.getLogger(os.path.basename(__file__))
+
+NODE_PREFIX = 'node_'
+EXTRA_PREFIX = 'extra_'
+
+
+class CSRGraph:
+    """Undirected graph with columnar node attributes and a symmetric CSR edge list."""
+
+    def __init__(self, ids, nodes, indptr, indices, weight, extra=None):
+        self.ids = ids
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.weight = weight
+        self.extra = extra or {}
+        self._nx = None
+
+    @property
+    def n(self):
+        return len(self.ids)
+
+    @property
+    def m(self):
+        return len(self.indices) // 2
+
+    def __getstate__(self):
+        # the networkx view is rebuilt on demand instead of being sent to other processes
+        return {**self.__dict__, '_nx': None}
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def edges(self):
+        """(u, v, weight) arrays over node positions, each undirected edge once with u < v."""
+        rows = np.repeat(np.arange(self.n), self.degree())
+        upper = rows < self.indices
+        return rows[upper], np.asarray(self.indices)[upper], np.asarray(self.weight)[upper]
+
+    def position(self):
+        """Mapping from node id to node position."""
+        return {node: i for i, node in enumerate(self.ids.tolist())}
+
+    def to_networkx(self):
+        """networkx view of the graph, keyed by node id; built once and cached."""
+        if self._nx is None:
+            G = nx.Graph()
+            ids = self.ids.tolist()
+            columns = {name: _values(values) for name, values in self.nodes.items()}
+            G.add_nodes_from(zip(ids, (dict(zip(columns, values)) for values in zip(*columns.values()))))
+            u, v, w = self.edges()
+            G.add_edges_from((ids[a], ids[b], {'weight': c}) for a, b, c in zip(u.tolist(), v.tolist(), w.tolist()))
+            self._nx = G
+        return self._nx
+
+    @classmethod
+    def from_edges(cls, ids, nodes, u, v, weight, extra=None):
+        """Builds the CSR arrays from an undirected edge list over node positions."""
+        n = len(ids)
+        rows = np.concatenate((u, v)).astype(np.int64)
+        cols = np.concatenate((v, u)).astype(np.int64)
+        weights = np.concatenate((weight, weight)).astype(np.float64)
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        indices = cols[order].astype(np.int32 if n < 2**31 else np.int64)
+        return cls(np.asarray(ids, dtype=np.int64), nodes, indptr, indices, weights[order], extra)
+
+    @classmethod
+    def from_networkx(cls, G, extra=None):
+        ids = list(G.nodes())
+        position = {node: i for i, node in enumerate(ids)}
+        data = [d for _, d in G.nodes(data=True)]
+        names = list(dict.fromkeys(name for d in data for name in d))
+        nodes = {name: _column([d.get(name) for d in data]) for name in names}
+        u = np.fromiter((position[a] for a, _ in G.edges()), dtype=np.int64, count=G.number_of_edges())
+        v = np.fromiter((position[b] for _, b in G.edges()), dtype=np.int64, count=G.number_of_edges())
+        w = np.fromiter((d.get('weight', 1.0) for _, _, d in G.edges(data=True)), dtype=np.float64,
+                        count=G.number_of_edges())
+        graph = cls.from_edges(ids, nodes, u, v, w, extra)
+        graph._nx = G
+        return graph
+
+
+def _values(column):
+    """Python values of a node attribute array; datetimes become datetime.datetime."""
+    if column.dtype.kind == 'M':
+        return column.astype('datetime64[us]').tolist()
+    return column.tolist()
+
+
+def _column(values):
+    """Array for one node attribute; nodes without the attribute get NaN, NaT or ''."""
+    present = [value for value in values if value is not None]
+    sample = np.asarray(present)
+    if sample.dtype == object:
+        # timestamps (e.g. pandas.Timestamp) are stored as datetime64
+        sample = sample.astype('datetime64[ns]')
+    if len(present) == len(values):
+        return sample
+    if sample.dtype.kind in 'biuf':
+        return np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+    if sample.dtype.kind == 'M':
+        return np.asarray([np.datetime64('NaT') if value is None else np.datetime64(value) for value in values],
+                          dtype='datetime64[ns]')
+    return np.asarray(['' if value is None else value for value in values])
+
+
+def save_graph(graph, path, **extra):
+    """
+    Saves a CSRGraph or a networkx graph in the columnar .npz format.
+
+    :param graph: CSRGraph or nx.Graph with integer node keys
+    :param path: output .npz file
+    :param extra: additional arrays stored with the graph
+    """
+    if isinstance(graph, nx.Graph):
+        graph = CSRGraph.from_networkx(graph)
+    arrays = {'node_id': graph.ids, 'indptr': graph.indptr, 'indices': graph.indices, 'weight': graph.weight}
+    arrays.update({NODE_PREFIX + name: values for name, values in graph.nodes.items()})
+    arrays.update({EXTRA_PREFIX + name: values for name, values in {**graph.extra, **extra}.items()})
+    # same layout as np.savez, with fixed timestamps so equal graphs give byte-identical files
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, values in arrays.items():
+            with archive.open(zipfile.ZipInfo(name + '.npy', date_time=(1980, 1, 1, 0, 0, 0)), 'w',
+                              force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(values), allow_pickle=False)
+    log.info(f"saved graph with {graph.n} nodes and {graph.m} edges to {path}")
+
+
+def load_graph(path, mmap=True):
+    """
+    Loads a graph saved with save_graph.
+
+    :param path: .npz file
+    :param mmap: memory map the arrays instead of reading them into memory
+    :return: CSRGraph
+    """
+    arrays = _mmap_npz(path) if mmap else dict(np.load(path))
+    nodes = {name[len(NODE_PREFIX):]: values for name, values in arrays.items()
+             if name.startswith(NODE_PREFIX) and name != 'node_id'}
+    extra = {name[len(EXTRA_PREFIX):]: values for name, values in arrays.items() if name.startswith(EXTRA_PREFIX)}
+    graph = CSRGraph(arrays['node_id'], nodes, arrays['indptr'], arrays['indices'], arrays['weight'], extra)
+    log.info(f"loaded graph with {graph.n} nodes and {graph.m} edges from {path}")
+    return graph
+
+
+def _mmap_npz(path):
+    """Memory maps every array of an uncompressed .npz archive."""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # local file header: 30 fixed bytes, then the file name and the extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if dtype.hasobject or 0 in shape:
+                f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
@@ -0,0 +1,120 @@
+'''
+Subtask:
+Build a pyramid of coarser and coarser graphs of the hotspots from a list of radii.
+
+Reasoning: Level 0 has one node per hotspot and edges between hotspots closer than the first
+radius. Every next level has one node per connected component of the level below (mean
+Latitude/Longitude, summed FRP) and edges closer than its own radius. With radii 1, 10, 50
+level 1 is graph_1_10 and level 2 is graph_50. Each level is built from the previous one only:
+its neighbour pairs are searched once and serve both as its edges and as the input of the
+component labelling that defines the next level, so no level is traversed twice.
+
+Each level k > 0 stores `extra_child_ptr`/`extra_child` (positions of its members in level
+k - 1, CSR style) and each level k < top stores `extra_parent` (position of its node in level
+k + 1). Composing the parent arrays maps every hotspot to its node at any level in O(n), so a
+result computed on a coarse level (SIR, communities, criticality) can be projected back to the
+hotspots, and hotspot values can be summed up to any level.
+'''
+import configparser
+import logging
+import os
+
+import numpy as np
+
+from gen_graph import CSV_FILE, NODE_COLUMNS, STORE_DIR, load_hotspots, selection_from_config, store_files
+from graph_io import CSRGraph, load_graph, save_graph
+from increase_radius import component_labels, create_subgraph_from_edges
+from spatial import neighbor_pairs
+
+import instrument
+from stage_cache import StageCache
+
+config_file = os.environ['CONFIG']
+config = configparser.ConfigParser()
+config.read(config_file)
+logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+log = logging.getLogger(os.path.basename(__file__))
+
+
+def with_edges(graph, radius):
+    """The nodes of `graph` with edges between the ones closer than `radius` km."""
+    i, j, distances = neighbor_pairs(graph.nodes['Latitude'], graph.nodes['Longitude'], radius)
+    return CSRGraph.from_edges(graph.ids, graph.nodes, i, j, distances, extra=graph.extra)
+
+
+def build_hierarchy(graph, radii):
+    """
+    Coarsening levels of a graph of hotspots.
+
+    :param graph: CSRGraph of the hotspots with Latitude, Longitude and FRP node attributes (edges are ignored)
+    :param radii: edge distance in km of every level, from the finest to the coarsest
+    :return: list of CSRGraph, one per radius
+    """
+    with instrument.stage("level_0", nodes=graph.n):
+        levels = [with_edges(graph, radii[0])]
+    for k, radius in enumerate(radii[1:], start=1):
+        below = levels[-1]
+        with instrument.stage(f"level_{k}", nodes=below.n, edges=below.m):
+            labels = component_labels(below)
+            coarse = create_subgraph_from_edges(below, labels)
+            below.extra['parent'] = labels
+            coarse.extra = {'child_ptr': coarse.extra['member_ptr'], 'child': np.argsort(labels, kind='stable')}
+            levels.append(with_edges(coarse, radius))
+    for k, (radius, level) in enumerate(zip(radii, levels)):
+        log.info(f"level {k} ({radius:g} km): nodes = {level.n}, edges = {level.m}")
+    return levels
+
+
+class Hierarchy:
+    """Levels saved by build_hierarchy, with the mappings between them."""
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def load(cls, paths, mmap=True):
+        return cls([load_graph(path, mmap=mmap) for path in paths])
+
+    def base_index(self, level):
+        """Position at `level` of every level-0 node."""
+        index = np.arange(self.levels[0].n)
+        for k in range(level):
+            index = np.asarray(self.levels[k].extra['parent'])[index]
+        return index
+
+    def project(self, values, level):
+        """Values of the nodes of `level`, repeated for every level-0 node (hotspot) they contain."""
+        return np.asarray(values)[self.base_index(level)]
+
+    def aggregate(self, values, level):
+        """Sums of level-0 values over the nodes of `level`."""
+        return np.bincount(self.base_index(level), weights=values, minlength=self.levels[level].n)
+
+    def children(self, level, node):
+        """Positions in level - 1 of the members of a node of `level`."""
+        ptr = self.levels[level].extra['child_ptr']
+        return np.asarray(self.levels[level].extra['child'][ptr[node]:ptr[node + 1]])
+
+
+def level_file(k):
+    return f"../../data/graph_level_{k}.npz"
+
+
+def hierarchy_stage(radii):
+    df = load_hotspots()
+    instrument.record(rows=len(df))
+    hotspots = CSRGraph(df.index.to_numpy(dtype=np.int64), {column: df[column].to_numpy() for column in NODE_COLUMNS},
+                        np.zeros(len(df) + 1, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0))
+    for k, level in enumerate(build_hierarchy(hotspots, radii)):
+        save_graph(level, level_file(k))
+
+
+if __name__ == "__main__":
+    radii = [float(r) for r in config.get("hierarchy", "radii", fallback="1,10,50").split(",")]
+    hotspot_files = store_files(STORE_DIR) or [CSV_FILE]
+    StageCache.from_config(config).run(
+        "hierarchy", [level_file(k) for k in range(len(radii))], lambda: hierarchy_stage(radii),
+        inputs=[*StageCache.sources(__file__, "gen_graph.py", "increase_radius.py", "graph_io.py", "spatial.py",
+                                    "union_find.py", "../data/hotspot_store.py"), *hotspot_files],
+        options={"radii": radii,
+                 "selection": selection_from_config(config) if hotspot_files != [CSV_FILE] else None})
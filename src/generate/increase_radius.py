@@ -2,10 +2,15 @@ import configparser
 import logging
 import os
 
-import pickle
-from statistics import mean
-import networkx as nx
-from gen_graph import add_edges_by_distance
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from graph_io import CSRGraph, load_graph, save_graph
+from spatial import neighbor_pairs
+
+import instrument
+from stage_cache import StageCache
 
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
@@ -13,40 +18,69 @@ config.read(config_file)
 
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
+INPUT_GRAPH_FILE = "../../data/graph_1_10.npz"
+GRAPH_FILE = "../../data/graph_50.npz"
+
+def component_labels(graph):
+    """Connected component of every node of a CSRGraph, numbered by their smallest node position."""
+    adjacency = sparse.csr_matrix((np.ones(len(graph.indices)), np.asarray(graph.indices), np.asarray(graph.indptr)),
+                                  shape=(graph.n, graph.n))
+    return csgraph.connected_components(adjacency, directed=False)[1]
+
+
+def create_subgraph_from_edges(graph, labels=None):
+    """
+    Coarse graph with one node per connected component of `graph`.
+
+    Components are labelled once on the CSR adjacency and their attributes come from grouped
+    reductions over the labels: each coarse node gets the mean Latitude/Longitude and the
+    summed FRP of its members. Coarse nodes are keyed 0..components-1 in order of their first
+    member, and have no edges.
+
+    :param graph: CSRGraph with Latitude, Longitude and FRP node attributes
+    :param labels: component_labels(graph), if already computed
+    :return: CSRGraph whose `extra` maps coarse nodes to their members: the members of node c
+             are member_id[member_ptr[c]:member_ptr[c + 1]] (node ids of `graph`)
+    """
+    labels = component_labels(graph) if labels is None else labels
+    counts = np.bincount(labels, minlength=labels.max() + 1 if len(labels) else 0)
+    log.info(f"largest cc = {counts.max() if len(counts) else 0}")
+    nodes = {
+        'Latitude': np.bincount(labels, weights=graph.nodes['Latitude']) / counts,
+        'Longitude': np.bincount(labels, weights=graph.nodes['Longitude']) / counts,
+        'FRP': np.bincount(labels, weights=graph.nodes['FRP']),
+    }
+    member_ptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=member_ptr[1:])
+    member_id = np.asarray(graph.ids)[np.argsort(labels, kind='stable')]
+    empty = np.empty(0, dtype=np.int64)
+    return CSRGraph.from_edges(np.arange(len(counts)), nodes, empty, empty, np.empty(0),
+                               extra={'member_ptr': member_ptr, 'member_id': member_id})
+
+def expand_stage():
+    graph = load_graph(INPUT_GRAPH_FILE)
+    instrument.record(nodes=graph.n, edges=graph.m)
+    with instrument.stage("coarsen", nodes=graph.n, edges=graph.m):
+        G = create_subgraph_from_edges(graph)
 
-def create_subgraph_from_edges(G):
+    add_edges_distance = config.getint("generate", "add_edges_distance2", fallback=50)
+    log.info(f"add edges distance = {add_edges_distance}")
+    with instrument.stage("neighbor_pairs", nodes=G.n):
+        i, j, distances = neighbor_pairs(G.nodes['Latitude'], G.nodes['Longitude'], add_edges_distance)  # 10 km default
+    G1 = CSRGraph.from_edges(G.ids, G.nodes, i, j, distances, extra=G.extra)
 
-#If you only want the largest connected component, it’s more efficient to use max instead of sort.
+    log.info(f"edges = {G1.m}")
+    log.info(f"nodes = {G1.n}")
+    log.info(f"components = {component_labels(G1).max() + 1 if G1.n else 0}")
+    save_graph(G1, GRAPH_FILE)
 
-  largest_cc = max(nx.connected_components(G), key=len)
-  log.info(f"largest cc = {len(largest_cc)}")
-  #To create the induced subgraph of each component, use:
-  S = [G.subgraph(c).copy() for c in nx.connected_components(G)]
 
-  H = nx.Graph()
-  for sg in S:
-    lats = []
-    longs = []
-    frp = []
-    for node_index, node_data in sg.nodes(data=True):
-        lats.append(node_data['Latitude'])
-        longs.append(node_data['Longitude'])
-        frp.append(node_data['FRP'])
-    H.add_node(sg, Latitude=mean(lats), Longitude=mean(longs), FRP=sum(frp))
+def main():
+    StageCache.from_config(config).run(
+        "graph_50", [GRAPH_FILE], expand_stage,
+        inputs=[*StageCache.sources(__file__, "graph_io.py", "spatial.py"), INPUT_GRAPH_FILE],
+        options={"add_edges_distance2": config.get("generate", "add_edges_distance2", fallback="50")})
 
-  return H
 
 if __name__ == "__main__":
-    with open("../../data/graph_1_10.gpickle", 'rb') as f:
-        G = pickle.load(f)
-        G1 = create_subgraph_from_edges(G)
-
-        add_edges_distance = config.getint("generate", "add_edges_distance2", fallback=50)
-        log.info(f"add edges distance = {add_edges_distance}")
-        add_edges_by_distance(G1, add_edges_distance)  # 10 km default
-
-        log.info(f"edges = {G1.number_of_edges()}")
-        log.info(f"nodes = {G1.number_of_nodes()}")
-        log.info(f"components = {nx.number_connected_components(G1)}")
-        with open("../../data/graph_50.gpickle", 'wb') as f2:
-            pickle.dump(G1, f2, pickle.HIGHEST_PROTOCOL)
+    main()
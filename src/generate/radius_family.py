@@ -0,0 +1,98 @@
+'''
+Subtask:
+Build the graphs of several edge distances at once and follow how their components change with the distance.
+
+Reasoning: Neighbour pairs are found once, at the largest radius, with their distances. Every smaller radius is a
+filter over those pairs, and adding the pairs in increasing distance order to a union-find gives the number of
+components and the largest component for every radius in a single sweep (edge percolation).
+'''
+import configparser
+import logging
+import os
+
+import numpy as np
+
+from graph_io import CSRGraph, load_graph, save_graph
+from spatial import neighbor_pairs
+from union_find import UnionFind
+
+import instrument
+from stage_cache import StageCache
+
+config_file = os.environ['CONFIG']
+config = configparser.ConfigParser()
+config.read(config_file)
+logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+log = logging.getLogger(os.path.basename(__file__))
+INPUT_GRAPH_FILE = "../../data/graph_merged.npz"
+PERCOLATION_FILE = "../../data/percolation.npz"
+
+
+def radius_family(graph, radii):
+    """
+    Graphs of the same nodes with edges between nodes closer than each radius.
+
+    :param graph: CSRGraph with Latitude/Longitude node attributes (its edges are ignored)
+    :param radii: distances in kilometers
+    :return: (dict radius -> CSRGraph, (i, j, distance) pairs at the largest radius)
+    """
+    i, j, distances = neighbor_pairs(graph.nodes['Latitude'], graph.nodes['Longitude'], max(radii))
+    log.info(f"{len(i)} neighbour pairs within {max(radii)} km")
+    family = {}
+    for radius in sorted(radii):
+        keep = distances < radius
+        family[radius] = CSRGraph.from_edges(graph.ids, graph.nodes, i[keep], j[keep], distances[keep])
+    return family, (i, j, distances)
+
+
+def percolation_sweep(n, i, j, distances):
+    """
+    Component structure while edges are added in increasing distance order.
+
+    :param n: number of nodes
+    :param i, j, distances: edge list
+    :return: (distance, components, largest) arrays; entry k is the state after adding every edge
+             shorter than or as long as distance[k], one entry per distinct distance
+    """
+    order = np.argsort(distances, kind='stable')
+    uf = UnionFind(n)
+    components = np.empty(len(order), dtype=np.int64)
+    largest = np.empty(len(order), dtype=np.int64)
+    biggest = 1 if n else 0
+    for k, (a, b) in enumerate(zip(i[order].tolist(), j[order].tolist())):
+        biggest = max(biggest, uf.size[uf.union(a, b)])
+        components[k] = uf.components
+        largest[k] = biggest
+    sorted_distances = distances[order]
+    # keep the state after the last edge of each distinct distance
+    last = np.append(sorted_distances[1:] != sorted_distances[:-1], True) if len(order) else np.zeros(0, bool)
+    return sorted_distances[last], components[last], largest[last]
+
+
+def family_stage(radii):
+    graph = load_graph(INPUT_GRAPH_FILE)
+    instrument.record(nodes=graph.n, edges=graph.m)
+    family, (i, j, distances) = radius_family(graph, radii)
+    for radius, g in family.items():
+        log.info(f"radius {radius} km: edges = {g.m}")
+        save_graph(g, family_file(radius))
+
+    with instrument.stage("percolation_sweep", nodes=graph.n, edges=len(i)):
+        distance, components, largest = percolation_sweep(graph.n, i, j, distances)
+    np.savez(PERCOLATION_FILE, distance=distance, components=components, largest=largest, nodes=graph.n)
+    for radius in sorted(radii):
+        k = np.searchsorted(distance, radius, side='left') - 1
+        c, l = (components[k], largest[k]) if k >= 0 else (graph.n, 1)
+        log.info(f"radius {radius} km: components = {c}, largest component = {l} ({l / graph.n:.1%} of nodes)")
+
+
+def family_file(radius):
+    return f"../../data/graph_family_{radius:g}.npz"
+
+
+if __name__ == "__main__":
+    radii = [float(r) for r in config.get("generate", "radii", fallback="5,10,20,50,100").split(",")]
+    StageCache.from_config(config).run(
+        "radius_family", [family_file(r) for r in radii] + [PERCOLATION_FILE], lambda: family_stage(radii),
+        inputs=[*StageCache.sources(__file__, "graph_io.py", "spatial.py", "union_find.py"), INPUT_GRAPH_FILE],
+        options={"radii": radii})
@@ -0,0 +1,71 @@
+import logging
+import os
+
+import numpy as np
+from haversine import Unit, haversine_vector
+from haversine.haversine import get_avg_earth_radius
+from scipy.spatial import cKDTree
+
+log = logging.getLogger(os.path.basename(__file__))
+
+EARTH_RADIUS_KM = get_avg_earth_radius(Unit.KILOMETERS)
+
+
+def to_unit_sphere(lats, longs):
+    """Converts latitude/longitude in degrees to 3D points on the unit sphere."""
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(longs, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_radius(distance_km):
+    """Chord length on the unit sphere equivalent to a great-circle distance in kilometers."""
+    return 2 * np.sin(min(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def neighbor_pairs(lats, longs, distance_threshold, batch_size=1_000_000):
+    """
+    Finds every pair of points closer than `distance_threshold` kilometers.
+
+    Candidate pairs come from a KD-tree on unit-sphere coordinates (chord distance grows
+    monotonically with the great-circle distance), so only nearby points are ever compared.
+    Exact distances are then computed in vectorized batches with the same haversine formula
+    used by `haversine()`, and pairs at or beyond the threshold are dropped.
+
+    :param lats: latitudes in decimal degrees
+    :param longs: longitudes in decimal degrees
+    :param distance_threshold: distance in kilometers; pairs must be strictly closer
+    :param batch_size: number of candidate pairs per haversine batch
+    :return: (i, j, distance) arrays with i < j, sorted by (i, j)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    if len(lats) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    tree = cKDTree(to_unit_sphere(lats, longs))
+    # small slack so rounding in the chord conversion never drops a pair the haversine keeps
+    candidates = tree.query_pairs(chord_radius(distance_threshold) * (1 + 1e-9) + 1e-12, output_type='ndarray')
+    log.debug(f"{len(candidates)} candidate pairs within {distance_threshold} km")
+
+    i_parts, j_parts, d_parts = [], [], []
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        i, j = batch[:, 0], batch[:, 1]
+        distances = haversine_vector(np.column_stack((lats[i], longs[i])), np.column_stack((lats[j], longs[j])),
+                                     Unit.KILOMETERS)
+        keep = distances < distance_threshold
+        i_parts.append(i[keep])
+        j_parts.append(j[keep])
+        d_parts.append(distances[keep])
+
+    if not i_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    i = np.concatenate(i_parts).astype(np.int64)
+    j = np.concatenate(j_parts).astype(np.int64)
+    distances = np.concatenate(d_parts)
+    # query_pairs returns unordered pairs; sort them the way the pair loop visits them
+    lo, hi = np.minimum(i, j), np.maximum(i, j)
+    order = np.lexsort((hi, lo))
+    return lo[order], hi[order], distances[order]
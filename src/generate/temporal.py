@@ -0,0 +1,188 @@
+'''
+Subtask:
+Build a temporal graph whose edges link detections that are close both in space and in time.
+
+Reasoning: Detections are sorted by `data_hora` and split into consecutive time bins as wide as the
+time threshold. Two detections closer in time than the threshold are in the same bin or in
+neighbouring bins, so the spatial index (spatial.py) only ever searches the detections of two
+consecutive bins at once. Each edge points from the earlier to the later detection and becomes
+active at the time of the later one; edges are kept sorted by that time (an edge stream), so the
+graph of any time window is a slice of the stream found with a binary search.
+'''
+import configparser
+import logging
+import os
+
+import numpy as np
+
+from gen_graph import CSV_FILE, STORE_DIR, load_hotspots, selection_from_config, store_files
+from graph_io import CSRGraph, load_graph, save_graph
+from spatial import neighbor_pairs
+
+import instrument
+from stage_cache import StageCache
+
+config_file = os.environ['CONFIG']
+config = configparser.ConfigParser()
+config.read(config_file)
+logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+log = logging.getLogger(os.path.basename(__file__))
+TEMPORAL_GRAPH_FILE = "../../data/graph_temporal.npz"
+
+
+def space_time_pairs(lats, longs, times, distance_threshold, time_threshold):
+    """
+    Finds every pair of detections closer than `distance_threshold` km and `time_threshold` seconds.
+
+    :param lats: latitudes in decimal degrees
+    :param longs: longitudes in decimal degrees
+    :param times: detection times in seconds, sorted in increasing order
+    :param distance_threshold: distance in kilometers; pairs must be strictly closer
+    :param time_threshold: time difference in seconds; pairs must be strictly closer
+    :return: (i, j, distance, lag) arrays with i < j (so times[i] <= times[j]) and lag = times[j] - times[i],
+             sorted by (j, i)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    times = np.asarray(times, dtype=np.int64)
+    if np.any(np.diff(times) < 0):
+        raise ValueError("times must be sorted")
+
+    # bin b holds the detections in [start + b * time_threshold, start + (b + 1) * time_threshold)
+    bins = (times - times[0]) // time_threshold if len(times) else times
+    occupied = np.unique(bins)
+    bounds = np.searchsorted(bins, np.stack((occupied, occupied + 1, occupied + 2)))
+    i_parts, j_parts, d_parts = [], [], []
+    for begin, middle, end in bounds.T.tolist():
+        # pairs inside bin b or between bins b and b + 1; pairs inside b + 1 are found at the next bin
+        i, j, distances = neighbor_pairs(lats[begin:end], longs[begin:end], distance_threshold)
+        keep = (i < middle - begin) & (times[begin + j] - times[begin + i] < time_threshold)
+        i_parts.append(begin + i[keep])
+        j_parts.append(begin + j[keep])
+        d_parts.append(distances[keep])
+
+    if not i_parts:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                np.empty(0, dtype=np.int64))
+    i = np.concatenate(i_parts)
+    j = np.concatenate(j_parts)
+    distances = np.concatenate(d_parts)
+    order = np.lexsort((i, j))
+    i, j, distances = i[order], j[order], distances[order]
+    return i, j, distances, times[j] - times[i]
+
+
+class TemporalGraph:
+    """
+    Detections ordered by time and the stream of space-time edges between them.
+
+    ids, nodes: node keys and columnar attributes, in time order
+    time: detection times in seconds (int64, increasing)
+    source, target: node positions of every edge, source earlier than target, sorted by target
+    distance, lag: length in km and time difference in seconds of every edge
+    """
+
+    def __init__(self, ids, nodes, time, source, target, distance, lag):
+        self.ids = ids
+        self.nodes = nodes
+        self.time = time
+        self.source = source
+        self.target = target
+        self.distance = distance
+        self.lag = lag
+
+    @property
+    def n(self):
+        return len(self.ids)
+
+    @property
+    def m(self):
+        return len(self.source)
+
+    @classmethod
+    def from_dataframe(cls, df, distance_threshold, time_threshold, time_column='data_hora'):
+        """
+        Builds the temporal graph of a DataFrame of detections, one node per row keyed by the row index.
+
+        :param df: DataFrame with Latitude, Longitude and a datetime column
+        :param distance_threshold: distance in kilometers
+        :param time_threshold: time difference in seconds
+        """
+        df = df[df[time_column].notna()].sort_values(time_column, kind='stable')
+        time = df[time_column].to_numpy().astype('datetime64[s]').astype(np.int64)
+        source, target, distance, lag = space_time_pairs(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(), time,
+                                                         distance_threshold, time_threshold)
+        nodes = {column: df[column].to_numpy(dtype=str) if df[column].dtype == 'category' else df[column].to_numpy()
+                 for column in df.columns}
+        return cls(df.index.to_numpy(dtype=np.int64), nodes, time, source, target, distance, lag)
+
+    def window(self, start, end):
+        """
+        Node range and edges of the detections in [start, end).
+
+        :param start, end: times in seconds, or datetime64 values
+        :return: (first node position, last node position + 1, positions in the edge stream)
+        """
+        first, last = np.searchsorted(self.time, [_seconds(start), _seconds(end)])
+        # edges are sorted by target: the ones whose target is in the window are contiguous
+        begin, stop = np.searchsorted(self.target, [first, last])
+        edges = begin + np.flatnonzero(np.asarray(self.source[begin:stop]) >= first)
+        return first, last, edges
+
+    def snapshot(self, start, end):
+        """
+        Graph of the detections in [start, end) and the edges between them, weighted by distance.
+
+        :return: CSRGraph; its `extra` holds the `time` of the nodes and the `lag` of the edges
+        """
+        first, last, edges = self.window(start, end)
+        nodes = {name: values[first:last] for name, values in self.nodes.items()}
+        return CSRGraph.from_edges(self.ids[first:last], nodes, self.source[edges] - first,
+                                   self.target[edges] - first, self.distance[edges],
+                                   extra={'time': self.time[first:last], 'lag': self.lag[edges]})
+
+    def to_csr(self):
+        """Whole graph as an undirected CSRGraph; the directed edge stream is kept in its `extra` arrays."""
+        return CSRGraph.from_edges(self.ids, self.nodes, self.source, self.target, self.distance,
+                                   extra={'time': self.time, 'source': self.source, 'target': self.target,
+                                          'distance': self.distance, 'lag': self.lag})
+
+
+def _seconds(t):
+    if isinstance(t, (np.datetime64, str)):
+        return np.datetime64(t, 's').astype(np.int64)
+    return t
+
+
+def save_temporal_graph(graph, path):
+    save_graph(graph.to_csr(), path)
+
+
+def load_temporal_graph(path, mmap=True):
+    csr = load_graph(path, mmap=mmap)
+    return TemporalGraph(csr.ids, csr.nodes, csr.extra['time'], csr.extra['source'], csr.extra['target'],
+                         csr.extra['distance'], csr.extra['lag'])
+
+
+def temporal_stage(distance_threshold, time_threshold):
+    df = load_hotspots()
+    if 'data_hora' not in df.columns:
+        log.error("the hotspots have no data_hora column: download them again with query = true")
+        exit(1)
+    instrument.record(rows=len(df))
+    graph = TemporalGraph.from_dataframe(df, distance_threshold, time_threshold)
+    log.info(f"{graph.n} detections, {graph.m} space-time edges "
+             f"(< {distance_threshold} km and < {time_threshold / 3600:g} h)")
+    save_temporal_graph(graph, TEMPORAL_GRAPH_FILE)
+
+
+if __name__ == "__main__":
+    distance_threshold = config.getfloat("temporal", "distance", fallback=10)
+    time_threshold = int(config.getfloat("temporal", "window_hours", fallback=24) * 3600)
+    hotspot_files = store_files(STORE_DIR) or [CSV_FILE]
+    StageCache.from_config(config).run(
+        "temporal", [TEMPORAL_GRAPH_FILE], lambda: temporal_stage(distance_threshold, time_threshold),
+        inputs=[*StageCache.sources(__file__, "gen_graph.py", "graph_io.py", "spatial.py", "union_find.py",
+                                    "../data/hotspot_store.py"), *hotspot_files],
+        options={"distance": distance_threshold, "window": time_threshold,
+                 "selection": selection_from_config(config) if hotspot_files != [CSV_FILE] else None})
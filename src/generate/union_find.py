@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class UnionFind:
+    """
+    Disjoint-set forest over the integers 0..n-1 with union by size and path halving.
+
+    The parent and size tables are plain Python lists, which are much faster than
+    NumPy element access inside the union/find loops.
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.components = n
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Joins the sets of a and b and returns the root of the merged set."""
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        self.components -= 1
+        return ra
+
+    def union_pairs(self, i, j):
+        """Joins every pair (i[k], j[k])."""
+        for a, b in zip(np.asarray(i).tolist(), np.asarray(j).tolist()):
+            self.union(a, b)
+
+    def roots(self):
+        """Root of every element as an array."""
+        return np.fromiter((self.find(x) for x in range(len(self.parent))), dtype=np.int64, count=len(self.parent))
+
+    def labels(self):
+        """
+        Compact set label of every element, 0..components-1.
+
+        Sets are numbered by their smallest element, so the labelling does not depend
+        on the order in which pairs were joined.
+        """
+        _, first, labels = np.unique(self.roots(), return_index=True, return_inverse=True)
+        # np.unique numbers sets by root; renumber them by their first element instead
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+        return rank[labels]
+
+
+def connected_labels(n, i, j):
+    """Component labels of the graph with n nodes and edges (i[k], j[k]), see UnionFind.labels."""
+    uf = UnionFind(n)
+    uf.union_pairs(i, j)
+    return uf.labels()
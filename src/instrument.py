@@ -0,0 +1,250 @@
+'''
+Timing and memory instrumentation of the pipeline stages.
+
+Every stage (cached stages of stage_cache.py, renders, metrics, simulations) runs inside
+`stage(name, nodes=..., edges=...)`, which appends one JSON line to data/run_report.jsonl with
+its wall time, CPU time (including finished child processes), peak resident memory and input
+sizes; sizes only known inside the stage are added with `record()`. Records carry the run id
+exported by the top Makefile (RUN_ID), so one `make all` gives one run; `python instrument.py`
+summarises the last run and flags the stages that got slower than in the previous run with
+the same input sizes.
+
+Peak memory is sampled from /proc/self/statm by a background thread while the stage runs
+(ru_maxrss, the peak of the whole process, where /proc is not available). The stage named
+by `profile` in the [instrument] section of config.ini is also run under cProfile, and its
+statistics are written to data/profile_<stage>.prof (readable with pstats, snakeviz or
+flameprof).
+'''
+import configparser
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+log = logging.getLogger(os.path.basename(__file__))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+REPORT_FILE = os.path.join(DATA_DIR, "run_report.jsonl")
+# a stage is reported as a regression when it is this much slower than in the previous run
+REGRESSION_RATIO = 1.2
+
+
+def _rss_bytes():
+    """Current resident memory of the process, or its peak so far if /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cpu_seconds():
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class _PeakSampler(threading.Thread):
+    """Highest resident memory seen every `interval` seconds until stopped."""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _rss_bytes())
+        return self.peak
+
+
+class Instrument:
+
+    def __init__(self, report_file=REPORT_FILE, enabled=True, profile=None, run_id=None):
+        self.report_file = report_file
+        self.enabled = enabled
+        self.profile = profile
+        self.run_id = run_id or os.environ.get("RUN_ID") or datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.script = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+        self._stack = []
+        self._records = []
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(enabled=config.getboolean("instrument", "enabled", fallback=True),
+                   profile=config.get("instrument", "profile", fallback="").strip() or None)
+
+    @contextmanager
+    def stage(self, name, **sizes):
+        """
+        Measures the enclosed block as stage `name`.
+
+        :param name: stage name; nested stages are reported as parent/name
+        :param sizes: input sizes (nodes, edges, rows, frames, ...); more can be added with record()
+        """
+        if not self.enabled:
+            yield _Record(sizes)
+            return
+        self._stack.append(name)
+        full_name = "/".join(self._stack)
+        record = _Record(sizes)
+        self._records.append(record)
+        sampler = _PeakSampler()
+        sampler.start()
+        profiler = cProfile.Profile() if self.profile in (name, full_name) else None
+        start_rss, start_cpu, start_wall = _rss_bytes(), _cpu_seconds(), time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+            wall, cpu = time.perf_counter() - start_wall, _cpu_seconds() - start_cpu
+            peak = sampler.stop()
+            record.seconds = wall
+            self._stack.pop()
+            self._records.pop()
+            entry = {'run': self.run_id, 'script': self.script, 'stage': full_name,
+                     'start': datetime.now().isoformat(timespec='seconds'), 'wall_s': round(wall, 4),
+                     'cpu_s': round(cpu, 4), 'rss_start_mb': round(start_rss / 2**20, 1),
+                     'peak_rss_mb': round(peak / 2**20, 1), 'sizes': record.sizes, **record.fields}
+            if profiler:
+                entry['profile'] = self._dump(profiler, full_name)
+            self._write(entry)
+            log.info(f"{full_name}: {wall:.2f} s wall, {cpu:.2f} s CPU, peak RSS {peak / 2**20:.0f} MiB"
+                     + (f" ({', '.join(f'{k} {v}' for k, v in record.sizes.items())})" if record.sizes else ""))
+
+    def record(self, **sizes):
+        """Adds input sizes to the innermost running stage (ignored outside of a stage)."""
+        if self._records:
+            self._records[-1].record(**sizes)
+
+    def _dump(self, profiler, name):
+        path = os.path.join(DATA_DIR, f"profile_{name.replace('/', '_')}.prof")
+        profiler.dump_stats(path)
+        log.info(f"cProfile statistics of {name} written to {path}")
+        return os.path.basename(path)
+
+    def _write(self, entry):
+        os.makedirs(os.path.dirname(self.report_file), exist_ok=True)
+        # one line per write, so processes of the same run can append to the same file
+        with open(self.report_file, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+
+
+class _Record:
+    """Sizes and extra fields added to a stage record while it runs."""
+
+    def __init__(self, sizes):
+        self.sizes = {name: _plain(value) for name, value in sizes.items()}
+        self.fields = {}
+        # wall time of the stage, once it is over
+        self.seconds = None
+
+    def record(self, **sizes):
+        self.sizes.update({name: _plain(value) for name, value in sizes.items()})
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+def _plain(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+_default = None
+
+
+def default():
+    """Instrument of this process, configured from the [instrument] section of $CONFIG."""
+    global _default
+    if _default is None:
+        config = configparser.ConfigParser()
+        if os.environ.get("CONFIG"):
+            config.read(os.environ["CONFIG"])
+        _default = Instrument.from_config(config)
+    return _default
+
+
+def set_default(instrument_):
+    """Makes `instrument_` the instrument of this process, e.g. to write the records to another file."""
+    global _default
+    _default = instrument_
+
+
+def stage(name, **sizes):
+    """default().stage(name, **sizes): measures the enclosed block as a stage of this run."""
+    return default().stage(name, **sizes)
+
+
+def record(**sizes):
+    """default().record(**sizes): adds input sizes to the innermost running stage."""
+    default().record(**sizes)
+
+
+def read_report(report_file=REPORT_FILE):
+    if not os.path.exists(report_file):
+        return []
+    with open(report_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def regressions(records, run=None, ratio=REGRESSION_RATIO):
+    """
+    Stages of `run` (the last run if None) slower than in the latest earlier run with the same sizes.
+
+    :return: list of (stage, previous wall time, wall time, sizes)
+    """
+    runs = list(dict.fromkeys(record['run'] for record in records))
+    if not runs:
+        return []
+    run = run or runs[-1]
+    if run not in runs:
+        return []
+    earlier = runs[:runs.index(run)]
+    previous = {}
+    for record in records:
+        if record['run'] in earlier and not record.get('cached'):
+            previous[(record['stage'], json.dumps(record['sizes'], sort_keys=True))] = record['wall_s']
+    found = []
+    for record in records:
+        if record['run'] != run or record.get('cached'):
+            continue
+        before = previous.get((record['stage'], json.dumps(record['sizes'], sort_keys=True)))
+        if before and record['wall_s'] > ratio * before and record['wall_s'] - before > 0.1:
+            found.append((record['stage'], before, record['wall_s'], record['sizes']))
+    return found
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    records = read_report()
+    if not records:
+        log.info(f"no stage records in {REPORT_FILE}")
+        sys.exit(0)
+    run = sys.argv[1] if len(sys.argv) > 1 else records[-1]['run']
+    print(f"run {run}")
+    print(f"{'stage':<45} {'wall s':>9} {'cpu s':>9} {'peak MiB':>9}  sizes")
+    for record in records:
+        if record['run'] == run:
+            sizes = ", ".join(f"{k}={v}" for k, v in record['sizes'].items())
+            cached = " (cached)" if record.get('cached') else ""
+            print(f"{record['stage'][:45]:<45} {record['wall_s']:>9.2f} {record['cpu_s']:>9.2f} "
+                  f"{record['peak_rss_mb']:>9.0f}  {sizes}{cached}")
+    slower = regressions(records, run)
+    for name, before, after, sizes in slower:
+        print(f"REGRESSION {name}: {before:.2f} s -> {after:.2f} s ({after / before:.1f}x) at {sizes}")
+    sys.exit(1 if slower else 0)
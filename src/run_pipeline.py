@@ -0,0 +1,206 @@
+'''
+Runs the generate and visualize stages in one process, as a DAG.
+
+`make all` starts one Python process per script, and each one imports networkx, matplotlib
+and EoN and loads graph_50 again. Here every script is imported once and called through its
+main(), which takes what it would otherwise load or compute (see the thin `__main__` block
+of every script):
+  generate   gen_graph (graph_merged, graph_1_10), then increase_radius (graph_50), in order
+  graphs     graph_1_10 and graph_50 loaded once
+  shared     the community partition, the map layers (positions, sizes and edge segments)
+             and the metrics report (degree, clustering, betweenness) of graph_50, each
+             computed once and passed to every stage that uses it
+  visualize  the seven analysis scripts, each one started as soon as the shared results
+             it needs are ready
+With workers > 1 ([pipeline] section of config.ini) the visualize tasks run in a process
+pool; the graphs are sent once to every worker, and the shared results go back through the
+parent to the tasks that need them. Stages keep going through the stage cache, so a second
+run only recomputes what changed, and each task is a stage of the instrument report.
+
+The scripts use paths relative to their directory (../../data), so the generate stages run
+from src/generate and the visualize stages from src/visualize.
+
+    python run_pipeline.py                      # everything
+    python run_pipeline.py community_analysis   # one task and the tasks it needs
+'''
+import argparse
+import configparser
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+GENERATE_DIR = os.path.join(SRC_DIR, "generate")
+VISUALIZE_DIR = os.path.join(SRC_DIR, "visualize")
+# the scripts read $CONFIG when they are imported, relative to their own directory when run by make
+os.environ['CONFIG'] = os.path.abspath(os.environ.get('CONFIG', os.path.join(SRC_DIR, "config.ini")))
+# the records of every task and worker belong to the same run
+os.environ.setdefault('RUN_ID', datetime.now().strftime("%Y%m%dT%H%M%S"))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import gen_graph
+import increase_radius
+from graph_io import load_graph
+
+import animate_community_propagation
+import animate_propagation
+import community_analysis
+import degree_analysis
+import find_critical_nodes
+import plot_graph
+import propagation_analysis
+from communities import cached_communities, options_from_config
+from stage_cache import StageCache
+
+import instrument
+
+config_file = os.environ['CONFIG']
+config = configparser.ConfigParser()
+config.read(config_file)
+logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
+log = logging.getLogger(os.path.basename(__file__))
+
+GRAPH_FILES = {name: f"../../data/{name}.npz" for name in plot_graph.GRAPHS}
+
+
+@contextmanager
+def working_dir(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+class Task:
+    """A visualize stage: function(graphs, *results of `needs`)."""
+
+    def __init__(self, function, needs=()):
+        self.function = function
+        self.needs = tuple(needs)
+
+
+def _communities(graphs):
+    return cached_communities(GRAPH_FILES["graph_50"], StageCache.from_config(config), graph=graphs["graph_50"],
+                              **options_from_config(config))
+
+
+def _layers(graphs):
+    return {name: plot_graph.graph_layers(graph) for name, graph in graphs.items()}
+
+
+GENERATE = {"gen_graph": gen_graph.main, "increase_radius": increase_radius.main}
+
+TASKS = {
+    # results shared by several stages
+    "communities": Task(_communities),
+    "layers": Task(_layers),
+    "metrics": Task(lambda graphs: degree_analysis.metrics(graphs["graph_50"])),
+    # one task per script of visualize/Makefile
+    "animate_propagation": Task(lambda graphs: animate_propagation.main(graphs["graph_50"])),
+    "animate_community_propagation": Task(
+        lambda graphs, communities: animate_community_propagation.main(graphs["graph_50"], communities),
+        needs=["communities"]),
+    "find_critical_nodes": Task(lambda graphs: find_critical_nodes.main(graphs["graph_50"])),
+    "propagation_analysis": Task(lambda graphs: propagation_analysis.main(graphs["graph_50"])),
+    "community_analysis": Task(
+        lambda graphs, communities, layers: community_analysis.main(graphs["graph_50"], communities,
+                                                                    layers["graph_50"]),
+        needs=["communities", "layers"]),
+    "plot_graph": Task(lambda graphs, layers: plot_graph.main(layers), needs=["layers"]),
+    "degree_analysis": Task(lambda graphs, report: degree_analysis.main(graphs["graph_50"], report),
+                            needs=["metrics"]),
+}
+
+
+def required(names):
+    """`names` and every task they need, in the order of TASKS."""
+    wanted = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in TASKS:
+            raise ValueError(f"unknown task {name!r}, expected one of {list(TASKS)}")
+        if name not in wanted:
+            wanted.add(name)
+            pending.extend(TASKS[name].needs)
+    return [name for name in TASKS if name in wanted]
+
+
+_graphs = None
+
+
+def _init_worker(graphs):
+    global _graphs
+    _graphs = graphs
+    os.chdir(VISUALIZE_DIR)
+
+
+def _run_task(name, results):
+    with instrument.stage(name):
+        return TASKS[name].function(_graphs, *results)
+
+
+def run_tasks(names, graphs, workers=1):
+    """
+    Runs tasks once all the tasks they need are done.
+
+    :param names: tasks to run, including the ones they need (see required)
+    :param graphs: dict of CSRGraph by name, passed to every task
+    :param workers: worker processes (1 runs every task here, None or 0 uses all cores)
+    :return: dict of the result of every task
+    """
+    workers = workers or os.cpu_count()
+    results = {}
+    if workers == 1:
+        _init_worker(graphs)
+        for name in names:
+            results[name] = _run_task(name, [results[need] for need in TASKS[name].needs])
+        return results
+    pending = list(names)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(graphs,)) as executor:
+        running = {}
+        while pending or running:
+            for name in [name for name in pending if all(need in results for need in TASKS[name].needs)]:
+                pending.remove(name)
+                running[executor.submit(_run_task, name, [results[need] for need in TASKS[name].needs])] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # a failed task stops the pipeline, as in make
+                results[name] = future.result()
+                log.info(f"task {name} done")
+    return results
+
+
+def run_pipeline(names=None, workers=1, generate=True):
+    """
+    :param names: visualize tasks to run with the tasks they need (None: all)
+    :param workers: worker processes of the visualize tasks
+    :param generate: run the generate stages first
+    """
+    with instrument.stage("pipeline"):
+        if generate:
+            with working_dir(GENERATE_DIR):
+                for name, main in GENERATE.items():
+                    with instrument.stage(name):
+                        main()
+        with working_dir(VISUALIZE_DIR):
+            with instrument.stage("load_graphs"):
+                graphs = {name: load_graph(path) for name, path in GRAPH_FILES.items()}
+                instrument.record(graphs=len(graphs), nodes=sum(g.n for g in graphs.values()),
+                                  edges=sum(g.m for g in graphs.values()))
+            run_tasks(required(names or list(TASKS)), graphs, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="runs the generate and visualize stages in one process")
+    parser.add_argument("tasks", nargs="*", help=f"visualize tasks (default: all of {', '.join(TASKS)})")
+    parser.add_argument("--workers", type=int, help="worker processes of the visualize tasks (default: [pipeline] workers)")
+    parser.add_argument("--skip-generate", action="store_true", help="use the graphs already in data/")
+    args = parser.parse_args()
+    run_pipeline(args.tasks or None, args.workers if args.workers is not None else
+                 config.getint("pipeline", "workers", fallback=1), generate=not args.skip_generate)
@@ -0,0 +1,165 @@
+'''
+Content-addressed cache of pipeline artifacts.
+
+Every stage output is stored under data/cache/<stage>/<key>/, where the key is a hash of the
+stage name, the contents of its input files (including the script that produces it) and the
+config options it depends on. A stage whose key is already cached copies its artifacts back
+instead of recomputing them, so several parameter variants live side by side on disk. The
+least recently used entries are evicted when the cache grows past `max_size_mb`.
+'''
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import instrument
+
+log = logging.getLogger(os.path.basename(__file__))
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "cache")
+
+
+class StageCache:
+
+    def __init__(self, root=CACHE_DIR, max_size_mb=4096, enabled=True):
+        self.root = root
+        self.max_bytes = max_size_mb * 2**20
+        self.enabled = enabled
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_size_mb=config.getint("cache", "max_size_mb", fallback=4096),
+                   enabled=config.getboolean("cache", "enabled", fallback=True))
+
+    @staticmethod
+    def sources(script, *modules):
+        """
+        Absolute paths of a script and of the modules it imports, so that the cache key of its
+        stages does not depend on the working directory.
+
+        :param script: __file__ of the script
+        :param modules: paths relative to the directory of the script
+        """
+        directory = os.path.dirname(os.path.abspath(script))
+        return [os.path.abspath(script)] + [os.path.normpath(os.path.join(directory, module)) for module in modules]
+
+    def key(self, stage, inputs=(), options=None):
+        """Hash of the stage name, the input file contents and the options."""
+        h = hashlib.sha256(stage.encode())
+        for path in inputs:
+            h.update(self._digest(path).encode())
+        h.update(json.dumps(options or {}, sort_keys=True, default=str).encode())
+        return h.hexdigest()[:16]
+
+    def run(self, stage, outputs, compute, inputs=(), options=None):
+        """
+        Restores the outputs of `stage` from the cache, or calls compute() and caches its outputs.
+
+        :param stage: stage name
+        :param outputs: files written by compute()
+        :param compute: function producing the outputs
+        :param inputs: files the outputs depend on (scripts and modules: see sources)
+        :param options: config values the outputs depend on
+        :return: True if the outputs came from the cache
+        """
+        # every stage is measured, cache hits included (recorded with cached: true)
+        with instrument.stage(stage) as record:
+            if not self.enabled:
+                compute()
+                return False
+            key = self.key(stage, inputs, options)
+            if self.restore(stage, key, outputs):
+                log.info(f"{stage}: reusing cached {', '.join(os.path.basename(p) for p in outputs)} (key {key})")
+                record.set(cached=True)
+                return True
+            log.info(f"{stage}: computing (key {key})")
+            compute()
+            self.store(stage, key, outputs, options)
+            record.set(cached=False)
+            return False
+
+    def restore(self, stage, key, outputs):
+        entry = os.path.join(self.root, stage, key)
+        cached = [os.path.join(entry, os.path.basename(path)) for path in outputs]
+        if not all(os.path.exists(path) for path in cached):
+            return False
+        for source, target in zip(cached, outputs):
+            shutil.copy2(source, target)
+        self._touch(entry)
+        return True
+
+    def store(self, stage, key, outputs, options=None):
+        entry = os.path.join(self.root, stage, key)
+        os.makedirs(entry, exist_ok=True)
+        for path in outputs:
+            shutil.copy2(path, os.path.join(entry, os.path.basename(path)))
+        with open(os.path.join(entry, "meta.json"), "w") as f:
+            json.dump({"stage": stage, "options": options or {}, "created": time.time()}, f, default=str)
+        self._touch(entry)
+        self.evict()
+
+    def entries(self):
+        """(last use, size in bytes, path) of every cache entry."""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                entry = os.path.join(stage_dir, key)
+                used = os.path.join(entry, "used")
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                # entries without a use mark were interrupted while being stored: evict them first
+                entries.append((os.path.getmtime(used) if os.path.exists(used) else 0, size, entry))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size_mb."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        # the most recent entry is kept even if it alone is larger than the limit
+        for _, size, entry in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            log.info(f"evicting {os.path.relpath(entry, self.root)} ({size / 2**20:.1f} MiB)")
+            shutil.rmtree(entry)
+            total -= size
+
+    @staticmethod
+    def _touch(entry):
+        with open(os.path.join(entry, "used"), "w"):
+            pass
+
+    def _digest(self, path):
+        """
+        sha256 of a file, remembered while its size and modification time do not change.
+
+        Several processes share the index: it is replaced atomically, and an index that cannot
+        be read only means that digests are computed again.
+        """
+        stat = os.stat(path)
+        index_file = os.path.join(self.root, "digests.json")
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        path = os.path.abspath(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if index.get(path, [None])[:2] != signature:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    h.update(block)
+            index = {p: v for p, v in index.items() if os.path.exists(p)}
+            index[path] = signature + [h.hexdigest()]
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{index_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, index_file)
+        return index[path][2]
@@ -2,90 +2,74 @@
 import configparser
 import logging
 import os
-import pickle
 import random
 
-import EoN
-import networkx as nx
-from matplotlib import pyplot as plt
-from matplotlib.animation import FuncAnimation
+
+import sir
+from propagation_renderer import PropagationScene, frame_times, save_animation, status_colors
+
+from graph_io import load_graph
+
+import instrument
 
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
-GRAPH_FILE = "../../data/graph_50.gpickle"
+GRAPH_FILE = "../../data/graph_50.npz"
 
-if __name__ == "__main__":
-    if not os.path.exists(GRAPH_FILE):
-        log.error(f"Graph file not found at {GRAPH_FILE}")
-        exit(1)
 
-    with open(GRAPH_FILE, 'rb') as f:
-        G = pickle.load(f)
+def main(graph=None):
+    """:param graph: CSRGraph of GRAPH_FILE, if already loaded"""
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
 
     # --- Parâmetros da Simulação ---
     gamma = 1.0
     tau_values = [1.0]
-
-    # Posições dos nós para o plot geográfico
-    pos = {node: (data['Longitude'], data['Latitude']) for node, data in G.nodes(data=True)}
+    # processos que desenham os frames (seção [animation] do config.ini)
+    workers = config.getint("animation", "workers", fallback=1)
 
     # Usamos o mesmo nó inicial para todas as simulações para uma comparação justa
     # TODO: Idealmente seria interessante usar as datas do conjunto de dados para escolher os nós iniciais
     # e usar essas datas para ver como é a propagação de fato.
-    initial_infected_node = random.choice(list(G.nodes()))
-    log.info(f"Starting fire at node: {initial_infected_node} for all animations.")
+    initial_infected_node = random.randrange(graph.n)
+    log.info(f"Starting fire at node: {graph.ids[initial_infected_node]} for all animations.")
 
-    # Dicionário de cores para os status
-    color_dict = {'S': '#a0a0a0', 'I': '#ff0000', 'R': '#303030'} # Cinza, Vermelho, Preto
+    # Cores para os status: cinza, vermelho, preto
+    colors = status_colors('#a0a0a0', burning='#ff0000', burned='#303030')
 
     # Loop para criar uma animação para cada valor de tau
     for tau in tau_values:
         log.info(f"Generating animation for tau = {tau}...")
 
-        # Roda a simulação para obter o objeto com todos os dados
-        sim = EoN.fast_SIR(G, tau, gamma, initial_infecteds=[initial_infected_node], return_full_data=True)
+        # Roda a simulação e calcula o status de todos os nós em cada frame (frames x nós)
+        with instrument.stage(f"simulate/tau_{tau}", nodes=graph.n, edges=graph.m):
+            result = sir.batch_sir(graph, tau, gamma, [initial_infected_node])
+        animation_times = frame_times(result, 100)
+        statuses = result.statuses(animation_times)
 
         # --- Configuração da Animação ---
-        fig, ax = plt.subplots(figsize=(12, 8))
-
-        # Define os tempos para os frames da animação (ex: 100 frames)
-        times = sim.t()
-        animation_times = [times[i] for i in range(0, len(times), len(times) // 100)] if len(times) > 100 else times
-
-        # Função que atualiza cada frame da animação
-        def update(frame_time):
-            ax.clear()
-
-            # Obtém o status de todos os nós no tempo do frame
-            statuses = sim.get_statuses(G.nodes(), frame_time)
-            node_colors = [color_dict[statuses[node]] for node in G.nodes()]
-
-            # Desenha a rede com as cores atualizadas
-            nx.draw(G, pos, ax=ax, with_labels=False, node_size=20, edgelist=[], node_color=node_colors)
-            # Desenha apenas as arestas que conectam a um nó queimando
-            burning_edges = [(u, v) for u, v in G.edges() if statuses[u] == 'I' or statuses[v] == 'I']
-            nx.draw_networkx_edges(G, pos, ax=ax, edgelist=burning_edges, edge_color='#ff9999', alpha=0.7)
-
-            ax.set_title(f"Fire Propagation (τ={tau}) at Time {frame_time:.2f}")
-            ax.set_xlabel("Longitude")
-            ax.set_ylabel("Latitude")
-            
-            # Adiciona uma legenda manual
-            legend_elements = [plt.Line2D([0], [0], marker='o', color='w', label='Susceptible', markerfacecolor=color_dict['S'], markersize=10),
-                               plt.Line2D([0], [0], marker='o', color='w', label='Burning', markerfacecolor=color_dict['I'], markersize=10),
-                               plt.Line2D([0], [0], marker='o', color='w', label='Burned-out', markerfacecolor=color_dict['R'], markersize=10)]
-            ax.legend(handles=legend_elements, loc='upper right')
-
-        # Cria o objeto de animação
-        anim = FuncAnimation(fig, update, frames=animation_times, interval=100, repeat_delay=1000)
-
-        # Salva a animação como um GIF
+        # Os artistas (nós e arestas) são criados uma única vez; cada frame só troca cores e arestas
+        scene = PropagationScene(graph, statuses, animation_times, colors, sizes=[20, 20, 20],
+                                 title=f"Fire Propagation (τ={tau}) at Time {{time:.2f}}", figsize=(12, 8),
+                                 edge_alpha=0.7,
+                                 # Adiciona uma legenda manual
+                                 legend=[('Susceptible', '#a0a0a0', 10), ('Burning', '#ff0000', 10),
+                                         ('Burned-out', '#303030', 10)])
+
+        # Salva a animação como um GIF (100 ms por frame), gravando cada frame assim que é desenhado;
+        # com workers > 1 os frames são divididos entre processos
         output_filename = f"../../data/propagation_animation_tau_{str(tau).replace('.', '_')}.gif"
-        log.info(f"Saving animation to {output_filename}... (This may take a moment)")
-        anim.save(output_filename, writer='pillow')
-        plt.close(fig) # Fecha a figura para liberar memória
+        log.info(f"Saving animation to {output_filename}...")
+        with instrument.stage(f"render/tau_{tau}", nodes=graph.n, edges=graph.m, frames=scene.frames):
+            save_animation(scene, output_filename, fps=10, workers=workers)
 
     log.info("All animations generated.")
+
+
+if __name__ == "__main__":
+    if not os.path.exists(GRAPH_FILE):
+        log.error(f"Graph file not found at {GRAPH_FILE}")
+        exit(1)
+    main()
@@ -0,0 +1,229 @@
+'''
+Community detection on CSR graphs, computed once per graph and options and shared by every script.
+
+The partition is saved next to the graph (graph_50.npz -> graph_50_communities.npz) as one
+int32 community label per node position, with its modularity and the time it took, and goes
+through the stage cache so other option values are kept side by side.
+
+Reasoning: networkx's Louvain moves one node at a time in Python dictionaries. Here the local
+moving phase is vectorized over all nodes: the weight from every node to every neighbouring
+community is summed in one sparse product, each node picks its best community, and a random
+part of the improving nodes move at once (all of them at once could swap forever). A round
+that lowers the modularity is undone and retried with fewer movers. Communities are then
+merged into nodes of a weighted graph (a sparse product again) and the phases repeat until
+nothing moves. Like Leiden, communities are finally split into their connected components,
+so no community is disconnected.
+'''
+import logging
+import os
+import time
+
+import numpy as np
+from networkx.algorithms import community as nx_comm
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from graph_io import load_graph
+
+log = logging.getLogger(os.path.basename(__file__))
+
+METHODS = ("louvain", "networkx")
+
+
+def _adjacency(graph):
+    """Symmetric scipy CSR matrix of the edge weights."""
+    return sparse.csr_matrix((np.asarray(graph.weight, dtype=np.float64), np.asarray(graph.indices),
+                              np.asarray(graph.indptr)), shape=(graph.n, graph.n))
+
+
+def _relabel(labels):
+    """Labels renumbered 0..k-1 in order of first appearance, and k."""
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse], len(first)
+
+
+def _membership(labels, k):
+    """(nodes, k) sparse indicator matrix of the communities."""
+    n = len(labels)
+    return sparse.csr_matrix((np.ones(n), (np.arange(n), labels)), shape=(n, k))
+
+
+def modularity(adjacency, labels, resolution=1.0):
+    """
+    Modularity of a partition.
+
+    :param adjacency: symmetric scipy sparse matrix (self-loops on the diagonal count twice in the degree
+                      only if stored twice, as in an aggregated graph)
+    :param labels: community of every node
+    """
+    labels, k = _relabel(np.asarray(labels))
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    two_m = degree.sum()
+    if two_m == 0:
+        return 0.0
+    member = _membership(labels, k)
+    internal = (member.T @ adjacency @ member).diagonal()
+    total = np.bincount(labels, weights=degree, minlength=k)
+    return float(internal.sum() / two_m - resolution * ((total / two_m) ** 2).sum())
+
+
+def _quality(row, col, data, degree, two_m, labels, resolution):
+    """modularity() over precomputed COO arrays and degrees, without building matrices."""
+    internal = data[labels[row] == labels[col]].sum()
+    total = np.bincount(labels, weights=degree)
+    return float(internal / two_m - resolution * ((total / two_m) ** 2).sum())
+
+
+def _local_moving(adjacency, resolution, rng, max_rounds=100, tolerance=1e-7):
+    """Vectorized local moving phase: community of every node of `adjacency`."""
+    n = adjacency.shape[0]
+    coo = adjacency.tocoo()
+    row, col, data = coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data
+    degree = np.bincount(row, weights=data, minlength=n)
+    two_m = degree.sum()
+    labels = np.arange(n)
+    if two_m == 0:
+        return labels
+    # self-loops are always inside their community: they shift the modularity by a constant
+    loops = row != col
+    row, col, data = row[loops], col[loops], data[loops]
+    quality = _quality(row, col, data, degree, two_m, labels, resolution)
+    # only nodes next to a node that moved in the last round are reconsidered (as in Leiden's queue)
+    active = np.ones(n, dtype=bool)
+    for _ in range(max_rounds):
+        total = np.bincount(labels, weights=degree, minlength=n)
+        considered = active[row]
+        # weight from every active node to every neighbouring community, one entry per (node, community)
+        key, inverse = np.unique(row[considered] * n + labels[col[considered]], return_inverse=True)
+        weight = np.bincount(inverse, weights=data[considered])
+        node, community = key // n, key % n
+        own = community == labels[node]
+        gain = weight - resolution * degree[node] * (total[community] - own * degree[node]) / two_m
+        # gain of staying, also for nodes with no neighbour in their own community
+        stay = -resolution * degree * (total[labels] - degree) / two_m
+        stay[node[own]] += weight[own]
+        # best community of every node: highest gain first within each node
+        order = np.lexsort((-gain, node))
+        best = order[np.flatnonzero(np.diff(node[order], prepend=-1))]
+        improving = best[gain[best] > stay[node[best]] + 1e-12]
+        if not len(improving):
+            break
+        movers, target = node[improving], community[improving]
+        fraction = 0.5
+        while fraction > 1e-3:
+            chosen = rng.random(len(movers)) < fraction
+            if not chosen.any():
+                chosen[rng.integers(len(movers))] = True
+            moved = labels.copy()
+            moved[movers[chosen]] = target[chosen]
+            moved_quality = _quality(row, col, data, degree, two_m, moved, resolution)
+            if moved_quality > quality + 1e-12:
+                break
+            fraction /= 2
+        else:
+            break
+        gained = moved_quality - quality
+        labels, quality = moved, moved_quality
+        if gained < tolerance:
+            break
+        active[:] = False
+        active[movers[chosen]] = True
+        active[col[active[row]]] = True
+    return _relabel(labels)[0]
+
+
+def louvain(graph, resolution=1.0, seed=42, max_levels=20):
+    """
+    Louvain communities of a CSRGraph, refined to connected communities.
+
+    :param graph: CSRGraph (edge weights are used)
+    :param resolution: modularity resolution (larger gives smaller communities)
+    :param seed: seed of the random choice of the moving nodes
+    :param max_levels: maximum number of aggregation levels
+    :return: int32 community label of every node position, numbered by first appearance
+    """
+    rng = np.random.default_rng(seed)
+    adjacency = _adjacency(graph)
+    labels = np.arange(graph.n)
+    level = adjacency
+    for _ in range(max_levels):
+        communities = _local_moving(level, resolution, rng)
+        k = communities.max() + 1 if len(communities) else 0
+        if k == level.shape[0]:
+            break
+        labels = communities[labels]
+        member = _membership(communities, k)
+        level = (member.T @ level @ member).tocsr()
+    # split disconnected communities: keep only the edges inside a community
+    coo = adjacency.tocoo()
+    inside = labels[coo.row] == labels[coo.col]
+    internal = sparse.csr_matrix((coo.data[inside], (coo.row[inside], coo.col[inside])), shape=adjacency.shape)
+    _, components = csgraph.connected_components(internal, directed=False)
+    return _relabel(components)[0].astype(np.int32)
+
+
+def networkx_louvain(graph, resolution=1.0, seed=42):
+    """Reference implementation: networkx's Louvain on the networkx view of the graph, as labels."""
+    communities = nx_comm.louvain_communities(graph.to_networkx(), weight='weight', resolution=resolution, seed=seed)
+    position = graph.position()
+    labels = np.empty(graph.n, dtype=np.int64)
+    for i, community in enumerate(communities):
+        labels[[position[node] for node in community]] = i
+    return _relabel(labels)[0].astype(np.int32)
+
+
+def detect_communities(graph, method="louvain", resolution=1.0, seed=42):
+    """
+    :return: (labels, modularity, seconds)
+    """
+    if method not in METHODS:
+        raise ValueError(f"unknown community method {method!r}, expected one of {METHODS}")
+    start = time.perf_counter()
+    labels = (louvain if method == "louvain" else networkx_louvain)(graph, resolution=resolution, seed=seed)
+    seconds = time.perf_counter() - start
+    return labels, modularity(_adjacency(graph), labels, resolution), seconds
+
+
+def community_file(graph_file):
+    return os.path.splitext(graph_file)[0] + "_communities.npz"
+
+
+def save_communities(path, labels, quality, seconds, method):
+    np.savez(path, labels=labels, modularity=quality, seconds=seconds, method=method)
+
+
+def load_communities(path):
+    """:return: (labels, modularity, seconds)"""
+    with np.load(path) as data:
+        return data['labels'], float(data['modularity']), float(data['seconds'])
+
+
+def options_from_config(config, section="communities"):
+    return {'method': config.get(section, "method", fallback="louvain"),
+            'resolution': config.getfloat(section, "resolution", fallback=1.0),
+            'seed': config.getint(section, "seed", fallback=42)}
+
+
+def cached_communities(graph_file, cache, method="louvain", resolution=1.0, seed=42, graph=None):
+    """
+    Partition of a saved graph, computed once per graph file and options.
+
+    :param graph_file: .npz graph
+    :param cache: StageCache
+    :param graph: CSRGraph of graph_file, if already loaded
+    :return: (labels, modularity, seconds) as in detect_communities
+    """
+    path = community_file(graph_file)
+
+    def stage():
+        labels, quality, seconds = detect_communities(load_graph(graph_file) if graph is None else graph, method, resolution, seed)
+        save_communities(path, labels, quality, seconds, method)
+
+    cache.run("communities", [path], stage, inputs=[*cache.sources(__file__, "../generate/graph_io.py"), graph_file],
+              options={'method': method, 'resolution': resolution, 'seed': seed})
+    labels, quality, seconds = load_communities(path)
+    log.info(f"{method}: {labels.max() + 1 if len(labels) else 0} communities, modularity {quality:.4f}, "
+             f"computed in {seconds:.2f} s")
+    return labels, quality, seconds
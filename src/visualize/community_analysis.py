@@ -1,50 +1,55 @@
-import itertools
 import configparser
 import logging
 import os
-import pickle
 
-import networkx as nx
-from networkx.algorithms import community as nx_comm
-#import networkx.community 
-from matplotlib import pyplot as plt
+import matplotlib
+import numpy as np
 
+from communities import cached_communities, options_from_config
 from plot_graph import plot_communities
 
+from graph_io import load_graph
+
+from stage_cache import StageCache
+
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
-GRAPH_FILE = "../../data/graph_50.gpickle"
+GRAPH_FILE = "../../data/graph_50.npz"
 
-if __name__ == "__main__":
-    if not os.path.exists(GRAPH_FILE):
-        log.error(f"Graph file not found at {GRAPH_FILE}")
-        exit(1)
 
-    with open(GRAPH_FILE, 'rb') as f:
-        G = pickle.load(f)
+def main(graph=None, communities=None, layers=None):
+    """
+    :param graph: CSRGraph of GRAPH_FILE, if already loaded
+    :param communities: (labels, modularity, seconds) of cached_communities, if already computed
+    :param layers: GraphLayers of the graph (plot_graph.py), if already computed
+    """
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
 
     log.info("Starting community detection using Louvain algorithm...")
 
-    # Detectar comunidades usando o algoritmo de Louvain
-    communities = nx_comm.louvain_communities(G, weight='weight', seed=42)
-    log.info(f"Found {len(communities)} communities.")
-
-    # Criar um mapeamento de nó para ID da comunidade para colorir
-    node_to_community = {}
-    for i, community in enumerate(communities):
-        for node in community:
-            node_to_community[node] = i
+    # Detectar comunidades usando o algoritmo de Louvain (seção [communities] do config.ini);
+    # a partição é calculada uma vez por grafo e opções e reutilizada pelos outros scripts
+    labels, modularity, seconds = communities or cached_communities(GRAPH_FILE, StageCache.from_config(config),
+                                                                    graph=graph, **options_from_config(config))
+    log.info(f"Found {labels.max() + 1} communities (modularity {modularity:.4f}).")
 
     # Gerar uma lista de cores para as comunidades
     # Usamos um ciclo de cores para o caso de haver muitas comunidades
-    color_cycle = itertools.cycle(plt.cm.get_cmap('tab20').colors)
-    community_colors = [next(color_cycle) for _ in range(len(communities))]
+    palette = np.asarray(matplotlib.colormaps['tab20'].colors)
 
     # Mapear a cor para cada nó
-    node_colors = [community_colors[node_to_community[node]] for node in G.nodes()]
+    node_colors = palette[labels % len(palette)]
 
     log.info("Plotting graph with detected communities...")
-    plot_communities(G, node_colors, title="Fire Spot Communities (Louvain)")
+    plot_communities(graph if layers is None else layers, node_colors, title="Fire Spot Communities (Louvain)",
+                     backend=config.get("plot", "backend", fallback="lines"))
+
+
+if __name__ == "__main__":
+    if not os.path.exists(GRAPH_FILE):
+        log.error(f"Graph file not found at {GRAPH_FILE}")
+        exit(1)
+    main()
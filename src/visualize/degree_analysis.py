@@ -1,173 +1,219 @@
-import pickle
 import configparser
 import logging
 import os
 
-import networkx as nx
 from matplotlib import pyplot as plt
 import numpy as np
 
+from graph_io import load_graph
+from graph_metrics import graph_metrics, load_report, save_report
+from robustness import adaptive_attack_order, betweenness_centrality, largest_component_curve, random_failure_curves
+
+from stage_cache import StageCache
+
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
+GRAPH_FILE = "../../data/graph_50.npz"
+METRICS_FILE = "../../data/graph_metrics.json"
+METRICS_NODES_FILE = "../../data/graph_metrics_nodes.parquet"
+OUTPUTS = ["degree_distribution", "degree_distribution_log_log", "clustering_distribution", "betweenness_distribution",
+           "top_betweenness_nodes", "robustness_analysis"]
 
-def robustness_analysis(G, strategy='targeted'):
+def robustness_analysis(graph, strategy='targeted', runs=1, rng=None, betweenness=None, batch_size=1, k=None):
     """
     Performs a robustness analysis by removing nodes and tracking the size of the largest connected component.
 
-    :param G: The graph to analyze.
-    :param strategy: 'targeted' (removes nodes by decreasing betweenness centrality) or 'random'.
-    :return: A list with the size of the largest connected component after each node removal.
+    :param graph: The CSRGraph to analyze.
+    :param strategy: 'targeted' (removes nodes by decreasing betweenness centrality), 'adaptive' (recomputes
+                     betweenness after each batch of removals) or 'random'.
+    :param runs: number of random removal orders averaged for the 'random' strategy.
+    :param rng: numpy Generator or seed for the random orders and the betweenness sampling.
+    :param betweenness: betweenness of every node of the full graph, if already computed.
+    :param batch_size: nodes removed between recomputations for the 'adaptive' strategy, or a fraction of the
+                       nodes if below 1.
+    :param k: sampled sources of the approximate betweenness (None for exact).
+    :return: An array with the size of the largest connected component after each node removal
+             (the mean over the runs for 'random').
     """
-    g_copy = G.copy()
-    lcc_sizes = []
-
-    if strategy == 'targeted':
+    if strategy in ('targeted', 'adaptive') and betweenness is None:
         # Calcula uma vez betweenness centrality
-        nodes_to_remove = sorted(nx.betweenness_centrality(g_copy).items(), key=lambda item: item[1], reverse=True)
-        nodes_to_remove = [node for node, centrality in nodes_to_remove]
+        betweenness = betweenness_centrality(graph, k=k, seed=rng)
+    if strategy == 'targeted':
+        nodes_to_remove = np.argsort(-np.asarray(betweenness), kind='stable')
+        return largest_component_curve(graph, nodes_to_remove)
+    elif strategy == 'adaptive':
+        batch_size = int(batch_size) if batch_size >= 1 else max(1, round(batch_size * graph.n))
+        nodes_to_remove = adaptive_attack_order(graph, batch_size=batch_size, k=k, seed=rng, initial=betweenness)
+        return largest_component_curve(graph, nodes_to_remove)
     elif strategy == 'random':
-        nodes_to_remove = list(g_copy.nodes())
-        np.random.shuffle(nodes_to_remove)
+        return random_failure_curves(graph, runs, rng).mean(axis=0)
+    else:
+        raise ValueError("A estrategia deve ser 'targeted', 'adaptive' ou 'random'")
+
+
+def metrics_stage(graph=None):
+    # Grau, clustering, distância média e betweenness calculados em passagens compartilhadas.
+    # Com betweenness_samples > 0, distâncias e betweenness são estimadas a partir de k nós de origem sorteados.
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
+    samples = config.getint("degree", "betweenness_samples", fallback=500) or None
+    summary, nodes = graph_metrics(graph, samples=samples, seed=42)
+    save_report(summary, nodes, METRICS_FILE, METRICS_NODES_FILE)
+    log.info(f"Metrics report saved to {METRICS_FILE}")
+
+
+def analysis(graph=None, report=None):
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
+    summary, metrics = report or load_report(METRICS_FILE, METRICS_NODES_FILE)
+    mean_degree = summary['mean_degree']
+    log.info(f"Mean degree: {mean_degree:.4f}")
+
+    # Número de nós de cada grau, ordenado pelo grau
+    x, y = summary['degree_histogram']['degree'], summary['degree_histogram']['nodes']
+
+    # 5 Plotar a distribuição de graus
+    plt.figure(figsize=(8, 5))
+    plt.bar(x, y, width=0.8, color='skyblue', edgecolor='black')
+    plt.title("Degree Distribution")
+    plt.xlabel("Degree (k)")
+    plt.ylabel("Number of Nodes")
+    plt.axvline(mean_degree, label='<k>', color='blue')
+    plt.legend()
+    plt.grid(alpha=0.3)
+    plt.savefig(f"../../data/degree_distribution.png", bbox_inches="tight")
+
+    plt.figure(figsize=(8, 5))
+    plt.scatter(x,np.array(y)/summary['nodes'], color='skyblue')
+    plt.axvline(mean_degree, label='<k>', color='blue')
+    plt.legend()
+    plt.xscale('log')
+    plt.yscale('log')
+    plt.title("Degree Probability (log-log scale)")
+    plt.xlabel("Degree (k)")
+    plt.ylabel("P(k)")
+    plt.grid(alpha=0.3)
+    plt.savefig(f"../../data/degree_distribution_log_log.png", bbox_inches="tight")
+
+    # 2. Mean Distance (Distância Média)
+    # Número médio de saltos no maior componente (o grafo inteiro, se for conectado)
+    ci = f" ± {summary['mean_distance_ci95']:.2f}" if not summary['exact'] else ""
+    if summary['components'] == 1:
+        log.info(f"Mean Distance: {summary['mean_distance']:.2f}{ci}")
     else:
-        raise ValueError("A estrategia deve ser 'targeted' ou 'random'")
+        log.info(f"Mean Distance (largest component): {summary['mean_distance']:.2f}{ci}")
+        log.info(f"  Note: Graph has {summary['components']} components")
+
+    # 3. Clustering Coefficient (Coeficiente de Agrupamento)
+    clustering_coeff = summary['average_clustering']
+    log.info(f"Clustering Coefficient: {clustering_coeff:.4f}")
+
+    # Distribuição de Clustering Coefficient local
+    plt.figure(figsize=(8, 5))
+    clustering_values = metrics['clustering']
+    plt.hist(clustering_values, bins=50, color='lightgreen', edgecolor='black', alpha=0.7)
+    plt.axvline(clustering_coeff, color='red', linestyle='--', linewidth=2,
+                label=f'Mean: {clustering_coeff:.4f}')
+    plt.title("Local Clustering Coefficient Distribution")
+    plt.xlabel("Clustering Coefficient")
+    plt.ylabel("Frequency")
+    plt.legend()
+    plt.grid(alpha=0.3)
+    plt.savefig(f"../../data/clustering_distribution.png", bbox_inches="tight")
+
+    # 4. Betweenness Centrality (Centralidade de Intermediação)
+    # Calculada uma única vez no relatório e usada pelos gráficos e pelo ataque direcionado.
+    betweenness_samples = config.getint("degree", "betweenness_samples", fallback=500) or None
+    betweenness_array = metrics['betweenness']
+    betweenness = dict(zip(metrics['node_id'].tolist(), betweenness_array.tolist()))
+    mean_betweenness = summary['mean_betweenness']
+    log.info(f"Mean Betweenness Centrality: {mean_betweenness:.6f}")
+    log.info("=" * 50)
+
+    # Distribuição de Betweenness Centrality
+    plt.figure(figsize=(10, 5))
+    betweenness_values = sorted(betweenness.values(), reverse=True)
+    plt.plot(betweenness_values, linewidth=2, color='coral')
+    plt.title("Betweenness Centrality Distribution")
+    plt.xlabel("Node Rank")
+    plt.ylabel("Betweenness Centrality")
+    plt.grid(alpha=0.3)
+    plt.savefig(f"../../data/betweenness_distribution.png", bbox_inches="tight")
+
+    # Top 10 nós com maior Betweenness
+    plt.figure(figsize=(10, 6))
+    top_10_nodes = sorted(betweenness.items(), key=lambda x: x[1], reverse=True)[:10]
+    nodes, values = zip(*top_10_nodes)
+    plt.barh(range(len(nodes)), values, color='lightcoral', edgecolor='black')
+    plt.yticks(range(len(nodes)), [f"Node {n}" for n in nodes])
+    plt.xlabel("Betweenness Centrality")
+    plt.title("Top 10 Nodes by Betweenness Centrality")
+    plt.grid(alpha=0.3, axis='x')
+    plt.tight_layout()
+    plt.savefig(f"../../data/top_betweenness_nodes.png", bbox_inches="tight")
+
+    # 5. Análise de Robustez
+    log.info("Starting robustness analysis...")
+
+    # Ataque direcionado baseado na centralidade de intermediação
+    lcc_targeted = robustness_analysis(graph, strategy='targeted', betweenness=betweenness_array)
+
+    # Ataque adaptativo: a betweenness é recalculada após cada lote de remoções
+    attack_batch_size = config.getfloat("degree", "attack_batch_size", fallback=0.01)
+    lcc_adaptive = robustness_analysis(graph, strategy='adaptive', betweenness=betweenness_array,
+                                       batch_size=attack_batch_size, k=betweenness_samples, rng=42)
+
+    # Falha aleatória, média sobre várias ordens de remoção
+    robustness_runs = config.getint("degree", "robustness_runs", fallback=100)
+    lcc_random = robustness_analysis(graph, strategy='random', runs=robustness_runs)
+
+    # Plotando os resultados
+    plt.figure(figsize=(10, 6))
+    num_nodes = graph.n
+    fraction_removed = np.linspace(0, 1, num_nodes)
+
+    plt.plot(fraction_removed, lcc_targeted / num_nodes, '#ff7966ff', label='Targeted Attack (by Betweenness)')
+    plt.plot(fraction_removed, lcc_adaptive / num_nodes, '#b8336aff', label='Adaptive Attack (recalculated Betweenness)')
+    plt.plot(fraction_removed, lcc_random / num_nodes, '#f5b073ff', label=f'Random Failure (mean of {robustness_runs})')
+
+    plt.title("Graph Robustness to Node Removal")
+    plt.xlabel("Fraction of Nodes Removed")
+    plt.ylabel("Fractional Size of Largest Connected Component")
+    plt.grid(alpha=0.3)
+    plt.legend()
+    plt.savefig(f"../../data/robustness_analysis.png", bbox_inches="tight")
+    log.info("Robustness analysis finished. Plot saved to ../../data/robustness_analysis.png")
+
+
+def metrics(graph=None):
+    """
+    Metrics report of the graph, computed once per graph and number of sampled sources.
 
-    for node in nodes_to_remove:
-        g_copy.remove_node(node)
-        if g_copy.number_of_nodes() > 0:
-            largest_cc = max(nx.connected_components(g_copy), key=len)
-            lcc_sizes.append(len(largest_cc))
-        else:
-            lcc_sizes.append(0)
-    return lcc_sizes
+    :param graph: CSRGraph of GRAPH_FILE, if already loaded
+    :return: (summary dict, dict of per-node arrays) as in graph_metrics
+    """
+    StageCache.from_config(config).run(
+        "graph_metrics", [METRICS_FILE, METRICS_NODES_FILE], lambda: metrics_stage(graph),
+        # the report depends on graph_metrics.py, not on this script
+        inputs=[*StageCache.sources(__file__, "graph_metrics.py", "../generate/graph_io.py")[1:], GRAPH_FILE],
+        options={"samples": config.getint("degree", "betweenness_samples", fallback=500)})
+    return load_report(METRICS_FILE, METRICS_NODES_FILE)
 
 
-if __name__ == "__main__":
-    with open("../../data/graph_50.gpickle", 'rb') as f:
-        G1 = pickle.load(f)
-        # Calcular o grau de cada nó
-        degrees = [d for _, d in G1.degree()]
-        mean_degree = np.mean(degrees)
-        log.info(f"Mean degree: {mean_degree:.4f}")
-
-        # Contar quantos nós têm cada grau
-        degree_counts = {}
-        for d in degrees:
-            degree_counts[d] = degree_counts.get(d, 0) + 1
-
-        # Ordenar os graus
-        sorted_degrees = sorted(degree_counts.items())
-
-        # Separar os eixos
-        x, y = zip(*sorted_degrees)
-
-        # 5 Plotar a distribuição de graus
-        plt.figure(figsize=(8, 5))
-        plt.bar(x, y, width=0.8, color='skyblue', edgecolor='black')
-        plt.title("Degree Distribution")
-        plt.xlabel("Degree (k)")
-        plt.ylabel("Number of Nodes")
-        plt.axvline(mean_degree, label='<k>', color='blue')
-        plt.legend()
-        plt.grid(alpha=0.3)
-        plt.savefig(f"../../data/degree_distribution.png", bbox_inches="tight")
-
-        plt.figure(figsize=(8, 5))
-        plt.scatter(x,np.array(y)/G1.number_of_nodes(), color='skyblue')
-        plt.axvline(mean_degree, label='<k>', color='blue')
-        plt.legend()
-        plt.xscale('log')
-        plt.yscale('log')
-        plt.title("Degree Probability (log-log scale)")
-        plt.xlabel("Degree (k)")
-        plt.ylabel("P(k)")
-        plt.grid(alpha=0.3)
-        plt.savefig(f"../../data/degree_distribution_log_log.png", bbox_inches="tight")
-
-        # 2. Mean Distance (Distância Média)
-        # Verifica se o grafo é conectado
-        if nx.is_connected(G1):
-            mean_distance = nx.average_shortest_path_length(G1)
-            log.info(f"Mean Distance: {mean_distance:.2f}")
-        else:
-            # Se não for conectado, calcula para o maior componente
-            largest_cc = max(nx.connected_components(G1), key=len)
-            G_largest = G1.subgraph(largest_cc).copy()
-            mean_distance = nx.average_shortest_path_length(G_largest, weight="weight")
-            log.info(f"Mean Distance (largest component): {mean_distance:.2f}")
-            log.info(f"  Note: Graph has {nx.number_connected_components(G1)} components")
-
-        # 3. Clustering Coefficient (Coeficiente de Agrupamento)
-        clustering_coeff = nx.average_clustering(G1)
-        log.info(f"Clustering Coefficient: {clustering_coeff:.4f}")
-
-        # Distribuição de Clustering Coefficient local
-        plt.figure(figsize=(8, 5))
-        local_clustering = nx.clustering(G1)
-        clustering_values = list(local_clustering.values())
-        plt.hist(clustering_values, bins=50, color='lightgreen', edgecolor='black', alpha=0.7)
-        plt.axvline(clustering_coeff, color='red', linestyle='--', linewidth=2,
-                    label=f'Mean: {clustering_coeff:.4f}')
-        plt.title("Local Clustering Coefficient Distribution")
-        plt.xlabel("Clustering Coefficient")
-        plt.ylabel("Frequency")
-        plt.legend()
-        plt.grid(alpha=0.3)
-        plt.savefig(f"../../data/clustering_distribution.png", bbox_inches="tight")
-
-        # 4. Betweenness Centrality (Centralidade de Intermediação)
-        betweenness = nx.betweenness_centrality(G1)
-        mean_betweenness = np.mean(list(betweenness.values()))
-        log.info(f"Mean Betweenness Centrality: {mean_betweenness:.6f}")
-        log.info("=" * 50)
-
-        # Distribuição de Betweenness Centrality
-        plt.figure(figsize=(10, 5))
-        betweenness_values = sorted(betweenness.values(), reverse=True)
-        plt.plot(betweenness_values, linewidth=2, color='coral')
-        plt.title("Betweenness Centrality Distribution")
-        plt.xlabel("Node Rank")
-        plt.ylabel("Betweenness Centrality")
-        plt.grid(alpha=0.3)
-        plt.savefig(f"../../data/betweenness_distribution.png", bbox_inches="tight")
-
-        # Top 10 nós com maior Betweenness
-        plt.figure(figsize=(10, 6))
-        top_10_nodes = sorted(betweenness.items(), key=lambda x: x[1], reverse=True)[:10]
-        nodes, values = zip(*top_10_nodes)
-        plt.barh(range(len(nodes)), values, color='lightcoral', edgecolor='black')
-        plt.yticks(range(len(nodes)), [f"Node {n}" for n in nodes])
-        plt.xlabel("Betweenness Centrality")
-        plt.title("Top 10 Nodes by Betweenness Centrality")
-        plt.grid(alpha=0.3, axis='x')
-        plt.tight_layout()
-        plt.savefig(f"../../data/top_betweenness_nodes.png", bbox_inches="tight")
-
-        # 5. Análise de Robustez
-        log.info("Starting robustness analysis...")
-
-        # Ataque direcionado baseado na centralidade de intermediação
-        lcc_targeted = robustness_analysis(G1, strategy='targeted')
-
-        # Falha aleatória
-        lcc_random = robustness_analysis(G1, strategy='random')
-
-        # Plotando os resultados
-        plt.figure(figsize=(10, 6))
-        num_nodes = G1.number_of_nodes()
-        fraction_removed = np.linspace(0, 1, num_nodes)
-
-        plt.plot(fraction_removed, np.array(lcc_targeted) / num_nodes, '#ff7966ff', label='Targeted Attack (by Betweenness)')
-        plt.plot(fraction_removed, np.array(lcc_random) / num_nodes, '#f5b073ff', label='Random Failure')
-
-        plt.title("Graph Robustness to Node Removal")
-        plt.xlabel("Fraction of Nodes Removed")
-        plt.ylabel("Fractional Size of Largest Connected Component")
-        plt.grid(alpha=0.3)
-        plt.legend()
-        plt.savefig(f"../../data/robustness_analysis.png", bbox_inches="tight")
-        log.info("Robustness analysis finished. Plot saved to ../../data/robustness_analysis.png")
+def main(graph=None, report=None):
+    """
+    :param graph: CSRGraph of GRAPH_FILE, if already loaded
+    :param report: metrics(graph), if already computed
+    """
+    report = report or metrics(graph)
+    # the plots are reused when the report and the [degree] options match a cached run
+    StageCache.from_config(config).run(
+        "degree_analysis", [f"../../data/{name}.png" for name in OUTPUTS], lambda: analysis(graph, report),
+        inputs=[*StageCache.sources(__file__, "robustness.py", "graph_metrics.py", "../generate/union_find.py"),
+                GRAPH_FILE, METRICS_FILE, METRICS_NODES_FILE],
+        options={k: v for k, v in config.items("degree") if k not in config.defaults()})
 
 
+if __name__ == "__main__":
+    main()
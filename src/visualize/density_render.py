@@ -0,0 +1,200 @@
+'''
+Density rendering of graphs too large to draw edge by edge.
+
+Nodes and edges are aggregated into fixed-size NumPy canvases, one cell per output pixel:
+nodes add their weight (e.g. FRP) to the cell they fall in, and edges add 1 to every cell their
+segment crosses: segments are clipped to the canvas and split at the grid lines they cross,
+vectorized over chunks of edges so memory stays bounded.
+The canvases are then shaded (logarithmic colour scale, empty cells transparent) and shown as
+images, so drawing and saving a map costs the same for a thousand or for millions of edges, and
+dense regions show how many edges pass there instead of a solid blot of overlapping lines.
+'''
+import numpy as np
+from matplotlib import colors as mcolors
+
+
+class Canvas:
+    """
+    Grid of `width` x `height` cells over `extent` = (west, east, south, north); row 0 is the south.
+    """
+
+    def __init__(self, extent, width, height):
+        self.extent = tuple(float(e) for e in extent)
+        self.width = int(width)
+        self.height = int(height)
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def _to_pixels(self, xy):
+        west, east, south, north = self.extent
+        x = (xy[..., 0] - west) * (self.width / (east - west))
+        y = (xy[..., 1] - south) * (self.height / (north - south))
+        return x, y
+
+    def _flat_index(self, x, y):
+        """Cell of every (x, y) pixel coordinate, -1 outside the canvas."""
+        col = np.floor(x).astype(np.int64)
+        row = np.floor(y).astype(np.int64)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & (row < self.height)
+        return np.where(inside, row * self.width + col, -1)
+
+    def _accumulate(self, index, weights=None):
+        keep = index >= 0
+        return np.bincount(index[keep], weights=None if weights is None else weights[keep],
+                           minlength=self.width * self.height).astype(np.float64).reshape(self.shape)
+
+    def points(self, xy, weights=None):
+        """
+        Sum of the weights of the points in every cell (count if weights is None).
+
+        :param xy: (points, 2) longitude/latitude
+        :param weights: weight of every point
+        :return: (height, width) float array
+        """
+        xy = np.asarray(xy, dtype=np.float64)
+        index = self._flat_index(*self._to_pixels(xy))
+        return self._accumulate(index, None if weights is None else np.asarray(weights, dtype=np.float64))
+
+    def _clip(self, x0, y0, x1, y1):
+        """
+        Liang-Barsky clipping of pixel segments to the canvas.
+
+        :return: (visible mask, clipped x0, y0, x1, y1 of the visible segments)
+        """
+        dx, dy = x1 - x0, y1 - y0
+        t0, t1 = np.zeros(len(x0)), np.ones(len(x0))
+        visible = np.ones(len(x0), dtype=bool)
+        for p, q in ((-dx, x0), (dx, self.width - x0), (-dy, y0), (dy, self.height - y0)):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = q / p
+            # parallel to this side of the canvas and outside of it
+            visible &= (p != 0) | (q >= 0)
+            t0 = np.where(p < 0, np.maximum(t0, t), t0)
+            t1 = np.where(p > 0, np.minimum(t1, t), t1)
+        visible &= t0 <= t1
+        t0, t1 = t0[visible], t1[visible]
+        x0, y0, dx, dy = x0[visible], y0[visible], dx[visible], dy[visible]
+        return visible, x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy
+
+    @staticmethod
+    def _crossings(edge, a0, a1):
+        """Parameters t in (0, 1] at which segments `edge` cross the integer grid lines between a0 and a1."""
+        low = np.minimum(np.floor(a0), np.floor(a1)).astype(np.int64)
+        count = np.abs(np.floor(a1) - np.floor(a0)).astype(np.int64)
+        owner = np.repeat(edge, count)
+        line = np.repeat(low + 1, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return owner, (line - np.repeat(a0, count)) / np.repeat(a1 - a0, count)
+
+    def lines(self, segments, chunk_pixels=2**22):
+        """
+        Number of segments crossing every cell.
+
+        Segments are clipped to the canvas (Liang-Barsky) and split where they cross the grid
+        lines, so each one adds exactly 1 to every cell it passes through; segments are
+        processed in chunks of about `chunk_pixels` cells.
+
+        :param segments: (segments, 2, 2) end points as longitude/latitude
+        :param chunk_pixels: cells rasterized at once
+        :return: (height, width) float array
+        """
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+        x, y = self._to_pixels(segments)
+        _, x0, y0, x1, y1 = self._clip(x[:, 0], y[:, 0], x[:, 1], y[:, 1])
+        # cells crossed by every clipped segment: the first one, then one per grid line
+        cells = (np.abs(np.floor(x1) - np.floor(x0)) + np.abs(np.floor(y1) - np.floor(y0))).astype(np.int64) + 1
+
+        canvas = np.zeros(self.width * self.height, dtype=np.float64)
+        ends = np.cumsum(cells)
+        # first edge of every chunk: the one whose cells cross the next multiple of chunk_pixels
+        starts = np.unique(np.searchsorted(ends, np.arange(0, ends[-1] if len(ends) else 0, chunk_pixels),
+                                           side='right')).tolist()
+        for begin, end in zip(starts, starts[1:] + [len(cells)]):
+            edge = np.arange(begin, end)
+            vertical, t_vertical = self._crossings(edge, x0[edge], x1[edge])
+            horizontal, t_horizontal = self._crossings(edge, y0[edge], y1[edge])
+            owner = np.concatenate((edge, edge, vertical, horizontal))
+            t = np.concatenate((np.zeros(len(edge)), np.ones(len(edge)), t_vertical, t_horizontal))
+            order = np.lexsort((t, owner))
+            owner, t = owner[order], t[order]
+            # one cell per piece of segment between consecutive crossings, read at its middle
+            piece = (owner[1:] == owner[:-1]) & (t[1:] > t[:-1])
+            # segments reduced to a point (both ends in the same place) still mark their cell
+            point = np.ones(len(edge), dtype=bool)
+            point[np.unique(owner[1:][piece]) - begin] = False
+            owner = np.concatenate((owner[1:][piece], edge[point]))
+            t = np.concatenate(((t[1:][piece] + t[:-1][piece]) / 2, np.zeros(point.sum())))
+            index = self._flat_index(x0[owner] + t * (x1[owner] - x0[owner]), y0[owner] + t * (y1[owner] - y0[owner]))
+            canvas += np.bincount(index[index >= 0], minlength=len(canvas))
+        return canvas.reshape(self.shape)
+
+    def categorical(self, xy, colors):
+        """
+        Sum of the colours of the points in every cell and their count.
+
+        :param xy: (points, 2) longitude/latitude
+        :param colors: colour of every point (any matplotlib colour)
+        :return: ((height, width, 3) RGB sums, (height, width) counts)
+        """
+        xy = np.asarray(xy, dtype=np.float64)
+        index = self._flat_index(*self._to_pixels(xy))
+        rgb = mcolors.to_rgba_array(colors)[:, :3]
+        if len(rgb) == 1:
+            rgb = np.broadcast_to(rgb, (len(xy), 3))
+        count = self._accumulate(index)
+        return np.stack([self._accumulate(index, rgb[:, c]) for c in range(3)], axis=-1), count
+
+
+def fade_colormap(color, low_alpha=0.2):
+    """Colormap from a translucent to an opaque `color`, for shading counts of a single colour."""
+    rgb = mcolors.to_rgb(color)
+    return mcolors.LinearSegmentedColormap.from_list(f"fade_{color}", [(*rgb, low_alpha), (*rgb, 1.0)])
+
+
+def log_norm(agg):
+    """Logarithmic normalization of the non-empty cells of an aggregate."""
+    filled = agg[agg > 0]
+    if not len(filled):
+        return mcolors.Normalize(0, 1)
+    low, high = filled.min(), filled.max()
+    return mcolors.LogNorm(low, high) if high > low else mcolors.Normalize(0, high)
+
+
+def shade(agg, cmap, norm=None):
+    """
+    RGBA image of an aggregate; empty cells are transparent.
+
+    :param agg: (height, width) aggregate
+    :param cmap: matplotlib colormap
+    :param norm: normalization of the values (log_norm(agg) if None)
+    """
+    norm = norm or log_norm(agg)
+    image = cmap(norm(np.where(agg > 0, agg, np.nan)))
+    image[agg <= 0] = 0
+    return image
+
+
+def shade_categorical(rgb, count, alpha_min=0.3):
+    """RGBA image of categorical(): mean colour of each cell, opacity growing with the log of the count."""
+    image = np.zeros(count.shape + (4,))
+    filled = count > 0
+    image[..., :3] = rgb / np.maximum(count, 1)[..., None]
+    if filled.any():
+        alpha = np.log1p(count) / np.log1p(count.max())
+        image[..., 3] = np.where(filled, alpha_min + (1 - alpha_min) * alpha, 0)
+    return image
+
+
+def spread(agg, radius=1):
+    """Sum over the (2 * radius + 1)-cell square around each cell, so isolated points stay visible."""
+    if radius <= 0:
+        return agg
+    # only the two grid axes are padded, so (height, width, channels) arrays work too
+    padded = np.pad(agg, [(radius, radius)] * 2 + [(0, 0)] * (agg.ndim - 2))
+    height, width = agg.shape[:2]
+    total = np.zeros_like(agg, dtype=np.float64)
+    for dy in range(2 * radius + 1):
+        for dx in range(2 * radius + 1):
+            total += padded[dy:dy + height, dx:dx + width]
+    return total
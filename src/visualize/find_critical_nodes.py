@@ -1,27 +1,32 @@
 import configparser
 import logging
 import os
-import pickle
 
-import EoN
 import networkx as nx
+import numpy as np
 from matplotlib import pyplot as plt
-from tqdm import tqdm
+
+from ignition_sweep import ignition_sweep, summarize
+
+from graph_io import load_graph
+
+import instrument
+from stage_cache import StageCache
 
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
-GRAPH_FILE = "../../data/graph_50.gpickle"
+GRAPH_FILE = "../../data/graph_50.npz"
+SWEEP_FILE = "../../data/ignition_sweep.npz"
+CHECKPOINT_FILE = "../../data/ignition_sweep_checkpoint.npz"
 
-if __name__ == "__main__":
-    if not os.path.exists(GRAPH_FILE):
-        log.error(f"Graph file not found at {GRAPH_FILE}")
-        exit(1)
 
-    with open(GRAPH_FILE, 'rb') as f:
-        G = pickle.load(f)
+def main(graph=None):
+    """:param graph: CSRGraph of GRAPH_FILE, if already loaded"""
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
+    G = graph.to_networkx()
 
     # --- 1. SIMULAÇÃO PARA ENCONTRAR NÓS CRÍTICOS ---
     log.info("Starting simulations to find most dangerous ignition points...")
@@ -31,28 +36,42 @@ if __name__ == "__main__":
     tau = 1.0
     gamma = 1.0
 
-    fire_outbreak_sizes = {}
-
-    # Usamos tqdm para mostrar uma barra de progresso, pois este loop pode ser demorado.
-    for initial_node in tqdm(G.nodes(), desc="Simulating outbreaks"):
-        # Rodamos a simulação sem `return_full_data` para ser mais rápido.
-        # A função retorna tuplas de arrays (t, S, I, R).
-        t, S, I, R = EoN.fast_SIR(G, tau, gamma, initial_infecteds=[initial_node])
-        
-        # O tamanho final do incêndio é o último valor do array R.
-        final_size = R[-1]
-        fire_outbreak_sizes[initial_node] = final_size
+    # Cada nó inicia `replicates` simulações independentes, distribuídas entre processos.
+    # O ranking usa a média do tamanho final, não uma única realização estocástica.
+    replicates = config.getint("critical", "replicates", fallback=20)
+    workers = config.getint("critical", "workers", fallback=0) or None
+    seed = config.getint("critical", "seed", fallback=42)
+    backend = config.get("critical", "backend", fallback="csr")
+
+    def sweep_stage():
+        instrument.record(realisations=graph.n * replicates)
+        nodes, sizes = ignition_sweep(graph, tau, gamma, replicates=replicates, workers=workers, seed=seed,
+                                      checkpoint=CHECKPOINT_FILE, backend=backend)
+        np.savez(SWEEP_FILE, nodes=nodes, sizes=sizes, **summarize(sizes))
+        log.info(f"Sweep results saved to {SWEEP_FILE}")
+
+    # a sweep with the same graph, parameters and [critical] options is reused from the cache
+    StageCache.from_config(config).run(
+        "ignition_sweep", [SWEEP_FILE], sweep_stage,
+        inputs=[*StageCache.sources(__file__, "ignition_sweep.py", "sir.py", "../generate/graph_io.py"), GRAPH_FILE],
+        options={"tau": tau, "gamma": gamma,
+                 **{k: v for k, v in config.items("critical") if k not in config.defaults() and k != "workers"}})
+    sweep = np.load(SWEEP_FILE)
+    nodes = sweep['nodes']
+    stats = {name: sweep[name] for name in ('mean', 'ci_low', 'ci_high', 'q05', 'q95')}
 
     # --- 2. IDENTIFICAR E LOGAR OS TOP 5 ---
-    # Ordena os nós pelo tamanho do incêndio que eles causaram (do maior para o menor).
-    sorted_nodes = sorted(fire_outbreak_sizes.items(), key=lambda item: item[1], reverse=True)
+    # Ordena os nós pelo tamanho médio do incêndio que eles causaram (do maior para o menor).
+    ranking = np.argsort(-stats['mean'], kind='stable')
 
-    top_5_critical_nodes = sorted_nodes[:5]
+    top_5_critical_nodes = [(nodes[i].item(), i) for i in ranking[:5]]
 
     log.info("=" * 50)
-    log.info("Top 5 Most Dangerous Ignition Points:")
-    for i, (node_id, size) in enumerate(top_5_critical_nodes):
-        log.info(f"{i+1}. Node {node_id}: Causes a fire of size {int(size)}")
+    log.info(f"Top 5 Most Dangerous Ignition Points ({replicates} simulations each):")
+    for rank, (node_id, i) in enumerate(top_5_critical_nodes):
+        log.info(f"{rank+1}. Node {node_id}: Causes a fire of mean size {stats['mean'][i]:.1f} "
+                 f"(95% CI {stats['ci_low'][i]:.1f}-{stats['ci_high'][i]:.1f}, "
+                 f"5%-95% quantiles {stats['q05'][i]:.0f}-{stats['q95'][i]:.0f})")
     log.info("=" * 50)
 
     # --- 3. VISUALIZAR OS NÓS CRÍTICOS NO MAPA ---
@@ -61,7 +80,7 @@ if __name__ == "__main__":
     # Definir cores e tamanhos para o plot
     node_colors = []
     node_sizes = []
-    critical_node_ids = [node_id for node_id, size in top_5_critical_nodes]
+    critical_node_ids = [node_id for node_id, i in top_5_critical_nodes]
 
     for node in G.nodes():
         if node in critical_node_ids:
@@ -90,3 +109,10 @@ if __name__ == "__main__":
 
     plt.savefig("../../data/critical_ignition_points.png", bbox_inches="tight")
     log.info("Map of critical ignition points saved to ../../data/critical_ignition_points.png")
+
+
+if __name__ == "__main__":
+    if not os.path.exists(GRAPH_FILE):
+        log.error(f"Graph file not found at {GRAPH_FILE}")
+        exit(1)
+    main()
@@ -0,0 +1,221 @@
+'''
+Structural metrics of a CSR graph computed in shared passes, written to one report.
+
+Triangles are counted once per node (a row-chunked sparse product A @ A masked by A), which
+gives both the local clustering of every node and the average clustering. Shortest-path
+trees are built once per source node: the hop distances from a batch of sources come from
+scipy's compiled BFS, and the edges of their shortest-path DAGs are then swept level by level,
+forwards to count shortest paths (Brandes' sigma) and backwards to accumulate dependencies
+(Brandes' delta). The same distances give the mean distance of the largest component and the
+same dependencies give the betweenness, so the two metrics cost one traversal per source.
+
+Distances and betweenness are unweighted (hop counts), like networkx's defaults. For large
+graphs they can be estimated from `samples` random source nodes; the report then includes the
+standard error of the mean distance and of the betweenness of every node.
+
+The report is a JSON file with the scalar metrics and the degree histogram, and a Parquet
+table with the metrics of every node.
+'''
+import json
+import logging
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
+from scipy.sparse import csgraph
+
+import instrument
+
+log = logging.getLogger(os.path.basename(__file__))
+
+# 95% normal quantile of the confidence intervals of sampled estimates
+Z95 = 1.959963984540054
+
+
+def adjacency_matrix(graph):
+    """Unweighted symmetric scipy CSR matrix of the graph, without self-loops."""
+    indptr, indices = np.asarray(graph.indptr), np.asarray(graph.indices)
+    rows = np.repeat(np.arange(graph.n), np.diff(indptr))
+    keep = rows != indices
+    return sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], indices[keep])), shape=(graph.n, graph.n))
+
+
+def triangles(adjacency, chunk_size=4096):
+    """Number of triangles through every node, counted over chunks of rows of A @ A."""
+    n = adjacency.shape[0]
+    counts = np.zeros(n, dtype=np.int64)
+    for begin in range(0, n, chunk_size):
+        rows = adjacency[begin:begin + chunk_size]
+        counts[begin:begin + chunk_size] = np.asarray((rows @ adjacency).multiply(rows).sum(axis=1)).ravel() // 2
+    return counts
+
+
+def clustering(degree, triangle_counts):
+    """Local clustering of every node (0 for nodes of degree < 2, as in networkx)."""
+    pairs = degree * (degree - 1) / 2
+    return np.divide(triangle_counts, pairs, out=np.zeros(len(degree)), where=pairs > 0)
+
+
+def shortest_path_batch(adjacency, sources, row, col):
+    """
+    Hop distances and Brandes dependencies of a batch of sources.
+
+    :param adjacency: unweighted scipy CSR matrix
+    :param sources: node positions of the sources
+    :param row, col: directed edge list of `adjacency`
+    :return: ((sources, nodes) distances, inf if unreachable; (sources, nodes) dependencies)
+    """
+    n, b = adjacency.shape[0], len(sources)
+    distance = csgraph.shortest_path(adjacency, directed=False, unweighted=True, indices=sources)
+    du = distance[:, row]
+    # edges (u, v) of the shortest-path DAG of each source: v is one hop further than u
+    batch, edge = np.nonzero(np.isfinite(du) & (distance[:, col] == du + 1))
+    level = du[batch, edge].astype(np.int64)
+    order = np.argsort(level, kind='stable')
+    u = (batch * n + row[edge])[order]
+    v = (batch * n + col[edge])[order]
+    bounds = np.searchsorted(level[order], np.arange(level.max() + 2 if len(level) else 1))
+
+    sigma = np.zeros(b * n)
+    sigma[np.arange(b) * n + sources] = 1
+    for begin, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        sigma += np.bincount(v[begin:end], weights=sigma[u[begin:end]], minlength=b * n)
+    delta = np.zeros(b * n)
+    for begin, end in zip(bounds[-2::-1].tolist(), bounds[:0:-1].tolist()):
+        share = sigma[u[begin:end]] / sigma[v[begin:end]] * (1 + delta[v[begin:end]])
+        delta += np.bincount(u[begin:end], weights=share, minlength=b * n)
+    delta[np.arange(b) * n + sources] = 0
+    return distance, delta.reshape(b, n)
+
+
+def _sources(n, samples, seed):
+    """All node positions, or `samples` random ones in increasing order."""
+    if samples is None or samples >= n:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(seed).choice(n, size=samples, replace=False))
+
+
+def _betweenness_scale(n, k):
+    """nx normalization of undirected betweenness, scaled by n / k when sampling k sources."""
+    return (1 / ((n - 1) * (n - 2)) if n > 2 else 1.0) * n / max(k, 1)
+
+
+def betweenness(adjacency, samples=None, seed=42, batch_entries=2**24):
+    """
+    Betweenness of every node of a scipy adjacency matrix, normalized as networkx.
+
+    :param adjacency: unweighted symmetric scipy CSR matrix without self-loops (see adjacency_matrix)
+    :param samples: number of random source nodes (None or >= nodes: exact)
+    :param seed: seed of the source sampling
+    :param batch_entries: (source, edge) pairs processed at once
+    """
+    n = adjacency.shape[0]
+    sources = _sources(n, samples, seed)
+    coo = adjacency.tocoo()
+    row, col = coo.row.astype(np.int64), coo.col.astype(np.int64)
+    batch_size = max(1, batch_entries // max(len(row), n, 1))
+    delta_sum = np.zeros(n)
+    for begin in range(0, len(sources), batch_size):
+        delta_sum += shortest_path_batch(adjacency, sources[begin:begin + batch_size], row, col)[1].sum(axis=0)
+    return delta_sum * _betweenness_scale(n, len(sources))
+
+
+def graph_metrics(graph, samples=None, seed=42, batch_entries=2**24):
+    """
+    Degree, clustering, mean distance and betweenness of a graph.
+
+    :param graph: CSRGraph
+    :param samples: number of random source nodes of the distances and betweenness (None or >= nodes: all)
+    :param seed: seed of the source sampling
+    :param batch_entries: (source, edge) pairs processed at once, bounds the memory of a batch
+    :return: (summary dict, dict of per-node arrays)
+    """
+    n = graph.n
+    with instrument.stage("components", nodes=n, edges=graph.m):
+        adjacency = adjacency_matrix(graph)
+        degree = np.diff(adjacency.indptr)
+        n_components, component = csgraph.connected_components(adjacency, directed=False)
+        sizes = np.bincount(component)
+        largest = int(np.argmax(sizes)) if n else 0
+
+    with instrument.stage("clustering", nodes=n, edges=graph.m):
+        triangle_counts = triangles(adjacency)
+        local_clustering = clustering(degree, triangle_counts)
+        triads = (degree * (degree - 1) / 2).sum()
+
+    exact = samples is None or samples >= n
+    sources = _sources(n, samples, seed)
+    coo = adjacency.tocoo()
+    row, col = coo.row.astype(np.int64), coo.col.astype(np.int64)
+    batch_size = max(1, batch_entries // max(len(row), n, 1))
+    # dependencies (sum and sum of squares over the sources) and per-source mean distances
+    delta_sum, delta_square = np.zeros(n), np.zeros(n)
+    mean_from = []
+    eccentricity = 0
+    lcc = component == largest
+    with instrument.stage("shortest_paths", nodes=n, edges=graph.m, sources=len(sources)):
+        for begin in range(0, len(sources), batch_size):
+            batch = sources[begin:begin + batch_size]
+            distance, delta = shortest_path_batch(adjacency, batch, row, col)
+            delta_sum += delta.sum(axis=0)
+            delta_square += (delta ** 2).sum(axis=0)
+            inside = lcc[batch]
+            if inside.any() and sizes[largest] > 1:
+                reached = distance[inside][:, lcc]
+                mean_from.append(reached.sum(axis=1) / (sizes[largest] - 1))
+                eccentricity = max(eccentricity, int(reached.max()))
+
+    k = len(sources)
+    scale = _betweenness_scale(n, k)
+    node_betweenness = delta_sum * scale
+    mean_from = np.concatenate(mean_from) if mean_from else np.zeros(0)
+    if exact:
+        betweenness_se = np.zeros(n)
+        distance_se = 0.0
+    else:
+        # standard errors of means over a sample without replacement of the sources
+        correction = np.sqrt(max(1 - k / n, 0.0))
+        contribution_mean = delta_sum / k
+        variance = np.maximum(delta_square / k - contribution_mean ** 2, 0) * k / max(k - 1, 1)
+        betweenness_se = np.sqrt(variance / k) * scale * correction
+        in_lcc = len(mean_from)
+        distance_se = float(mean_from.std(ddof=1) / np.sqrt(in_lcc) * np.sqrt(max(1 - in_lcc / sizes[largest], 0.0))) \
+            if in_lcc > 1 else float('nan')
+
+    values, counts = np.unique(degree, return_counts=True)
+    summary = {
+        'nodes': int(n),
+        'edges': int(adjacency.nnz // 2),
+        'components': int(n_components),
+        'largest_component': int(sizes[largest]) if n else 0,
+        'mean_degree': float(degree.mean()) if n else 0.0,
+        'degree_histogram': {'degree': values.tolist(), 'nodes': counts.tolist()},
+        'average_clustering': float(local_clustering.mean()) if n else 0.0,
+        'transitivity': float(triangle_counts.sum() / triads) if triads else 0.0,
+        'mean_distance': float(mean_from.mean()) if len(mean_from) else 0.0,
+        'mean_distance_ci95': Z95 * distance_se,
+        'max_distance_seen': eccentricity,
+        'mean_betweenness': float(node_betweenness.mean()) if n else 0.0,
+        'max_betweenness_ci95': float(Z95 * betweenness_se.max()) if n else 0.0,
+        'sources': int(k),
+        'exact': bool(exact),
+    }
+    nodes = {'node_id': np.asarray(graph.ids), 'degree': degree, 'component': component, 'triangles': triangle_counts,
+             'clustering': local_clustering, 'betweenness': node_betweenness, 'betweenness_se': betweenness_se}
+    return summary, nodes
+
+
+def save_report(summary, nodes, json_file, nodes_file):
+    with open(json_file, "w") as f:
+        json.dump({**summary, 'nodes_file': os.path.basename(nodes_file)}, f, indent=2)
+    pq.write_table(pa.table(nodes), nodes_file)
+
+
+def load_report(json_file, nodes_file):
+    """:return: (summary dict, dict of per-node arrays)"""
+    with open(json_file) as f:
+        summary = json.load(f)
+    table = pq.read_table(nodes_file)
+    return summary, {name: table.column(name).to_numpy() for name in table.column_names}
@@ -0,0 +1,136 @@
+'''
+Monte-Carlo sweep of SIR outbreaks started at every node.
+
+Each node is used as the single initial infected node in `replicates` independent SIR
+runs, simulated with the CSR engine of sir.py ('csr') or with EoN.fast_SIR ('eon'). Nodes
+are split into chunks that run in a process pool. Random draws never depend on the chunks:
+the CSR engine samples transmission graph r of every chunk from a seed derived from the
+sweep seed and r, and EoN seeds the runs of every node from the sweep seed and the node
+position, so the sizes are the same for any number of workers or chunk size. Partial
+results are checkpointed to disk so that an interrupted sweep resumes where it stopped.
+'''
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from statistics import NormalDist
+
+import EoN
+import numpy as np
+from tqdm import tqdm
+
+import sir
+
+log = logging.getLogger(os.path.basename(__file__))
+
+_graph = None
+_ids = None
+
+
+def _init_worker(graph, backend):
+    global _graph, _ids
+    _graph = graph.to_networkx() if backend == 'eon' else graph
+    _ids = graph.ids.tolist()
+
+
+def _derived_seed(seed, key):
+    return int(np.random.SeedSequence(seed, spawn_key=(key,)).generate_state(1)[0])
+
+
+def _simulate_chunk(chunk_index, nodes, tau, gamma, replicates, seed, backend):
+    """Final outbreak sizes of `replicates` runs for each node (position) of the chunk."""
+    sizes = np.empty((len(nodes), replicates), dtype=np.int32)
+    if backend == 'csr':
+        # every chunk samples the same transmission graph for replicate r
+        for r in range(replicates):
+            sizes[:, r:r + 1] = sir.final_sizes(_graph, tau, gamma, nodes, 1, rng=_derived_seed(seed, r))
+        return chunk_index, sizes
+    for i, node in enumerate(nodes):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(node,)))
+        for r in range(replicates):
+            t, S, I, R = EoN.fast_SIR(_graph, tau, gamma, initial_infecteds=[_ids[node]], rng=rng)
+            sizes[i, r] = R[-1]
+    return chunk_index, sizes
+
+
+def _load_checkpoint(checkpoint, nodes, params):
+    if not checkpoint or not os.path.exists(checkpoint):
+        return None
+    saved = np.load(checkpoint)
+    if not np.array_equal(saved['nodes'], nodes) or not np.array_equal(saved['params'], params):
+        log.warning(f"Ignoring checkpoint {checkpoint}: it was made for another graph or other parameters")
+        return None
+    return saved['sizes'], saved['done']
+
+
+def _save_checkpoint(checkpoint, nodes, params, sizes, done):
+    tmp = checkpoint + '.tmp.npz'
+    np.savez(tmp, nodes=nodes, params=params, sizes=sizes, done=done)
+    os.replace(tmp, checkpoint)
+
+
+def ignition_sweep(graph, tau, gamma, replicates=20, workers=None, seed=42, chunk_size=None, checkpoint=None,
+                   backend='csr'):
+    """
+    Runs `replicates` SIR simulations started at each node of the graph.
+
+    :param graph: CSRGraph
+    :param tau: transmission rate
+    :param gamma: recovery rate
+    :param replicates: number of simulations per initial node
+    :param workers: worker processes (None uses all cores)
+    :param seed: seed of the sweep
+    :param chunk_size: nodes per task (default: 16 for EoN; for the CSR engine, which simulates
+                       all nodes of a chunk on the same transmission graphs, a few chunks per worker)
+    :param checkpoint: .npz file used to save partial results and resume
+    :param backend: 'csr' or 'eon'
+    :return: (nodes, sizes) where sizes[i, r] is the final size of replicate r started at node id nodes[i]
+    """
+    if backend not in ('csr', 'eon'):
+        raise ValueError("backend must be 'csr' or 'eon'")
+    nodes = np.asarray(graph.ids)
+    if chunk_size is None:
+        chunk_size = 16 if backend == 'eon' else max(16, -(-graph.n // (4 * (workers or os.cpu_count()))))
+    params = np.array([tau, gamma, replicates, seed, chunk_size, backend == 'csr'], dtype=np.float64)
+    chunks = [np.arange(start, min(start + chunk_size, len(nodes))) for start in range(0, len(nodes), chunk_size)]
+
+    resumed = _load_checkpoint(checkpoint, nodes, params)
+    if resumed is not None:
+        sizes, done = resumed
+        log.info(f"Resuming sweep from {checkpoint}: {int(done.sum())}/{len(chunks)} chunks done")
+    else:
+        sizes = np.zeros((len(nodes), replicates), dtype=np.int32)
+        done = np.zeros(len(chunks), dtype=bool)
+
+    pending = [i for i in range(len(chunks)) if not done[i]]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(graph, backend)) as executor:
+        futures = [executor.submit(_simulate_chunk, i, chunks[i].tolist(), tau, gamma, replicates, seed, backend)
+                   for i in pending]
+        for future in tqdm(as_completed(futures), desc="Simulating outbreaks", total=len(futures), unit="chunks"):
+            chunk_index, chunk_sizes = future.result()
+            start = chunk_index * chunk_size
+            sizes[start:start + len(chunk_sizes)] = chunk_sizes
+            done[chunk_index] = True
+            if checkpoint:
+                _save_checkpoint(checkpoint, nodes, params, sizes, done)
+
+    return nodes, sizes
+
+
+def summarize(sizes, quantiles=(0.05, 0.5, 0.95), confidence=0.95):
+    """
+    Per-node statistics of the final outbreak sizes.
+
+    :param sizes: (nodes, replicates) array from ignition_sweep
+    :param quantiles: quantiles to report
+    :param confidence: level of the normal-approximation confidence interval of the mean
+    :return: dict of arrays: mean, std, q<quantile> and ci_low/ci_high
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    replicates = sizes.shape[1]
+    mean = sizes.mean(axis=1)
+    std = sizes.std(axis=1, ddof=1) if replicates > 1 else np.zeros_like(mean)
+    half_width = NormalDist().inv_cdf((1 + confidence) / 2) * std / np.sqrt(replicates)
+    stats = {'mean': mean, 'std': std, 'ci_low': mean - half_width, 'ci_high': mean + half_width}
+    for q, values in zip(quantiles, np.quantile(sizes, quantiles, axis=1)):
+        stats[f"q{round(q * 100):02d}"] = values
+    return stats
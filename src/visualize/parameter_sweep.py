@@ -0,0 +1,134 @@
+'''
+SIR sweep over a grid of transmission rates (tau), recovery rates (gamma), seed nodes and replicates.
+
+Every (tau, gamma) cell of the grid is one task of a process pool, simulated with the CSR
+engine of sir.py: `replicates` realisations started at each seed node, all counted on the same
+time grid so their S/I/R curves can be averaged point by point. Each cell gets its own RNG seed
+derived from the sweep seed and the cell index, so results do not depend on the scheduling.
+Workers return only the mean and quantile bands of the curves and the final outbreak sizes,
+which are saved together in one .npz file; plots are made from that file.
+
+The epidemic threshold is estimated from the final sizes: below it outbreaks stay small, above
+it some of them reach a finite fraction of the graph, and the relative variance of the final
+size (the susceptibility) peaks at the transition.
+'''
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+import sir
+
+log = logging.getLogger(os.path.basename(__file__))
+
+COMPARTMENTS = ('S', 'I', 'R')
+
+_graph = None
+
+
+def _init_worker(graph):
+    global _graph
+    _graph = graph
+
+
+def _simulate_cell(cell, tau, gamma, seed_nodes, replicates, t, seed, quantiles, batch_size):
+    """S/I/R mean and quantile bands and final sizes of one (tau, gamma) cell."""
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(cell,)))
+    initial = np.repeat(seed_nodes, replicates)
+    curves = np.empty((len(initial), len(COMPARTMENTS), len(t)), dtype=np.int32)
+    final_size = np.empty(len(initial), dtype=np.int32)
+    # realisations are simulated in batches to bound the (realisations, nodes) time arrays
+    for begin in range(0, len(initial), batch_size):
+        result = sir.batch_sir(_graph, tau, gamma, initial[begin:begin + batch_size], t=t, rng=rng)
+        curves[begin:begin + batch_size] = np.stack((result.S, result.I, result.R), axis=1)
+        final_size[begin:begin + batch_size] = result.final_size()
+    return (cell, curves.mean(axis=0), np.quantile(curves, quantiles, axis=0),
+            final_size.reshape(len(seed_nodes), replicates))
+
+
+def parameter_sweep(graph, taus, gammas, seed_nodes, replicates, t, workers=None, seed=42,
+                    quantiles=(0.05, 0.5, 0.95), batch_size=1024):
+    """
+    Runs `replicates` SIR realisations from every seed node for every (tau, gamma) pair.
+
+    :param graph: CSRGraph
+    :param taus: transmission rates
+    :param gammas: recovery rates
+    :param seed_nodes: positions of the initial infected nodes (one per realisation)
+    :param replicates: realisations per seed node and cell
+    :param t: common time grid of the S/I/R curves
+    :param workers: worker processes (None uses all cores)
+    :param seed: seed of the sweep
+    :param quantiles: quantiles of the S/I/R bands
+    :param batch_size: realisations simulated at once in a worker
+    :return: dict of arrays: tau, gamma, seed_nodes, t, quantiles,
+             mean (tau, gamma, compartment, time), bands (tau, gamma, quantile, compartment, time)
+             and final_size (tau, gamma, seed node, replicate)
+    """
+    taus = np.asarray(taus, dtype=np.float64)
+    gammas = np.asarray(gammas, dtype=np.float64)
+    seed_nodes = np.asarray(seed_nodes, dtype=np.int64)
+    t = np.asarray(t, dtype=np.float64)
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    cells = [(a, b) for a in range(len(taus)) for b in range(len(gammas))]
+
+    mean = np.empty((len(taus), len(gammas), len(COMPARTMENTS), len(t)), dtype=np.float32)
+    bands = np.empty((len(taus), len(gammas), len(quantiles), len(COMPARTMENTS), len(t)), dtype=np.float32)
+    final_size = np.empty((len(taus), len(gammas), len(seed_nodes), replicates), dtype=np.int32)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(graph,)) as executor:
+        futures = [executor.submit(_simulate_cell, cell, taus[a], gammas[b], seed_nodes, replicates, t, seed,
+                                   quantiles, batch_size)
+                   for cell, (a, b) in enumerate(cells)]
+        for future in tqdm(as_completed(futures), desc="Sweeping parameters", total=len(futures), unit="cells"):
+            cell, cell_mean, cell_bands, cell_sizes = future.result()
+            a, b = cells[cell]
+            mean[a, b] = cell_mean
+            bands[a, b] = cell_bands
+            final_size[a, b] = cell_sizes
+
+    return {'tau': taus, 'gamma': gammas, 'seed_nodes': seed_nodes, 't': t, 'quantiles': quantiles,
+            'mean': mean, 'bands': bands, 'final_size': final_size}
+
+
+def susceptibility(final_size, n):
+    """
+    Relative variance of the final outbreak fraction, per (tau, gamma): var(s) / mean(s).
+
+    :param final_size: (tau, gamma, seed node, replicate) array from parameter_sweep
+    :param n: number of nodes of the graph
+    """
+    fraction = final_size.reshape(*final_size.shape[:2], -1) / n
+    mean = fraction.mean(axis=-1)
+    return np.divide(fraction.var(axis=-1), mean, out=np.zeros_like(mean), where=mean > 0)
+
+
+def estimate_threshold(sweep, n):
+    """
+    Epidemic threshold of every gamma: the tau where the susceptibility of the final size peaks.
+
+    :param sweep: dict returned by parameter_sweep (or the loaded .npz file)
+    :param n: number of nodes of the graph
+    :return: array of tau values, one per gamma
+    """
+    chi = susceptibility(sweep['final_size'], n)
+    return np.asarray(sweep['tau'])[np.argmax(chi, axis=0)]
+
+
+def heterogeneous_mean_field_threshold(graph, gammas):
+    """
+    Threshold predicted from the degree distribution, for comparison with estimate_threshold.
+
+    An edge transmits with probability T = tau / (tau + gamma), and an outbreak can reach a
+    finite fraction of the graph when T > <k> / (<k^2> - <k>), i.e. tau > gamma * Tc / (1 - Tc).
+
+    :return: array of tau values, one per gamma (inf if the graph has no edges)
+    """
+    degree = graph.degree().astype(np.float64)
+    excess = (degree ** 2).mean() - degree.mean()
+    if excess <= 0:
+        return np.full(len(gammas), np.inf)
+    critical = degree.mean() / excess
+    return np.asarray(gammas, dtype=np.float64) * critical / (1 - critical) if critical < 1 \
+        else np.full(len(gammas), np.inf)
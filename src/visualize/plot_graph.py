@@ -2,17 +2,35 @@
 Visualize or analyze
 Subtask:
 Provide options for visualizing or analyzing the created network.
+
+Reasoning: Everything a map needs from a graph (node positions, FRP marker sizes, the FRP legend
+and the edge segments) is computed once per graph in GraphLayers, and every background image
+is read and downsampled once. Edges are drawn as one LineCollection, rasterized when there are
+many of them, so a map costs a few array copies instead of one matplotlib artist per edge.
+Several maps can be rendered at the same time by a process pool that receives each graph once.
+Graphs with too many edges for that are drawn with the density backend (density_render.py),
+whose cost depends on the size of the image instead of the number of edges.
 '''
 import configparser
 import logging
 import os
-import pickle
 import re
-from statistics import quantiles
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import networkx as nx
 import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib import colormaps
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
+from PIL import Image
+
+import density_render
+
+from graph_io import CSRGraph, load_graph
+
+import instrument
 
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
@@ -20,80 +38,256 @@ config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
 
-def plot(graph, title="Network based on Latitude and Longitude", img_src=None):
-  # Create a dictionary of positions for the nodes using Latitude and Longitude
-  pos = {node: (data['Longitude'], data['Latitude']) for node, data in graph.nodes(data=True)}
-
-  frp = np.array(list(data for node, data in graph.nodes(data="FRP")))
-  log.info(f"min frp = {min(frp)}")
-  log.info(f"max frp = {max(frp)}")
-  sizes = frp - min(frp) + 1 # min size 1
-  sizes = np.emath.power(sizes, 3/4 ) # max size is sizes**(3/4)
-  log.info(f"min sizes = {min(sizes)}")
-  log.info(f"max sizes = {max(sizes)}")
-
-  # Draw the network
-  fig, ax = plt.subplots(figsize=(18, 12))
-  longs = [p[0] for p in pos.values()]
-  lats = [p[1] for p in pos.values()]
-  log.info(f"min long = {min(longs)}")
-  log.info(f"max long = {max(longs)}")
-  log.info(f"min lat = {min(lats)}")
-  log.info(f"max lat = {max(lats)}")
-  if img_src:
-      img = plt.imread(img_src)
-      ax.imshow(img, extent=[-53.2, max(longs), -25.2, max(lats)])
-  nx.draw(graph, pos, with_labels=False, node_size=sizes, edge_color='#27211e', alpha=0.6, node_color='#ff7966')
-  plt.title(title, fontsize=20)
-  plt.xlabel("Longitude")
-  plt.ylabel("Latitude")
-
-  # Create dummy scatter plots for the legend
-  # The 's' parameter in scatter corresponds to the area, so you might need to adjust for visual representation
-  # If your node_size in nx.draw is proportional to radius, then s should be proportional to radius^2
-  n = 1000
-  quantiles_pack = list(zip(quantiles(frp, n=n), quantiles(sizes, n=n)))
-  for i in range(0, n, n//10-1):
-    frp,size = quantiles_pack[i]
-    plt.scatter([], [], s=size, color='#ffbcb3', label=f'{frp:.0f}')
-
-  plt.legend(scatterpoints=1, frameon=False, labelspacing=2, reverse=True, title='FRP')
-  title = re.sub(r'[^\x00-\x7F]+', '', title)
-  title = title.replace(" ", "_")
-  #plt.show()
-  plt.savefig(f"../../data/{title}.png", bbox_inches="tight")
-
-def plot_communities(graph, node_colors, title="Communities", img_src=None):
-    # Create a dictionary of positions for the nodes using Latitude and Longitude
-    pos = {node: (data['Longitude'], data['Latitude']) for node, data in graph.nodes(data=True)}
-
-    # Draw the network
-    fig, ax = plt.subplots(figsize=(18, 12))
-    longs = [p[0] for p in pos.values()]
-    lats = [p[1] for p in pos.values()]
+FIGSIZE = (18, 12)
+# west and south borders of the background images; east and north come from the nodes
+IMAGE_WEST, IMAGE_SOUTH = -53.2, -25.2
+# above this number of edges the LineCollection is drawn as an image in vector outputs
+RASTERIZE_EDGES = 20000
+# "lines" draws every edge, "density" draws node and edge densities aggregated per pixel
+BACKENDS = ("lines", "density")
+# radius in pixels of the node density cells, so single nodes stay visible
+DENSITY_SPREAD = 2
+
+
+class GraphLayers:
+    """
+    Static drawing data of a graph.
+
+    xy: (nodes, 2) longitude/latitude of the nodes
+    frp, sizes: FRP of the nodes and their marker sizes
+    segments: (edges, 2, 2) end points of the edges
+    legend: (FRP, marker size) pairs of the FRP legend
+    """
+
+    def __init__(self, xy, frp, sizes, segments, legend):
+        self.xy = xy
+        self.frp = frp
+        self.sizes = sizes
+        self.segments = segments
+        self.legend = legend
+
+    @classmethod
+    def from_graph(cls, graph, n=1000):
+        """
+        :param graph: CSRGraph or networkx graph with Latitude, Longitude and FRP node attributes
+        :param n: number of quantiles the legend entries are picked from
+        """
+        if isinstance(graph, nx.Graph):
+            graph = CSRGraph.from_networkx(graph)
+        xy = np.column_stack((np.asarray(graph.nodes['Longitude'], dtype=np.float64),
+                              np.asarray(graph.nodes['Latitude'], dtype=np.float64)))
+        frp = np.asarray(graph.nodes['FRP'], dtype=np.float64)
+        sizes = frp - frp.min() + 1 # min size 1
+        sizes = np.emath.power(sizes, 3/4) # max size is sizes**(3/4)
+        u, v, _ = graph.edges()
+        # every (n // 10 - 1)-th of the n-quantiles, computed like statistics.quantiles (exclusive method)
+        levels = [(i + 1) / n for i in range(0, n, n // 10 - 1)]
+        legend = list(zip(np.quantile(frp, levels, method='weibull').tolist(),
+                          np.quantile(sizes, levels, method='weibull').tolist()))
+        return cls(xy, frp, sizes, np.stack((xy[u], xy[v]), axis=1), legend)
+
+    def log_ranges(self):
+        log.info(f"min frp = {self.frp.min()}")
+        log.info(f"max frp = {self.frp.max()}")
+        log.info(f"min sizes = {self.sizes.min()}")
+        log.info(f"max sizes = {self.sizes.max()}")
+        log.info(f"min long = {self.xy[:, 0].min()}")
+        log.info(f"max long = {self.xy[:, 0].max()}")
+        log.info(f"min lat = {self.xy[:, 1].min()}")
+        log.info(f"max lat = {self.xy[:, 1].max()}")
+
+
+@lru_cache(maxsize=None)
+def graph_layers(graph):
+    """GraphLayers of a graph, computed once per graph object."""
+    return GraphLayers.from_graph(graph)
+
+
+@lru_cache(maxsize=None)
+def load_background(img_src, max_size=(FIGSIZE[0] * 100, FIGSIZE[1] * 100)):
+    """Background image as an array, read once and downsampled to at most `max_size` pixels."""
+    with Image.open(img_src) as img:
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        return np.asarray(img)
+
+
+def _draw(ax, layers, img_src, node_color, node_size, edge_color, alpha):
+    """Background, edges and nodes, drawn like nx.draw with the same options."""
+    if img_src:
+        ax.imshow(load_background(img_src),
+                  extent=[IMAGE_WEST, layers.xy[:, 0].max(), IMAGE_SOUTH, layers.xy[:, 1].max()])
+    edges = LineCollection(layers.segments, colors=edge_color, alpha=alpha, zorder=1,
+                           rasterized=len(layers.segments) > RASTERIZE_EDGES)
+    ax.scatter(layers.xy[:, 0], layers.xy[:, 1], s=node_size, c=node_color, alpha=alpha, zorder=2)
+    ax.add_collection(edges)
+    if len(layers.segments):
+        # same 5% padding around the edges as nx.draw_networkx_edges
+        low, high = layers.segments.min(axis=(0, 1)), layers.segments.max(axis=(0, 1))
+        pad = 0.05 * (high - low)
+        ax.update_datalim([low - pad, high + pad])
+        ax.autoscale_view()
+    ax.set_axis_off()
+
+
+def _density_canvas(ax, layers):
+    """Canvas over the nodes (with the 5% padding of _draw) and one cell per pixel of the axes."""
+    low, high = layers.xy.min(axis=0), layers.xy.max(axis=0)
+    pad = 0.05 * (high - low)
+    low, high = low - pad, high + pad
+    box = ax.get_window_extent()
+    return density_render.Canvas((low[0], high[0], low[1], high[1]), max(int(box.width), 1), max(int(box.height), 1))
+
+
+def _draw_density(ax, layers, img_src, nodes, edge_color):
+    """
+    Background and the density images of the edges and the nodes.
+
+    :param nodes: (height, width, 4) RGBA image of the nodes, drawn over the edges
+    """
     if img_src:
-        img = plt.imread(img_src)
-        ax.imshow(img, extent=[-53.2, max(longs), -25.2, max(lats)])
+        ax.imshow(load_background(img_src),
+                  extent=[IMAGE_WEST, layers.xy[:, 0].max(), IMAGE_SOUTH, layers.xy[:, 1].max()])
+    canvas = _density_canvas(ax, layers)
+    edges = density_render.shade(canvas.lines(layers.segments), density_render.fade_colormap(edge_color))
+    for image, zorder in [(edges, 1), (nodes, 2)]:
+        ax.imshow(image, extent=canvas.extent, origin='lower', interpolation='nearest', aspect=ax.get_aspect(),
+                  zorder=zorder)
+    ax.set_axis_off()
 
-    nx.draw(graph, pos, with_labels=False, node_size=20, edge_color='#cccccc', alpha=0.7, node_color=node_colors)
-    plt.title(title, fontsize=20)
-    plt.xlabel("Longitude")
-    plt.ylabel("Latitude")
 
-    title = re.sub(r'[^\x00-\x7F]+', '', title).replace(" ", "_")
+def _save(title):
+    title = re.sub(r'[^\x00-\x7F]+', '', title)
+    title = title.replace(" ", "_")
     plt.savefig(f"../../data/{title}.png", bbox_inches="tight")
+    plt.close()
+
+
+def plot(graph, title="Network based on Latitude and Longitude", img_src=None, backend="lines"):
+    """
+    Map of the graph with FRP-sized nodes.
+
+    :param graph: CSRGraph, networkx graph or its GraphLayers
+    :param title: title of the map, also its file name in data/
+    :param img_src: background image
+    :param backend: "lines" draws every node and edge, "density" the FRP and edge densities per pixel
+    """
+    layers = graph if isinstance(graph, GraphLayers) else graph_layers(graph)
+    layers.log_ranges()
+    with instrument.stage(f"plot/{title}", nodes=len(layers.xy), edges=len(layers.segments)) as record:
+        record.set(backend=backend)
+
+        # Draw the network
+        fig, ax = plt.subplots(figsize=FIGSIZE)
+        if backend == "density":
+            canvas = _density_canvas(ax, layers)
+            frp = density_render.spread(canvas.points(layers.xy, layers.frp - layers.frp.min() + 1), DENSITY_SPREAD)
+            norm, cmap = density_render.log_norm(frp), colormaps['YlOrRd']
+            _draw_density(ax, layers, img_src, density_render.shade(frp, cmap, norm), edge_color='#27211e')
+        else:
+            _check_backend(backend)
+            _draw(ax, layers, img_src, node_color='#ff7966', node_size=layers.sizes, edge_color='#27211e', alpha=0.6)
+        plt.title(title, fontsize=20)
+        plt.xlabel("Longitude")
+        plt.ylabel("Latitude")
+
+        if backend == "density":
+            # colour scale of the FRP summed around each pixel
+            fig.colorbar(ScalarMappable(norm, cmap), ax=ax, shrink=0.6, label='FRP')
+        else:
+            # Create dummy scatter plots for the legend
+            # The 's' parameter in scatter corresponds to the area, so you might need to adjust for visual representation
+            # If your node_size in nx.draw is proportional to radius, then s should be proportional to radius^2
+            for frp, size in layers.legend:
+                plt.scatter([], [], s=size, color='#ffbcb3', label=f'{frp:.0f}')
+
+            plt.legend(scatterpoints=1, frameon=False, labelspacing=2, reverse=True, title='FRP')
+        _save(title)
+
+
+def plot_communities(graph, node_colors, title="Communities", img_src=None, backend="lines"):
+    """
+    Map of the graph with one colour per node.
+
+    :param graph: CSRGraph, networkx graph or its GraphLayers
+    :param node_colors: colour of every node, in node order
+    :param backend: "lines" or "density" (mean colour of the nodes of every pixel)
+    """
+    layers = graph if isinstance(graph, GraphLayers) else graph_layers(graph)
+    with instrument.stage(f"plot/{title}", nodes=len(layers.xy), edges=len(layers.segments)) as record:
+        record.set(backend=backend)
+
+        # Draw the network
+        fig, ax = plt.subplots(figsize=FIGSIZE)
+        if backend == "density":
+            rgb, count = _density_canvas(ax, layers).categorical(layers.xy, node_colors)
+            nodes = density_render.shade_categorical(density_render.spread(rgb, DENSITY_SPREAD),
+                                                     density_render.spread(count, DENSITY_SPREAD))
+            _draw_density(ax, layers, img_src, nodes, edge_color='#cccccc')
+        else:
+            _check_backend(backend)
+            _draw(ax, layers, img_src, node_color=node_colors, node_size=20, edge_color='#cccccc', alpha=0.7)
+        plt.title(title, fontsize=20)
+        plt.xlabel("Longitude")
+        plt.ylabel("Latitude")
+        _save(title)
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+_layers = None
+
+
+def _init_worker(layers):
+    global _layers
+    _layers = layers
+
+
+def _plot_job(key, title, img_src, backend):
+    plot(_layers[key], title, img_src, backend)
+    return title
+
+
+def plot_all(layers, jobs, workers=1, backend="lines"):
+    """
+    Renders several maps, in parallel when workers > 1.
+
+    :param layers: dict of GraphLayers, sent once to every worker
+    :param jobs: (layers key, title, background image) of every map
+    :param workers: worker processes (1 renders here, None or 0 uses all cores)
+    :param backend: "lines" or "density", see plot
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        for key, title, img_src in jobs:
+            plot(layers[key], title, img_src, backend)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_worker,
+                             initargs=(layers,)) as executor:
+        for title in executor.map(_plot_job, *zip(*jobs), [backend] * len(jobs)):
+            log.info(f"saved {title}")
+
+
+GRAPHS = ("graph_1_10", "graph_50")
+
+
+def main(layers=None):
+    """:param layers: dict of the GraphLayers of GRAPHS, if already computed"""
+    distance = config.getint("generate", "add_edges_distance", fallback=10)
+    distance2 = config.getint("generate", "add_edges_distance2", fallback=50)
+    # each graph is loaded and prepared once for all of its maps
+    graphs = dict(zip(GRAPHS, (distance, distance2)))
+    layers = layers or {name: graph_layers(load_graph(f"../../data/{name}.npz")) for name in graphs}
+    jobs = []
+    for name, d in graphs.items():
+        jobs += [(name, f"{d} km de distância", None),
+                 (name, f"{d} km de distância sobre Transporte", "Mapa_de_transportes_em_São_Paulo.jpg"),
+                 (name, f"{d} km de distância sobre Densidade Populacional", "SP_DensidadePopulacional.png")]
+    plot_all(layers, jobs, workers=config.getint("plot", "workers", fallback=1),
+             backend=config.get("plot", "backend", fallback="lines"))
+
 
 if __name__ == "__main__":
-    with open("../../data/graph_1_10.gpickle", 'rb') as f:
-        G = pickle.load(f)
-        add_edges_distance = config.getint("generate", "add_edges_distance", fallback=10)
-        plot(G, f"{add_edges_distance} km de distância")
-        plot(G, f"{add_edges_distance} km de distância sobre Transporte", "Mapa_de_transportes_em_São_Paulo.jpg")
-        plot(G, f"{add_edges_distance} km de distância sobre Densidade Populacional", "SP_DensidadePopulacional.png")
-
-    with open("../../data/graph_50.gpickle", 'rb') as f:
-        G1 = pickle.load(f)
-        add_edges_distance = config.getint("generate", "add_edges_distance2", fallback=50)
-        plot(G1, f"{add_edges_distance} km de distância")
-        plot(G1, f"{add_edges_distance} km de distância sobre Transporte", "Mapa_de_transportes_em_São_Paulo.jpg")
-        plot(G1, f"{add_edges_distance} km de distância sobre Densidade Populacional", "SP_DensidadePopulacional.png")
\ No newline at end of file
+    main()
@@ -1,68 +1,103 @@
 import configparser
 import logging
 import os
-import pickle
-import random
 
-import EoN
-import networkx as nx
+import numpy as np
 from matplotlib import pyplot as plt
 
+from parameter_sweep import (COMPARTMENTS, estimate_threshold, heterogeneous_mean_field_threshold, parameter_sweep,
+                             susceptibility)
+
+from graph_io import load_graph
+
+import instrument
+from stage_cache import StageCache
+
 config_file = os.environ['CONFIG']
 config = configparser.ConfigParser()
 config.read(config_file)
 logging.basicConfig(level=config.get('DEFAULT', 'log_level'))
 log = logging.getLogger(os.path.basename(__file__))
-GRAPH_FILE = "../../data/graph_50.gpickle"
+GRAPH_FILE = "../../data/graph_50.npz"
+SWEEP_FILE = "../../data/propagation_sweep.npz"
 
-if __name__ == "__main__":
-    if not os.path.exists(GRAPH_FILE):
-        log.error(f"Graph file not found at {GRAPH_FILE}")
-        exit(1)
 
-    with open(GRAPH_FILE, 'rb') as f:
-        G = pickle.load(f)
+def values(option, fallback):
+    return [float(value) for value in config.get("propagation", option, fallback=fallback).split(",")]
+
 
-    log.info("Starting SIR propagation simulation...")
+def main(graph=None):
+    """:param graph: CSRGraph of GRAPH_FILE, if already loaded"""
+    graph = load_graph(GRAPH_FILE) if graph is None else graph
 
-    # --- Parâmetros da Simulação ---
-    # Estes valores são exemplos. O ideal seria calibrá-los com dados reais.
+    log.info("Starting SIR parameter sweep...")
 
-    # Taxa de recuperação (fogo se extingue).
-    # Um valor de 1 significa que, em média, um incêndio em um local dura 1/1 = 1 unidade de tempo.
-    gamma = 1.0
+    # --- Parâmetros da Varredura (seção [propagation] do config.ini) ---
+    # Taxas de propagação (tau) em escala geométrica, para localizar o limiar epidêmico,
+    # mais os valores de tau mostrados nos gráficos de S/I/R.
+    plot_taus = values("plot_taus", "0.1,0.5,1.0")
+    taus = np.union1d(np.geomspace(config.getfloat("propagation", "tau_min", fallback=0.01),
+                                   config.getfloat("propagation", "tau_max", fallback=2.0),
+                                   config.getint("propagation", "tau_steps", fallback=25)), plot_taus)
+    # Taxas de recuperação (fogo se extingue). gamma = 1 significa que, em média, um incêndio
+    # em um local dura 1/1 = 1 unidade de tempo.
+    gammas = values("gammas", "1.0")
+    replicates = config.getint("propagation", "replicates", fallback=50)
+    workers = config.getint("propagation", "workers", fallback=0) or None
+    seed = config.getint("propagation", "seed", fallback=42)
+    t = np.linspace(0, config.getfloat("propagation", "t_max", fallback=20.0),
+                    config.getint("propagation", "steps", fallback=200))
 
-    # Escolher um nó aleatório para começar o incêndio
-    # Usamos o mesmo nó inicial para todas as simulações para uma comparação justa
+    # Em vez de um único nó inicial aleatório, sorteamos `seed_nodes` nós iniciais, os mesmos
+    # para todos os valores de tau e gamma, para uma comparação justa.
     # TODO: Idealmente seria interessante usar as datas do conjunto de dados para escolher os nós iniciais
     # e usar essas datas para ver como é a propagação de fato.
-    initial_infected_node = random.choice(list(G.nodes()))
+    rng = np.random.default_rng(seed)
+    seed_nodes = np.sort(rng.choice(graph.n, size=min(config.getint("propagation", "seed_nodes", fallback=20),
+                                                      graph.n), replace=False))
+
+    log.info(f"Graph has {graph.n} nodes.")
+    log.info(f"{len(taus)} tau x {len(gammas)} gamma values, {len(seed_nodes)} seed nodes, "
+             f"{replicates} replicates each")
 
-    log.info(f"Graph has {G.number_of_nodes()} nodes.")
-    log.info(f"Starting fire at node: {initial_infected_node}")
+    def sweep_stage():
+        instrument.record(cells=len(taus) * len(gammas), realisations=len(taus) * len(gammas) * len(seed_nodes) * replicates)
+        sweep = parameter_sweep(graph, taus, gammas, seed_nodes, replicates, t, workers=workers, seed=seed)
+        np.savez(SWEEP_FILE, **sweep)
+        log.info(f"Sweep results saved to {SWEEP_FILE}")
 
-    # Valores de tau para testar (baixo, médio, alto)
-    tau_values = [0.1, 0.5, 1.0]
+    # a sweep with the same graph and [propagation] options is reused from the cache
+    StageCache.from_config(config).run(
+        "propagation_sweep", [SWEEP_FILE], sweep_stage,
+        inputs=[*StageCache.sources(__file__, "parameter_sweep.py", "sir.py", "../generate/graph_io.py"), GRAPH_FILE],
+        options={k: v for k, v in config.items("propagation") if k not in config.defaults() and k != "workers"})
+    sweep = dict(np.load(SWEEP_FILE))
+
+    # --- Limiar epidêmico ---
+    threshold = estimate_threshold(sweep, graph.n)
+    predicted = heterogeneous_mean_field_threshold(graph, sweep['gamma'])
+    for gamma, tau_c, tau_hmf in zip(sweep['gamma'], threshold, predicted):
+        log.info(f"gamma = {gamma:g}: epidemic threshold tau_c ~ {tau_c:.3g} "
+                 f"(heterogeneous mean field: {tau_hmf:.3g})")
 
     # --- Plotar os Resultados usando Subplots ---
-    # Criamos uma figura com 1 linha e 3 colunas de subplots.
-    # `sharey=True` pode ajudar a comparar as alturas, mas vamos deixar como False
-    # para que cada gráfico tenha sua própria escala e fique mais claro.
-    fig, axes = plt.subplots(1, len(tau_values), figsize=(18, 5), sharex=True)
-    fig.suptitle("SIR Propagation Analysis for Different Spread Rates (τ)", fontsize=16)
-    
+    # Criamos uma figura com 1 linha e uma coluna por valor de tau, para o primeiro gamma.
+    # Cada curva é a média das realizações, com a faixa entre os quantis extremos.
+    fig, axes = plt.subplots(1, len(plot_taus), figsize=(6 * len(plot_taus), 5), sharex=True, squeeze=False)
+    axes = axes[0]
+    fig.suptitle(f"SIR Propagation Analysis for Different Spread Rates (τ), "
+                 f"{len(seed_nodes)} seed nodes × {replicates} runs", fontsize=16)
+    labels = {'S': 'Susceptible', 'I': 'Burning', 'R': 'Burned-out'}
+    low, high = 0, len(sweep['quantiles']) - 1
+
     # Iteramos sobre os eixos (subplots) e os valores de tau ao mesmo tempo
-    for ax, tau in zip(axes, tau_values):
-        log.info(f"Running simulation for tau = {tau}...")
-        # Rodar a simulação SIR para o valor de tau atual
-        sim = EoN.fast_SIR(G, tau, gamma, initial_infecteds=[initial_infected_node], return_full_data=True)
-        
-        # Plotar TODAS as três curvas (S, I, R) no subplot atual (ax)
-        ax.plot(sim.t(), sim.S(), label='Susceptible')
-        ax.plot(sim.t(), sim.I(), label='Burning')
-        ax.plot(sim.t(), sim.R(), label='Burned-out')
-        
-        log.info(f"  -> Simulation finished. Total nodes burned: {sim.R()[-1]}")
+    for ax, tau in zip(axes, plot_taus):
+        a = int(np.argmin(np.abs(sweep['tau'] - tau)))
+        for c, name in enumerate(COMPARTMENTS):
+            line, = ax.plot(sweep['t'], sweep['mean'][a, 0, c], label=labels[name])
+            ax.fill_between(sweep['t'], sweep['bands'][a, 0, low, c], sweep['bands'][a, 0, high, c],
+                            color=line.get_color(), alpha=0.2)
+        log.info(f"  -> tau = {tau}: mean nodes burned {sweep['final_size'][a, 0].mean():.1f}")
 
         ax.set_title(f"τ = {tau}")
         ax.grid(alpha=0.3)
@@ -70,12 +105,44 @@ if __name__ == "__main__":
 
     # Adicionar rótulo do eixo Y apenas no primeiro subplot para não poluir
     axes[0].set_ylabel("Number of Nodes")
-    
+
     # Adicionar uma única legenda para a figura inteira
-    handles, labels = axes[0].get_legend_handles_labels()
-    fig.legend(handles, labels, loc='upper right', bbox_to_anchor=(0.98, 0.88))
-    
+    handles, legend_labels = axes[0].get_legend_handles_labels()
+    fig.legend(handles, legend_labels, loc='upper right', bbox_to_anchor=(0.98, 0.88))
+
     plt.tight_layout(rect=[0, 0, 1, 0.96]) # Ajusta o layout para caber o supertítulo
     plt.savefig("../../data/sir_sensitivity_analysis.png", bbox_inches="tight")
+    plt.close(fig)
+
+    log.info("Sensitivity analysis plot saved to ../../data/sir_sensitivity_analysis.png")
+
+    # --- Tamanho final e susceptibilidade em função de tau ---
+    chi = susceptibility(sweep['final_size'], graph.n)
+    fig, (ax_size, ax_chi) = plt.subplots(1, 2, figsize=(14, 5))
+    for b, gamma in enumerate(sweep['gamma']):
+        fraction = sweep['final_size'][:, b].reshape(len(sweep['tau']), -1) / graph.n
+        line, = ax_size.plot(sweep['tau'], fraction.mean(axis=1), marker='o', label=f"γ = {gamma:g}")
+        ax_size.fill_between(sweep['tau'], *np.quantile(fraction, [0.05, 0.95], axis=1), color=line.get_color(),
+                             alpha=0.2)
+        ax_chi.plot(sweep['tau'], chi[:, b], marker='o', color=line.get_color(), label=f"γ = {gamma:g}")
+        for ax in (ax_size, ax_chi):
+            ax.axvline(threshold[b], color=line.get_color(), linestyle='--', alpha=0.7)
+    for ax, ylabel in ((ax_size, "Final burned fraction"), (ax_chi, "Susceptibility var(s)/mean(s)")):
+        ax.set_xscale('log')
+        ax.set_xlabel("τ")
+        ax.set_ylabel(ylabel)
+        ax.grid(alpha=0.3)
+        ax.legend()
+    fig.suptitle("Epidemic threshold (dashed: susceptibility peak)", fontsize=16)
+    plt.tight_layout(rect=[0, 0, 1, 0.95])
+    plt.savefig("../../data/sir_epidemic_threshold.png", bbox_inches="tight")
+    plt.close(fig)
+
+    log.info("Epidemic threshold plot saved to ../../data/sir_epidemic_threshold.png")
 
-    log.info("Sensitivity analysis plot saved to ../../data/sir_sensitivity_analysis.png")
\ No newline at end of file
+
+if __name__ == "__main__":
+    if not os.path.exists(GRAPH_FILE):
+        log.error(f"Graph file not found at {GRAPH_FILE}")
+        exit(1)
+    main()
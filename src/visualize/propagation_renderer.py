@@ -0,0 +1,274 @@
+'''
+Renderer of SIR propagation animations.
+
+The node scatter and the edge LineCollection are created once; each frame only changes the
+colours and sizes of the nodes and the segments of the edges next to a burning node. Node
+statuses of every frame come precomputed as one (frames, nodes) array (SIRResult.statuses), so
+a frame is a handful of array lookups. Frames are written by a streaming writer as soon as
+they are drawn: GIFs are encoded frame by frame with Pillow, MP4 files are piped to ffmpeg.
+Long GIFs can be rendered by a process pool, each worker drawing a contiguous slice of frames.
+'''
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from matplotlib import colors as mcolors
+from matplotlib import pyplot as plt
+from matplotlib.animation import AbstractMovieWriter, FFMpegWriter
+from matplotlib.collections import LineCollection
+from PIL import GifImagePlugin, Image
+
+log = logging.getLogger(os.path.basename(__file__))
+
+SUSCEPTIBLE, BURNING, BURNED = 0, 1, 2
+
+
+class PropagationRenderer:
+    """
+    Artists of a propagation animation on a map.
+
+    :param ax: matplotlib Axes
+    :param graph: CSRGraph with Latitude/Longitude node attributes
+    :param colors: (3, nodes, 4) RGBA colour of every node in each status (S, I, R), or (3, 1, 4)
+    :param sizes: marker size in each status, shape (3,) or (3, nodes)
+    :param edge_color: colour of the edges next to burning nodes
+    :param edge_alpha: opacity of those edges
+    """
+
+    def __init__(self, ax, graph, colors, sizes, edge_color='#ff9999', edge_alpha=0.7):
+        self.ax = ax
+        self.colors = np.broadcast_to(np.asarray(colors, dtype=np.float64), (3, graph.n, 4))
+        self.sizes = np.broadcast_to(np.asarray(sizes, dtype=np.float64)[:, None] if np.ndim(sizes) == 1
+                                     else np.asarray(sizes, dtype=np.float64), (3, graph.n))
+        self.nodes = np.arange(graph.n)
+        xy = np.column_stack((np.asarray(graph.nodes['Longitude'], dtype=np.float64),
+                              np.asarray(graph.nodes['Latitude'], dtype=np.float64)))
+        self.u, self.v, _ = graph.edges()
+        self.segments = np.stack((xy[self.u], xy[self.v]), axis=1)
+
+        self.edges = LineCollection([], colors=edge_color, alpha=edge_alpha, zorder=1)
+        ax.add_collection(self.edges)
+        self.scatter = ax.scatter(xy[:, 0], xy[:, 1], s=self.sizes[0], c=self.colors[0], edgecolors='none', zorder=2)
+        self.title = ax.set_title("")
+        ax.set_axis_off()
+
+    def update(self, status, title=None):
+        """
+        Shows one frame.
+
+        :param status: (nodes,) int8 status of every node (0 = S, 1 = I, 2 = R)
+        :param title: new title of the axes
+        :return: changed artists
+        """
+        self.scatter.set_facecolor(self.colors[status, self.nodes])
+        self.scatter.set_sizes(self.sizes[status, self.nodes])
+        burning = status == BURNING
+        self.edges.set_segments(self.segments[burning[self.u] | burning[self.v]])
+        if title is not None:
+            self.title.set_text(title)
+        return self.scatter, self.edges, self.title
+
+
+def status_colors(base_colors, burning=None, burned=None, alphas=(1.0, 1.0, 1.0)):
+    """
+    (3, nodes, 4) RGBA array for PropagationRenderer ((3, 1, 4) if every colour is a single one).
+
+    :param base_colors: one colour for all nodes or one colour per node, used for every status
+                        without its own colour
+    :param burning: colour of burning nodes (None keeps the base colour)
+    :param burned: colour of burned-out nodes (None keeps the base colour)
+    :param alphas: opacity of the nodes in each status
+    """
+    base = mcolors.to_rgba_array(base_colors)
+    layers = [base if color is None else mcolors.to_rgba_array(color) for color in (None, burning, burned)]
+    n = max(len(layer) for layer in layers)
+    rgba = np.stack([np.broadcast_to(layer, (n, 4)).copy() for layer in layers])
+    rgba[:, :, 3] = np.asarray(alphas, dtype=np.float64)[:, None]
+    return rgba
+
+
+def frame_times(result, frames, realisation=0):
+    """`frames` evenly spaced times from 0 to the last recovery of one realisation of a SIRResult."""
+    recovery = result.recovery_time[realisation]
+    end = np.max(recovery, where=np.isfinite(recovery), initial=0)
+    return np.linspace(0, end, frames)
+
+
+class StreamingGifWriter(AbstractMovieWriter):
+    """
+    GIF writer that encodes every frame as soon as it is grabbed.
+
+    The palette of the first frame is the global palette of the file, and every later frame
+    only stores the rectangle that changed since the previous one, so memory use does not
+    grow with the number of frames (matplotlib's PillowWriter keeps them all).
+
+    With `segment=True` the writer writes only frames, without the GIF header and trailer, using
+    the given palette: segments of the same animation can be rendered apart and concatenated.
+    """
+
+    def setup(self, fig, outfile, dpi=None, palette=None, segment=False):
+        super().setup(fig, outfile, dpi=dpi)
+        if segment and palette is None:
+            raise ValueError("a segment needs the palette of the animation")
+        self._file = open(outfile, 'wb')
+        self.palette = palette
+        self._segment = segment
+        self._previous = None
+
+    def _capture(self, savefig_kwargs):
+        buf = BytesIO()
+        self.fig.savefig(buf, **{**savefig_kwargs, "format": "rgba", "dpi": self.dpi})
+        frame = Image.frombuffer("RGBA", self.frame_size, buf.getbuffer(), "raw", "RGBA", 0, 1).convert("RGB")
+        if self.palette is None:
+            self.palette = frame.quantize(256, method=Image.Quantize.FASTOCTREE)
+            header, _ = GifImagePlugin.getheader(self.palette, info={"loop": 0})
+            self._file.writelines(header)
+        return frame.quantize(palette=self.palette, dither=Image.Dither.NONE)
+
+    def skip_frame(self, **savefig_kwargs):
+        """Uses the current figure as the previous frame of the next one, without writing it."""
+        self._previous = np.asarray(self._capture(savefig_kwargs))
+
+    def grab_frame(self, **savefig_kwargs):
+        frame = self._capture(savefig_kwargs)
+        pixels = np.asarray(frame)
+        box = (0, 0) + frame.size
+        if self._previous is not None:
+            rows, cols = np.nonzero(pixels != self._previous)
+            # an unchanged frame still needs a (1 pixel) image to keep its duration
+            box = (cols.min(), rows.min(), cols.max() + 1, rows.max() + 1) if len(rows) else (0, 0, 1, 1)
+        self._previous = pixels
+        self._file.writelines(GifImagePlugin.getdata(frame.crop(box), offset=box[:2], duration=int(1000 / self.fps)))
+
+    def append_segment(self, segment):
+        """Appends the frames of a segment file written with the palette of this writer."""
+        with open(segment, 'rb') as f:
+            shutil.copyfileobj(f, self._file)
+
+    def finish(self):
+        if not self._segment:
+            self._file.write(b";")
+        self._file.close()
+
+
+class PropagationScene:
+    """
+    Picklable description of a propagation animation; calling it builds the figure.
+
+    :param graph: CSRGraph
+    :param statuses: (frames, nodes) int8 status of every node in every frame
+    :param times: simulation time of every frame
+    :param colors, sizes, edge_alpha: as in PropagationRenderer
+    :param title: title of every frame, formatted with the frame `time`
+    :param figsize: size of the figure
+    :param legend: (label, colour, marker size) of every legend entry
+    :param legend_title: title of the legend
+    :param title_fontsize: font size of the title
+    """
+
+    def __init__(self, graph, statuses, times, colors, sizes, title, figsize=(12, 8), edge_alpha=0.7, legend=(),
+                 legend_title=None, title_fontsize=None):
+        self.graph = graph
+        self.statuses = statuses
+        self.times = times
+        self.colors = colors
+        self.sizes = sizes
+        self.title = title
+        self.figsize = figsize
+        self.edge_alpha = edge_alpha
+        self.legend = legend
+        self.legend_title = legend_title
+        self.title_fontsize = title_fontsize
+
+    @property
+    def frames(self):
+        return len(self.statuses)
+
+    def __call__(self):
+        """:return: (figure, update function of the frame index)"""
+        fig, ax = plt.subplots(figsize=self.figsize)
+        renderer = PropagationRenderer(ax, self.graph, self.colors, self.sizes, edge_alpha=self.edge_alpha)
+        if self.title_fontsize:
+            renderer.title.set_fontsize(self.title_fontsize)
+        if self.legend:
+            handles = [plt.Line2D([0], [0], marker='o', color='w', label=label, markerfacecolor=color,
+                                  markersize=markersize) for label, color, markersize in self.legend]
+            ax.legend(handles=handles, loc='upper right', title=self.legend_title)
+
+        def update(frame):
+            return renderer.update(self.statuses[frame], self.title.format(time=self.times[frame]))
+
+        return fig, update
+
+
+def _render_segment(scene, begin, end, path, fps, dpi, palette):
+    """Writes frames [begin, end) of a scene as a GIF segment; frame begin - 1 is drawn as their reference."""
+    fig, update = scene()
+    writer = StreamingGifWriter(fps=fps)
+    with writer.saving(fig, path, dpi, palette=palette, segment=True):
+        update(begin - 1)
+        writer.skip_frame()
+        for frame in range(begin, end):
+            update(frame)
+            writer.grab_frame()
+    plt.close(fig)
+    return path
+
+
+def save_animation(scene, path, fps=10, dpi=None, workers=1):
+    """
+    Renders every frame of a scene and writes it to `path` as soon as it is drawn.
+
+    With several workers (GIF only), the first frame is drawn here to fix the palette and the
+    other frames are split in contiguous slices rendered by a process pool. Each slice is written
+    to a segment file exactly as the serial writer would write it (its first frame is compared
+    with the last frame of the previous slice), and the segments are appended in order, so the
+    file is byte-for-byte the serial one.
+
+    :param scene: callable returning (figure, update function of the frame index), e.g. a
+                  PropagationScene; with workers it must be picklable and update(frame) must not
+                  depend on the frames drawn before
+    :param path: output .gif or .mp4 file
+    :param fps: frames per second
+    :param dpi: resolution (default: the figure dpi)
+    :param workers: worker processes (1 renders here, None or 0 uses all cores)
+    """
+    frames = scene.frames
+    fig, update = scene()
+    dpi = dpi or fig.dpi
+    workers = workers or os.cpu_count()
+    if path.endswith(".mp4") and workers > 1:
+        log.warning("parallel rendering only writes GIF files: rendering the MP4 file in one process")
+        workers = 1
+    writer = movie_writer(path, fps=fps)
+    with writer.saving(fig, path, dpi):
+        if workers == 1 or frames < 2:
+            for frame in range(frames):
+                update(frame)
+                writer.grab_frame()
+        else:
+            update(0)
+            writer.grab_frame()
+            # a few slices per worker so that slow slices do not leave workers idle
+            bounds = np.unique(np.linspace(1, frames, min(4 * workers, frames - 1) + 1).astype(int)).tolist()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_render_segment, scene, begin, end, f"{path}.{i}.part", fps, dpi,
+                                           writer.palette)
+                           for i, (begin, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+                for future in futures:
+                    segment = future.result()
+                    writer.append_segment(segment)
+                    os.remove(segment)
+    plt.close(fig)
+
+
+def movie_writer(path, fps=10):
+    """Streaming writer for a .gif or .mp4 file (MP4 needs ffmpeg)."""
+    if path.endswith(".mp4"):
+        if not FFMpegWriter.isAvailable():
+            raise RuntimeError("ffmpeg is needed to write MP4 animations")
+        return FFMpegWriter(fps=fps)
+    return StreamingGifWriter(fps=fps)
@@ -0,0 +1,96 @@
+'''
+Largest connected component curves under node removal (Newman-Ziff).
+
+Instead of removing nodes one at a time and recomputing the components, the removal order is
+processed backwards as a sequence of node additions. Each added node is joined to its
+already-present neighbours in a union-find structure, so the size of the largest component
+after every step is known in near-linear time for the whole curve.
+
+Attack orders come from betweenness centrality, either computed once or recomputed on the
+remaining graph after each batch of removals (adaptive attack). Betweenness comes from the
+batched Brandes of graph_metrics.py on the adjacency of the remaining nodes; large graphs can
+estimate it from k sampled source nodes to keep the recomputation cheap.
+'''
+import numpy as np
+
+from graph_metrics import adjacency_matrix, betweenness
+from union_find import UnionFind
+
+
+def largest_component_curve(graph, order):
+    """
+    Size of the largest connected component after each removal of `order`.
+
+    :param graph: CSRGraph
+    :param order: node positions in removal order (a permutation of all nodes)
+    :return: int array; entry i is the largest component size after removing order[:i + 1]
+    """
+    n = graph.n
+    indptr = np.asarray(graph.indptr).tolist()
+    indices = np.asarray(graph.indices).tolist()
+    uf = UnionFind(n)
+    present = [False] * n
+    curve = np.zeros(n, dtype=np.int64)
+    largest = 0
+    # after adding order[k:], the nodes order[:k] are the ones removed: entry k - 1 of the curve
+    for k in range(n - 1, 0, -1):
+        v = int(order[k])
+        present[v] = True
+        largest = max(largest, 1)
+        for u in indices[indptr[v]:indptr[v + 1]]:
+            if present[u]:
+                largest = max(largest, uf.size[uf.union(u, v)])
+        curve[k - 1] = largest
+    return curve
+
+
+def random_failure_curves(graph, runs=100, rng=None):
+    """
+    Largest component curves for `runs` random removal orders.
+
+    :return: (runs, nodes) int array, one curve per random order
+    """
+    rng = np.random.default_rng(rng)
+    return np.stack([largest_component_curve(graph, rng.permutation(graph.n)) for _ in range(runs)])
+
+
+def betweenness_centrality(graph, k=None, seed=None):
+    """
+    Betweenness centrality of every node (by position), exact or estimated from k sampled sources.
+
+    :param graph: CSRGraph
+    :param k: number of sampled sources (None or >= number of nodes for the exact value)
+    """
+    return betweenness(adjacency_matrix(graph), samples=k, seed=seed)
+
+
+def adaptive_attack_order(graph, batch_size=1, k=None, seed=None, initial=None):
+    """
+    Removal order of an attack that recomputes betweenness after every batch of removals.
+
+    :param graph: CSRGraph
+    :param batch_size: nodes removed between two recomputations
+    :param k: number of sampled sources of the approximate betweenness (None for exact)
+    :param seed: seed of the source sampling
+    :param initial: betweenness of the full graph, if already computed
+    :return: node positions in removal order
+    """
+    adjacency = adjacency_matrix(graph)
+    remaining = np.arange(graph.n)
+    order = []
+    centrality = None if initial is None else np.asarray(initial, dtype=np.float64)
+    while len(remaining):
+        # adjacency of the remaining nodes, whose positions in it follow `remaining`
+        sub = adjacency[remaining][:, remaining]
+        if centrality is None:
+            centrality = betweenness(sub, samples=k, seed=seed)
+        if not centrality.any():
+            # every component is a clique: no node lies between others, remove the rest by degree
+            degree = np.diff(sub.indptr)
+            order.extend(remaining[np.argsort(-degree, kind='stable')].tolist())
+            break
+        batch = np.argsort(-centrality, kind='stable')[:batch_size]
+        order.extend(remaining[batch].tolist())
+        remaining = np.delete(remaining, batch)
+        centrality = None
+    return np.array(order, dtype=np.int64)